@@ -0,0 +1,86 @@
+"""Short-lived caches shared by the route blueprints.
+
+When REDIS_URL is set the data lives in Redis and is shared by every
+gunicorn worker; otherwise each process keeps its own copy.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # optional; caches stay per process without it
+    redis = None
+
+REDIS_URL = os.environ.get('REDIS_URL', '')
+
+redis_client = None
+if REDIS_URL and redis is not None:
+    redis_client = redis.Redis.from_url(REDIS_URL)
+
+
+class CountsCache:
+    """Per-user profile counters (posts, followers, following).
+
+    Entries expire after ``ttl`` seconds and are dropped early by
+    invalidate() when the acting request changes them. At most
+    ``max_entries`` are kept per process; past that the entry closest
+    to expiry is evicted. A Redis outage
+    falls through to the loader rather than failing the page.
+    """
+
+    def __init__(self, prefix, ttl=30, max_entries=10000):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Every entry gets the same TTL, so insertion order is expiry order.
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, load):
+        """Return the cached counts for ``user_id``, calling ``load()`` on a miss."""
+        key = f'{self.prefix}:{user_id}'
+        if redis_client is not None:
+            try:
+                cached = redis_client.get(key)
+                if cached is not None:
+                    return json.loads(cached)
+                counts = load()
+                redis_client.setex(key, self.ttl, json.dumps(counts))
+                return counts
+            except redis.RedisError:
+                return load()
+
+        now = time.monotonic()
+        entry = self._local.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        counts = load()
+        with self._lock:
+            self._local.pop(key, None)
+            self._local[key] = (now + self.ttl, counts)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+        return counts
+
+    def invalidate(self, *user_ids):
+        """Drop the cached counts for each of ``user_ids``."""
+        keys = [f'{self.prefix}:{uid}' for uid in user_ids]
+        if redis_client is not None:
+            try:
+                redis_client.delete(*keys)
+            except redis.RedisError:
+                pass
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+    def clear(self):
+        """Forget every process-local entry."""
+        with self._lock:
+            self._local.clear()
+
+
+profile_counts = CountsCache('user-counts')
@@ -1,407 +1,735 @@
+import atexit
+import logging
+import queue
 import sqlite3
 import os
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
 
 DATABASE_PATH = os.environ.get('DATABASE_PATH', 'database/chirp.db')
 
+log = logging.getLogger(__name__)
+
 # Shared connection for in-memory databases (used in testing)
 _memory_db = None
 
+# Applied once when a pooled connection is opened. NORMAL sync is safe in
+# WAL mode (only the last commits can be lost on power failure) and saves
+# an fsync per transaction. journal_size_limit trims the WAL back to 64 MiB
+# after each checkpoint, so a burst of writes doesn't leave it at its
+# high-water mark until the next db-optimize.
+PRAGMAS = '''
+    PRAGMA journal_mode=WAL;
+    PRAGMA foreign_keys=ON;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA busy_timeout=5000;
+    PRAGMA mmap_size=268435456;
+    PRAGMA wal_autocheckpoint=1000;
+    PRAGMA journal_size_limit=67108864;
+'''
+
+# Read-only connections skip the write-side settings; query_only is a
+# second guard in case the URI mode is ignored.
+READ_PRAGMAS = '''
+    PRAGMA query_only=ON;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA busy_timeout=5000;
+    PRAGMA mmap_size=268435456;
+'''
+
+# Prepared statements kept per connection (sqlite3 defaults to 128). Every
+# query string in the app fits, so hot queries are only parsed once per
+# pooled connection.
+STATEMENT_CACHE_SIZE = 256
+
+# Per-thread pooled connections for file databases. Reusing a connection
+# keeps SQLite's page cache warm and skips the connect + PRAGMA setup on
+# every request. Each thread keeps one read-only and one writable handle;
+# in WAL mode the readers never block on the writers.
+_local = threading.local()
+_pool = []
+_pool_lock = threading.Lock()
+
+
+def _connect(readonly):
+    # Each connection is only used by its owning thread; the flag just
+    # lets the shutdown hook close it from the main thread.
+    if readonly:
+        db = sqlite3.connect(f'file:{DATABASE_PATH}?mode=ro', uri=True,
+                             check_same_thread=False,
+                             cached_statements=STATEMENT_CACHE_SIZE)
+        db.executescript(READ_PRAGMAS)
+    else:
+        db = sqlite3.connect(DATABASE_PATH, check_same_thread=False,
+                             cached_statements=STATEMENT_CACHE_SIZE)
+        db.executescript(PRAGMAS)
+    db.row_factory = sqlite3.Row
+    with _pool_lock:
+        _pool.append(db)
+    return db
 
-def get_db():
-    """Get a database connection."""
+
+def get_db(readonly=True):
+    """Get a database connection, read-only unless ``readonly=False``."""
     global _memory_db
     if DATABASE_PATH == ':memory:':
         if _memory_db is None:
-            _memory_db = sqlite3.connect(':memory:', check_same_thread=False)
+            _memory_db = sqlite3.connect(':memory:', check_same_thread=False,
+                                         cached_statements=STATEMENT_CACHE_SIZE)
             _memory_db.row_factory = sqlite3.Row
             _memory_db.execute("PRAGMA foreign_keys=ON")
         return _memory_db
-    db = sqlite3.connect(DATABASE_PATH)
-    db.row_factory = sqlite3.Row
-    db.execute("PRAGMA journal_mode=WAL")
-    db.execute("PRAGMA foreign_keys=ON")
+    attr = 'reader' if readonly else 'writer'
+    db = getattr(_local, attr, None)
+    if db is None:
+        db = _connect(readonly)
+        setattr(_local, attr, db)
     return db
 
 
+def get_db_write():
+    """Get a writable database connection."""
+    return get_db(readonly=False)
+
+
 def close_db(db):
-    """Close a database connection."""
-    if db is not None and DATABASE_PATH != ':memory:':
-        db.close()
+    """Release a database connection back to the pool.
+
+    Pooled connections stay open; any transaction left open by the
+    request is rolled back so the next user starts clean.
+    """
+    if db is not None and db.in_transaction:
+        db.rollback()
+
+
+def optimize_db():
+    """Refresh query planner statistics and truncate the WAL file."""
+    db = get_db_write()
+    db.execute('PRAGMA optimize')
+    if DATABASE_PATH != ':memory:':
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    close_db(db)
+
+
+@atexit.register
+def _close_pool():
+    """Close every pooled connection on interpreter shutdown."""
+    with _pool_lock:
+        while _pool:
+            _pool.pop().close()
+    _local.__dict__.clear()
+
+
+@atexit.register
+def _optimize_on_exit():
+    """Run optimize_db() before the pool is closed (atexit runs LIFO)."""
+    if DATABASE_PATH == ':memory:' or not _pool:
+        return
+    try:
+        optimize_db()
+    except sqlite3.Error:
+        pass
+
+
+class SettingsCache:
+    """Process-local cache of the site_settings table.
+
+    Settings are read on every request but only change from the admin
+    panel, so they are loaded lazily and kept until invalidated. The TTL
+    lets other worker processes pick up changes made elsewhere.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.version = 0
+        self._settings = None
+        self._loaded_at = 0.0
+
+    def get(self):
+        """Return the cached settings dict, reloading it if stale."""
+        settings = self._settings
+        if settings is None or time.monotonic() - self._loaded_at > self.ttl:
+            rows = get_db().execute('SELECT key, value FROM site_settings').fetchall()
+            settings = {row['key']: row['value'] for row in rows}
+            self._settings = settings
+            self._loaded_at = time.monotonic()
+        return settings
+
+    def invalidate(self):
+        """Drop the cached settings so the next get() reloads them."""
+        self._settings = None
+        self.version += 1
+
+
+settings_cache = SettingsCache()
+
+
+class BackgroundWriter(ABC):
+    """Batches writes onto a daemon thread with its own connection.
+
+    Requests queue rows and return without waiting on the fsync; the
+    thread drains whatever has queued up and hands it to write() in one
+    transaction. In-memory databases (tests) have a single shared
+    connection and are written inline instead, inside the request's open
+    transaction if there is one.
+    """
+
+    name = 'background-writer'
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # The writer thread does not survive a fork; start over in the child.
+        self._queue = queue.Queue()
+        self._thread = None
+
+    @abstractmethod
+    def write(self, db, batch):
+        """Write a batch of queued rows; subclasses supply the SQL."""
+
+    def put(self, row):
+        """Queue one row for the writer thread."""
+        if DATABASE_PATH == ':memory:':
+            db = get_db_write()
+            if db.in_transaction:
+                self.write(db, [row])
+            else:
+                with db:
+                    self.write(db, [row])
+            return
+        self._start()
+        self._queue.put(row)
+
+    def flush(self):
+        """Block until every queued row has been written."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _start(self):
+        # Started lazily so forked workers each get their own thread.
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name,
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            db = get_db_write()
+            try:
+                with db:
+                    self.write(db, batch)
+            except sqlite3.Error:
+                # No app context on this thread for current_app.logger.
+                log.exception('%s: failed to write %d queued rows',
+                              self.name, len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+class AuditLogWriter(BackgroundWriter):
+    """Background writer for admin audit_log rows.
+
+    The admin response does not wait on the audit fsync. Rows are queued
+    after the admin's change has committed (see admin.commit_and_audit).
+    """
+
+    name = 'audit-log'
+
+    INSERT_SQL = '''
+        INSERT INTO audit_log (admin_id, action, target_type, target_id, details, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''
+
+    def log(self, admin_id, action, target_type=None, target_id=None, details=''):
+        """Queue one audit row, timestamped now."""
+        self.put((admin_id, action, target_type, target_id, details,
+                  time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())))
+
+    def write(self, db, batch):
+        db.executemany(self.INSERT_SQL, batch)
+
+
+class NotificationReadMarker(BackgroundWriter):
+    """Marks notifications read after the notifications page is served.
+
+    Each mark covers the notifications up to the newest one the user was
+    shown, so anything arriving before the write lands stays unread.
+    Repeat views queued together collapse to one UPDATE per user.
+    """
+
+    name = 'notification-reads'
+
+    UPDATE_SQL = '''
+        UPDATE notifications SET is_read = 1
+        WHERE user_id = ? AND is_read = 0 AND id <= ?
+    '''
+
+    def mark(self, user_id, up_to_id):
+        """Queue marking ``user_id``'s notifications up to ``up_to_id`` read."""
+        self.put((user_id, up_to_id))
+
+    def write(self, db, batch):
+        newest = {}
+        for user_id, up_to_id in batch:
+            newest[user_id] = max(up_to_id, newest.get(user_id, up_to_id))
+        db.executemany(self.UPDATE_SQL, newest.items())
+
+
+audit_writer = AuditLogWriter()
+atexit.register(audit_writer.flush)
+
+notification_reads = NotificationReadMarker()
+atexit.register(notification_reads.flush)
+
+
+# Full schema, run by init_db() as a single script in one transaction.
+# EXCLUSIVE serializes workers that boot at the same time.
+SCHEMA_SQL = '''
+BEGIN EXCLUSIVE;
+
+-- Users table
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL COLLATE NOCASE,
+    email TEXT UNIQUE NOT NULL COLLATE NOCASE,
+    password_hash TEXT NOT NULL,
+    display_name TEXT NOT NULL DEFAULT '',
+    bio TEXT DEFAULT '' CHECK(length(bio) <= 280),
+    location TEXT DEFAULT '',
+    website TEXT DEFAULT '',
+    profile_pic TEXT DEFAULT '',
+    banner_pic TEXT DEFAULT '',
+    is_verified INTEGER DEFAULT 0,
+    is_corp_verified INTEGER DEFAULT 0,
+    affiliated_with INTEGER,
+    is_admin INTEGER DEFAULT 0,
+    is_moderator INTEGER DEFAULT 0,
+    is_private INTEGER DEFAULT 0,
+    is_suspended INTEGER DEFAULT 0,
+    suspended_until TEXT,
+    suspend_reason TEXT DEFAULT '',
+    email_verified INTEGER DEFAULT 0,
+    totp_secret TEXT,
+    theme TEXT DEFAULT 'auto',
+    accent_color TEXT DEFAULT '#6750A4',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Sessions table
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    ip_address TEXT,
+    user_agent TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Posts table
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    content TEXT NOT NULL CHECK(length(content) <= 500),
+    parent_id INTEGER,
+    repost_id INTEGER,
+    quote_id INTEGER,
+    is_edited INTEGER DEFAULT 0,
+    edit_history TEXT DEFAULT '[]',
+    edited_at TIMESTAMP,
+    is_pinned INTEGER DEFAULT 0,
+    is_deleted INTEGER DEFAULT 0,
+    media TEXT DEFAULT '[]',
+    poll_id INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (parent_id) REFERENCES posts(id) ON DELETE SET NULL,
+    FOREIGN KEY (repost_id) REFERENCES posts(id) ON DELETE SET NULL,
+    FOREIGN KEY (quote_id) REFERENCES posts(id) ON DELETE SET NULL
+);
+
+-- Polls table
+CREATE TABLE IF NOT EXISTS polls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER NOT NULL,
+    options TEXT NOT NULL DEFAULT '[]',
+    expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+);
+
+-- Poll votes table
+CREATE TABLE IF NOT EXISTS poll_votes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    poll_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    option_index INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(poll_id, user_id),
+    FOREIGN KEY (poll_id) REFERENCES polls(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Likes table
+CREATE TABLE IF NOT EXISTS likes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    post_id INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(user_id, post_id),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+);
+
+-- Bookmarks table
+CREATE TABLE IF NOT EXISTS bookmarks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    post_id INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(user_id, post_id),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+);
+
+-- Follows table
+CREATE TABLE IF NOT EXISTS follows (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    follower_id INTEGER NOT NULL,
+    following_id INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(follower_id, following_id),
+    FOREIGN KEY (follower_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (following_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Blocks table
+CREATE TABLE IF NOT EXISTS blocks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    blocker_id INTEGER NOT NULL,
+    blocked_id INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(blocker_id, blocked_id),
+    FOREIGN KEY (blocker_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (blocked_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Mutes table
+CREATE TABLE IF NOT EXISTS mutes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    muter_id INTEGER NOT NULL,
+    muted_id INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(muter_id, muted_id),
+    FOREIGN KEY (muter_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (muted_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Hashtags table
+CREATE TABLE IF NOT EXISTS hashtags (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tag TEXT UNIQUE NOT NULL COLLATE NOCASE,
+    post_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Post-Hashtag junction
+CREATE TABLE IF NOT EXISTS post_hashtags (
+    post_id INTEGER NOT NULL,
+    hashtag_id INTEGER NOT NULL,
+    PRIMARY KEY(post_id, hashtag_id),
+    FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
+    FOREIGN KEY (hashtag_id) REFERENCES hashtags(id) ON DELETE CASCADE
+);
+
+-- Notifications table
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    actor_id INTEGER,
+    type TEXT NOT NULL,
+    post_id INTEGER,
+    message TEXT DEFAULT '',
+    is_read INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (actor_id) REFERENCES users(id) ON DELETE SET NULL,
+    FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+);
+
+-- Direct messages table
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    is_group INTEGER DEFAULT 0,
+    name TEXT DEFAULT '',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS conversation_members (
+    conversation_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_read_at TIMESTAMP,
+    PRIMARY KEY(conversation_id, user_id),
+    FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id INTEGER NOT NULL,
+    sender_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    media TEXT DEFAULT '[]',
+    is_deleted INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE,
+    FOREIGN KEY (sender_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Community notes table
+CREATE TABLE IF NOT EXISTS community_notes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    content TEXT NOT NULL CHECK(length(content) <= 280),
+    sources TEXT NOT NULL DEFAULT '[]',
+    category TEXT NOT NULL DEFAULT 'missing_context',
+    status TEXT DEFAULT 'proposed',
+    helpful_count INTEGER DEFAULT 0,
+    not_helpful_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
+    FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS community_note_ratings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    note_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    rating TEXT NOT NULL CHECK(rating IN ('helpful', 'not_helpful')),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(note_id, user_id),
+    FOREIGN KEY (note_id) REFERENCES community_notes(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Staff notes table
+CREATE TABLE IF NOT EXISTS staff_notes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    note_type TEXT NOT NULL DEFAULT 'info',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
+    FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Announcements table
+CREATE TABLE IF NOT EXISTS announcements (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    author_id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    type TEXT NOT NULL DEFAULT 'banner',
+    is_active INTEGER DEFAULT 1,
+    target TEXT DEFAULT 'all',
+    publish_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS announcement_dismissals (
+    announcement_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    dismissed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY(announcement_id, user_id),
+    FOREIGN KEY (announcement_id) REFERENCES announcements(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Reports table
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    reporter_id INTEGER NOT NULL,
+    reported_user_id INTEGER,
+    reported_post_id INTEGER,
+    reason TEXT NOT NULL,
+    details TEXT DEFAULT '',
+    status TEXT DEFAULT 'pending',
+    resolved_by INTEGER,
+    resolved_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (reporter_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (reported_user_id) REFERENCES users(id) ON DELETE SET NULL,
+    FOREIGN KEY (reported_post_id) REFERENCES posts(id) ON DELETE SET NULL,
+    FOREIGN KEY (resolved_by) REFERENCES users(id) ON DELETE SET NULL
+);
+
+-- Audit log table
+CREATE TABLE IF NOT EXISTS audit_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    admin_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    target_type TEXT,
+    target_id INTEGER,
+    details TEXT DEFAULT '',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (admin_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Site settings table
+CREATE TABLE IF NOT EXISTS site_settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+-- Indexes
+-- Superseded by the composite indexes below
+DROP INDEX IF EXISTS idx_posts_user_id;
+DROP INDEX IF EXISTS idx_posts_created_at;
+DROP INDEX IF EXISTS idx_posts_active_created;
+DROP INDEX IF EXISTS idx_posts_timeline;
+DROP INDEX IF EXISTS idx_posts_created_id;
+DROP INDEX IF EXISTS idx_posts_parent_id;
+DROP INDEX IF EXISTS idx_reports_status;
+DROP INDEX IF EXISTS idx_messages_conversation;
+DROP INDEX IF EXISTS idx_messages_conv_created;
+DROP INDEX IF EXISTS idx_notifications_user;
+DROP INDEX IF EXISTS idx_posts_repost_id;
+DROP INDEX IF EXISTS idx_community_notes_post;
+-- Prefixes of the UNIQUE(follower_id, following_id) / UNIQUE(user_id, post_id) autoindexes
+DROP INDEX IF EXISTS idx_follows_follower;
+DROP INDEX IF EXISTS idx_likes_user_id;
+DROP INDEX IF EXISTS idx_bookmarks_user;
+CREATE INDEX IF NOT EXISTS idx_posts_user_time ON posts(user_id, is_deleted, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_posts_feed ON posts(created_at DESC, id DESC, user_id) WHERE is_deleted = 0;
+CREATE INDEX IF NOT EXISTS idx_posts_parent ON posts(parent_id, is_deleted);
+CREATE INDEX IF NOT EXISTS idx_posts_repost_user ON posts(repost_id, user_id);
+CREATE INDEX IF NOT EXISTS idx_likes_post_id ON likes(post_id);
+CREATE INDEX IF NOT EXISTS idx_likes_user_time ON likes(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_follows_following ON follows(following_id);
+CREATE INDEX IF NOT EXISTS idx_notifications_user_time ON notifications(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_unread ON notifications(user_id) WHERE is_read = 0;
+CREATE INDEX IF NOT EXISTS idx_messages_conv_recent ON messages(conversation_id, created_at DESC, id DESC, sender_id);
+CREATE INDEX IF NOT EXISTS idx_conversation_members_user ON conversation_members(user_id, conversation_id);
+CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id);
+CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at);
+CREATE INDEX IF NOT EXISTS idx_bookmarks_user_time ON bookmarks(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_bookmarks_post ON bookmarks(post_id);
+CREATE INDEX IF NOT EXISTS idx_community_notes_post_rank ON community_notes(post_id, status, helpful_count DESC);
+CREATE INDEX IF NOT EXISTS idx_staff_notes_post ON staff_notes(post_id);
+CREATE INDEX IF NOT EXISTS idx_reports_status_created ON reports(status, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_community_notes_status ON community_notes(status);
+CREATE INDEX IF NOT EXISTS idx_audit_log_created ON audit_log(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_hashtags_tag ON hashtags(tag);
+CREATE INDEX IF NOT EXISTS idx_post_hashtags_tag ON post_hashtags(hashtag_id, post_id);
+CREATE INDEX IF NOT EXISTS idx_announcements_active ON announcements(is_active, publish_at);
+
+-- Full-text search (trigram, so MATCH behaves like LIKE '%q%')
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+    username, display_name, email, bio,
+    content='users', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+    INSERT INTO users_fts(rowid, username, display_name, email, bio)
+    VALUES (new.id, new.username, new.display_name, new.email, new.bio);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+    INSERT INTO users_fts(users_fts, rowid, username, display_name, email, bio)
+    VALUES ('delete', old.id, old.username, old.display_name, old.email, old.bio);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, display_name, email, bio ON users BEGIN
+    INSERT INTO users_fts(users_fts, rowid, username, display_name, email, bio)
+    VALUES ('delete', old.id, old.username, old.display_name, old.email, old.bio);
+    INSERT INTO users_fts(rowid, username, display_name, email, bio)
+    VALUES (new.id, new.username, new.display_name, new.email, new.bio);
+END;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+    content,
+    content='posts', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS posts_fts_ai AFTER INSERT ON posts BEGIN
+    INSERT INTO posts_fts(rowid, content) VALUES (new.id, new.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_fts_ad AFTER DELETE ON posts BEGIN
+    INSERT INTO posts_fts(posts_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_fts_au AFTER UPDATE OF content ON posts BEGIN
+    INSERT INTO posts_fts(posts_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    INSERT INTO posts_fts(rowid, content) VALUES (new.id, new.content);
+END;
+
+-- Backfill rows written before the search tables existed
+INSERT INTO users_fts(users_fts) VALUES ('rebuild');
+INSERT INTO posts_fts(posts_fts) VALUES ('rebuild');
+
+COMMIT;
+'''
+
+# Stamped into PRAGMA user_version once the schema has been applied. It is
+# derived from the DDL itself, so any schema change re-runs init_db().
+SCHEMA_VERSION = zlib.crc32(SCHEMA_SQL.encode()) & 0x7FFFFFFF
+
+
+def fts_phrase(text):
+    """Quote ``text`` as an FTS5 phrase for the trigram search tables.
+
+    Returns None when the text is shorter than one trigram; callers fall
+    back to LIKE for those.
+    """
+    if len(text) < 3:
+        return None
+    return '"' + text.replace('"', '""') + '"'
+
+
+def like_prefix(text):
+    """Escape ``text`` as a prefix pattern for ``LIKE ? ESCAPE '\\'``.
+
+    On a COLLATE NOCASE column this is an index range scan, unlike the
+    leading-wildcard ``LIKE '%q%'``.
+    """
+    text = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return text + '%'
 
 
 def init_db():
     """Initialize the database with schema."""
-    db = get_db()
+    db = get_db_write()
     cursor = db.cursor()
-
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL COLLATE NOCASE,
-            email TEXT UNIQUE NOT NULL COLLATE NOCASE,
-            password_hash TEXT NOT NULL,
-            display_name TEXT NOT NULL DEFAULT '',
-            bio TEXT DEFAULT '' CHECK(length(bio) <= 280),
-            location TEXT DEFAULT '',
-            website TEXT DEFAULT '',
-            profile_pic TEXT DEFAULT '',
-            banner_pic TEXT DEFAULT '',
-            is_verified INTEGER DEFAULT 0,
-            is_corp_verified INTEGER DEFAULT 0,
-            affiliated_with INTEGER,
-            is_admin INTEGER DEFAULT 0,
-            is_moderator INTEGER DEFAULT 0,
-            is_private INTEGER DEFAULT 0,
-            is_suspended INTEGER DEFAULT 0,
-            suspended_until TEXT,
-            suspend_reason TEXT DEFAULT '',
-            email_verified INTEGER DEFAULT 0,
-            totp_secret TEXT,
-            theme TEXT DEFAULT 'auto',
-            accent_color TEXT DEFAULT '#6750A4',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Sessions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sessions (
-            id TEXT PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            ip_address TEXT,
-            user_agent TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            expires_at TIMESTAMP NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Posts table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            content TEXT NOT NULL CHECK(length(content) <= 500),
-            parent_id INTEGER,
-            repost_id INTEGER,
-            quote_id INTEGER,
-            is_edited INTEGER DEFAULT 0,
-            edit_history TEXT DEFAULT '[]',
-            edited_at TIMESTAMP,
-            is_pinned INTEGER DEFAULT 0,
-            is_deleted INTEGER DEFAULT 0,
-            media TEXT DEFAULT '[]',
-            poll_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (parent_id) REFERENCES posts(id) ON DELETE SET NULL,
-            FOREIGN KEY (repost_id) REFERENCES posts(id) ON DELETE SET NULL,
-            FOREIGN KEY (quote_id) REFERENCES posts(id) ON DELETE SET NULL
-        )
-    ''')
-
-    # Polls table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS polls (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            post_id INTEGER NOT NULL,
-            options TEXT NOT NULL DEFAULT '[]',
-            expires_at TIMESTAMP NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Poll votes table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS poll_votes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            poll_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            option_index INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(poll_id, user_id),
-            FOREIGN KEY (poll_id) REFERENCES polls(id) ON DELETE CASCADE,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Likes table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS likes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            post_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(user_id, post_id),
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Bookmarks table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS bookmarks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            post_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(user_id, post_id),
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Follows table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS follows (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            follower_id INTEGER NOT NULL,
-            following_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(follower_id, following_id),
-            FOREIGN KEY (follower_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (following_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Blocks table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS blocks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            blocker_id INTEGER NOT NULL,
-            blocked_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(blocker_id, blocked_id),
-            FOREIGN KEY (blocker_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (blocked_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Mutes table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS mutes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            muter_id INTEGER NOT NULL,
-            muted_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(muter_id, muted_id),
-            FOREIGN KEY (muter_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (muted_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Hashtags table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS hashtags (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            tag TEXT UNIQUE NOT NULL COLLATE NOCASE,
-            post_count INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Post-Hashtag junction
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS post_hashtags (
-            post_id INTEGER NOT NULL,
-            hashtag_id INTEGER NOT NULL,
-            PRIMARY KEY(post_id, hashtag_id),
-            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
-            FOREIGN KEY (hashtag_id) REFERENCES hashtags(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Notifications table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS notifications (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            actor_id INTEGER,
-            type TEXT NOT NULL,
-            post_id INTEGER,
-            message TEXT DEFAULT '',
-            is_read INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (actor_id) REFERENCES users(id) ON DELETE SET NULL,
-            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Direct messages table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            is_group INTEGER DEFAULT 0,
-            name TEXT DEFAULT '',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversation_members (
-            conversation_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_read_at TIMESTAMP,
-            PRIMARY KEY(conversation_id, user_id),
-            FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            conversation_id INTEGER NOT NULL,
-            sender_id INTEGER NOT NULL,
-            content TEXT NOT NULL,
-            media TEXT DEFAULT '[]',
-            is_deleted INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE,
-            FOREIGN KEY (sender_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Community notes table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS community_notes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            post_id INTEGER NOT NULL,
-            author_id INTEGER NOT NULL,
-            content TEXT NOT NULL CHECK(length(content) <= 280),
-            sources TEXT NOT NULL DEFAULT '[]',
-            category TEXT NOT NULL DEFAULT 'missing_context',
-            status TEXT DEFAULT 'proposed',
-            helpful_count INTEGER DEFAULT 0,
-            not_helpful_count INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
-            FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS community_note_ratings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            note_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            rating TEXT NOT NULL CHECK(rating IN ('helpful', 'not_helpful')),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(note_id, user_id),
-            FOREIGN KEY (note_id) REFERENCES community_notes(id) ON DELETE CASCADE,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Staff notes table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS staff_notes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            post_id INTEGER NOT NULL,
-            author_id INTEGER NOT NULL,
-            content TEXT NOT NULL,
-            note_type TEXT NOT NULL DEFAULT 'info',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
-            FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Announcements table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS announcements (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            author_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            content TEXT NOT NULL,
-            type TEXT NOT NULL DEFAULT 'banner',
-            is_active INTEGER DEFAULT 1,
-            target TEXT DEFAULT 'all',
-            publish_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            expires_at TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS announcement_dismissals (
-            announcement_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            dismissed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY(announcement_id, user_id),
-            FOREIGN KEY (announcement_id) REFERENCES announcements(id) ON DELETE CASCADE,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Reports table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS reports (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            reporter_id INTEGER NOT NULL,
-            reported_user_id INTEGER,
-            reported_post_id INTEGER,
-            reason TEXT NOT NULL,
-            details TEXT DEFAULT '',
-            status TEXT DEFAULT 'pending',
-            resolved_by INTEGER,
-            resolved_at TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (reporter_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (reported_user_id) REFERENCES users(id) ON DELETE SET NULL,
-            FOREIGN KEY (reported_post_id) REFERENCES posts(id) ON DELETE SET NULL,
-            FOREIGN KEY (resolved_by) REFERENCES users(id) ON DELETE SET NULL
-        )
-    ''')
-
-    # Audit log table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS audit_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            admin_id INTEGER NOT NULL,
-            action TEXT NOT NULL,
-            target_type TEXT,
-            target_id INTEGER,
-            details TEXT DEFAULT '',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (admin_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Site settings table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS site_settings (
-            key TEXT PRIMARY KEY,
-            value TEXT NOT NULL
-        )
-    ''')
-
-    # Create indexes
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_user_id ON posts(user_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_parent_id ON posts(parent_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts(created_at DESC)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_likes_post_id ON likes(post_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_likes_user_id ON likes(user_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_follows_follower ON follows(follower_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_follows_following ON follows(following_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id, is_read)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id, created_at)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bookmarks_user ON bookmarks(user_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_community_notes_post ON community_notes(post_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_staff_notes_post ON staff_notes(post_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reports_status ON reports(status)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_hashtags_tag ON hashtags(tag)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_announcements_active ON announcements(is_active, publish_at)')
+    cursor.executescript(SCHEMA_SQL)
 
     # Insert default site settings
     defaults = [
@@ -414,14 +742,29 @@ def init_db():
         ('posts_per_page', '20'),
         ('default_theme', 'auto'),
     ]
-    for key, value in defaults:
-        cursor.execute(
-            'INSERT OR IGNORE INTO site_settings (key, value) VALUES (?, ?)',
-            (key, value)
-        )
+    cursor.executemany(
+        'INSERT OR IGNORE INTO site_settings (key, value) VALUES (?, ?)',
+        defaults
+    )
+    db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    db.commit()
 
+    # Give the planner statistics for any new indexes. analysis_limit
+    # samples each index, so this stays quick on large databases.
+    db.execute('PRAGMA analysis_limit = 400')
+    db.execute('ANALYZE')
     db.commit()
     close_db(db)
+    settings_cache.invalidate()
+
+
+def ensure_db():
+    """Run init_db() unless the current schema is already in place."""
+    db = get_db_write()
+    current = db.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    close_db(db)
+    if not current:
+        init_db()
 
 
 if __name__ == '__main__':
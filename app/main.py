@@ -1,20 +1,101 @@
 import os
+import binascii
+import hmac
 import secrets
+import threading
+import time
 import json
 from datetime import datetime, timedelta
 from functools import wraps
 
 from flask import (
     Flask, g, request, session, redirect, url_for,
-    render_template, flash, jsonify, abort
+    render_template, flash, jsonify, abort, has_request_context
 )
+from flask.ctx import _AppCtxGlobals
+from flask.json.provider import DefaultJSONProvider
+from flask.sessions import SecureCookieSessionInterface
+import click
 from dotenv import load_dotenv
+from werkzeug.local import LocalProxy
+
+try:
+    import orjson
+except ImportError:  # optional; falls back to the stdlib encoder
+    orjson = None
 
 load_dotenv()
 
-from database import get_db, close_db, init_db
+from database import (
+    get_db, get_db_write, close_db, init_db, ensure_db, optimize_db, settings_cache
+)
+
+
+class AppGlobals(_AppCtxGlobals):
+    """``g`` with a lazily acquired ``g.db``.
+
+    The connection is only taken from the pool the first time a handler
+    touches ``g.db``, so redirects and other DB-free requests skip it.
+    Safe methods get the read-only connection; handlers that must write
+    during a GET ask for get_db_write().
+    """
+
+    def __getattr__(self, name):
+        if name != 'db':
+            return super().__getattr__(name)
+        if has_request_context() and request.method in ('GET', 'HEAD'):
+            self.db = get_db()
+        else:
+            self.db = get_db_write()
+        return self.db
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that encodes with orjson.
+
+    Responses are serialized straight to bytes in one pass, skipping the
+    stdlib encoder and the str -> bytes round trip. Keys are not sorted.
+    """
+
+    OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.OPTIONS).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.OPTIONS),
+            mimetype=self.mimetype,
+        )
+
+
+class LazyCookieSessionInterface(SecureCookieSessionInterface):
+    """Signed-cookie sessions that are only re-sent when needed.
+
+    Flask re-signs and re-sends a permanent session on every response to
+    slide its expiry. Here the cookie is re-issued only when the session
+    changed or a tenth of its lifetime has passed since it was last
+    issued, so active users still stay logged in.
+    """
+
+    def should_set_cookie(self, app, session):
+        now = int(time.time())
+        if not session.modified:
+            if not (session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']):
+                return False
+            refresh_after = app.permanent_session_lifetime.total_seconds() / 10
+            if now - session.get('_issued', 0) < refresh_after:
+                return False
+        session['_issued'] = now
+        return True
+
 
 app = Flask(__name__)
+app.app_ctx_globals_class = AppGlobals
+app.session_interface = LazyCookieSessionInterface()
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_VIDEO_SIZE', 104857600))
 app.config['SESSION_COOKIE_HTTPONLY'] = True
@@ -53,35 +134,79 @@ def admin_required(f):
     return decorated
 
 
-def get_site_settings():
-    """Load site settings from database."""
-    db = get_db()
-    rows = db.execute('SELECT key, value FROM site_settings').fetchall()
-    return {row['key']: row['value'] for row in rows}
+# CSRF tokens are sliced from a pooled block of random bytes so new
+# visitors don't each cost a getrandom() syscall.
+_csrf_buf = bytearray()
+_csrf_lock = threading.Lock()
+# Forked workers must never hand out the same bytes as their parent.
+os.register_at_fork(after_in_child=_csrf_buf.clear)
+
+
+def new_csrf():
+    """Return a fresh 64-character hex CSRF token."""
+    with _csrf_lock:
+        if len(_csrf_buf) < 32:
+            _csrf_buf.extend(os.urandom(4096))
+        raw = bytes(_csrf_buf[:32])
+        del _csrf_buf[:32]
+    return binascii.hexlify(raw).decode()
+
+
+def csrf_token():
+    """Return the session's CSRF token, creating it on first use.
+
+    Tokens are only minted when a page actually renders one, so redirects,
+    JSON responses and other form-less requests leave the session cookie
+    untouched.
+    """
+    token = session.get('csrf_token')
+    if token is None:
+        token = session['csrf_token'] = new_csrf()
+    return token
 
 
 # ── Before / After Request ──────────────────────────────────────────
 
+ASSET_PREFIXES = ('/static/', '/favicon')
+
+# The logged-in user and their unread notification count in one round
+# trip. sqlite3 keeps compiled statements in its per-connection cache, so
+# reusing the same SQL text skips re-parsing on pooled connections. The
+# badge shows "99+" past 99, so counting stops at 100 unread rows of
+# idx_notifications_unread however far behind the user is.
+USER_WITH_UNREAD_SQL = '''
+    SELECT u.*, corp.profile_pic as corp_profile_pic,
+           (SELECT COUNT(*) FROM (SELECT 1 FROM notifications n
+                                  WHERE n.user_id = u.id AND n.is_read = 0
+                                  LIMIT 100)) as unread_count
+    FROM users u
+    LEFT JOIN users corp ON u.affiliated_with = corp.id
+    WHERE u.id = ? AND u.is_suspended = 0
+'''
+
+
 @app.before_request
 def before_request():
-    g.db = get_db()
+    g.now = datetime.now()
     g.user = None
-    g.site_settings = get_site_settings()
+    g.unread_count = 0
+    g.site_settings = settings_cache.get()
+
+    # Asset requests never need the current user or a CSRF token. The
+    # defaults above are enough for the error pages if one is missing.
+    if request.endpoint == 'static' or request.path.startswith(ASSET_PREFIXES):
+        return
 
     user_id = session.get('user_id')
     if user_id:
-        g.user = g.db.execute('''
-            SELECT u.*, corp.profile_pic as corp_profile_pic
-            FROM users u
-            LEFT JOIN users corp ON u.affiliated_with = corp.id
-            WHERE u.id = ? AND u.is_suspended = 0
-        ''', (user_id,)).fetchone()
-        if g.user is None:
+        row = g.db.execute(USER_WITH_UNREAD_SQL, (user_id,)).fetchone()
+        if row is None:
             session.clear()
-
-    # CSRF token
-    if 'csrf_token' not in session:
-        session['csrf_token'] = secrets.token_hex(32)
+        else:
+            # Handlers and templates read many user fields per request; a
+            # plain dict gives hashed lookups instead of Row's name scan.
+            g.user = dict(row)
+            g.unread_count = g.user['unread_count']
 
     # CSRF validation for POST/PUT/DELETE
     if request.method in ('POST', 'PUT', 'DELETE'):
@@ -91,7 +216,8 @@ def before_request():
             token = request.form.get('csrf_token', '')
         # Skip CSRF for API routes with API key auth
         if not request.path.startswith('/api/v1/'):
-            if token != session.get('csrf_token'):
+            expected = session.get('csrf_token', '')
+            if not expected or not hmac.compare_digest(token.encode(), expected.encode()):
                 abort(403)
 
 
@@ -101,12 +227,17 @@ def teardown_db(exception):
     close_db(db)
 
 
+SECURITY_HEADERS = [
+    ('X-Content-Type-Options', 'nosniff'),
+    ('X-Frame-Options', 'DENY'),
+    ('X-XSS-Protection', '1; mode=block'),
+    ('Referrer-Policy', 'strict-origin-when-cross-origin'),
+]
+
+
 @app.after_request
 def security_headers(response):
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['X-XSS-Protection'] = '1; mode=block'
-    response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
+    response.headers.update(SECURITY_HEADERS)
     return response
 
 
@@ -114,20 +245,12 @@ def security_headers(response):
 
 @app.context_processor
 def inject_globals():
-    unread_count = 0
-    if g.user:
-        row = g.db.execute(
-            'SELECT COUNT(*) as c FROM notifications WHERE user_id = ? AND is_read = 0',
-            (g.user['id'],)
-        ).fetchone()
-        unread_count = row['c'] if row else 0
-
     return {
         'current_user': g.user,
         'site_settings': g.site_settings,
-        'unread_notifications': unread_count,
-        'csrf_token': session.get('csrf_token', ''),
-        'now': datetime.now(),
+        'unread_notifications': g.unread_count,
+        'csrf_token': LocalProxy(csrf_token),
+        'now': g.now,
     }
 
 
@@ -183,11 +306,46 @@ app.register_blueprint(notifications_bp)
 app.register_blueprint(api_bp)
 app.register_blueprint(setup_bp)
 
+# Compile the busiest pages, and the layout and macros they pull in, when
+# the worker starts rather than on its first requests. Jinja then serves
+# them from its cache; with TEMPLATES_AUTO_RELOAD left at its default,
+# source files are only re-checked in debug mode.
+WARM_TEMPLATES = (
+    'base.html', 'components/icons.html', 'components/badges.html',
+    'components/post_card.html', 'components/conversation_row.html',
+    'feed/home.html', 'posts/view.html', 'auth/profile.html',
+    'messages/inbox.html', 'messages/conversation.html', 'messages/new.html',
+    'notifications/index.html',
+)
+
+for name in WARM_TEMPLATES:
+    app.jinja_env.get_template(name)
+
 
 # ── Initialize Database ─────────────────────────────────────────────
 
-with app.app_context():
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the schema and default site settings."""
     init_db()
+    click.echo('Database initialized successfully.')
+
+
+@app.cli.command('db-optimize')
+def db_optimize_command():
+    """Refresh planner statistics and checkpoint the WAL.
+
+    Also runs automatically at process exit; schedule it from cron for
+    long-running deployments.
+    """
+    optimize_db()
+    click.echo('Database optimized.')
+
+
+# Only the first boot after a schema change pays for the DDL; every other
+# worker start is a single PRAGMA read.
+with app.app_context():
+    ensure_db()
 
 
 if __name__ == '__main__':
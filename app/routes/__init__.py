@@ -0,0 +1,204 @@
+"""Helpers shared by the route blueprints."""
+import base64
+import binascii
+import io
+import os
+import re
+import secrets
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+# Like/reply/repost counts for the posts in a CTE named ``page``. Each
+# count is aggregated once over just that page instead of a correlated
+# subquery per row.
+PAGE_COUNTS_SQL = '''
+    SELECT page.*,
+           COALESCE(lc.c, 0) as like_count,
+           COALESCE(rc.c, 0) as reply_count,
+           COALESCE(rpc.c, 0) as repost_count
+    FROM page
+    LEFT JOIN (SELECT post_id, COUNT(*) as c FROM likes
+               WHERE post_id IN (SELECT id FROM page)
+               GROUP BY post_id) lc ON lc.post_id = page.id
+    LEFT JOIN (SELECT parent_id, COUNT(*) as c FROM posts
+               WHERE parent_id IN (SELECT id FROM page) AND is_deleted = 0
+               GROUP BY parent_id) rc ON rc.parent_id = page.id
+    LEFT JOIN (SELECT repost_id, COUNT(*) as c FROM posts
+               WHERE repost_id IN (SELECT id FROM page)
+               GROUP BY repost_id) rpc ON rpc.repost_id = page.id
+'''
+
+
+def encode_cursor(created_at, row_id):
+    """Build an opaque keyset pagination cursor from a row's sort key."""
+    return base64.urlsafe_b64encode(f'{created_at}|{row_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(); raises ValueError on malformed input."""
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        return created_at, int(row_id)
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(str(e)) from e
+
+
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads')
+UPLOAD_BUFFER = 1024 * 1024  # copy uploads to disk in 1 MiB chunks
+# Linux can sendfile() between two regular files; elsewhere it needs a socket
+SENDFILE = sys.platform.startswith('linux')
+
+_upload_dirs = set()
+
+ALLOWED_IMAGE_EXT = frozenset({'png', 'jpg', 'jpeg', 'gif', 'webp'})
+
+
+def image_ext(filename):
+    """Lower-cased extension of an allowed image filename, else None."""
+    dot = filename.rfind('.')
+    ext = filename[dot + 1:].lower() if dot >= 0 else ''
+    return ext if ext in ALLOWED_IMAGE_EXT else None
+
+
+# The markup user text may keep; the same allow-list bleach.clean() used.
+ALLOWED_TAGS = frozenset({
+    'a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+    'em', 'i', 'li', 'ol', 'strong', 'ul',
+})
+ALLOWED_ATTRIBUTES = {
+    'a': frozenset({'href', 'title'}),
+    'abbr': frozenset({'title'}),
+    'acronym': frozenset({'title'}),
+}
+ALLOWED_PROTOCOLS = frozenset({'http', 'https', 'mailto'})
+
+# Characters nh3 would escape or drop; text without any is returned as is
+NEEDS_CLEANING_RE = re.compile('[<>&\0\r\xa0\ufeff]')
+
+
+_cleaner = None
+
+
+def clean(text):
+    """Sanitize user input down to ALLOWED_TAGS.
+
+    nh3 (ammonia) parses in native code and is thread-safe. Unlike
+    bleach it drops disallowed tags instead of escaping them, and
+    removes the contents of <script> and <style> too. Plain text, the
+    bulk of posts and messages, skips the parser entirely.
+    """
+    global _cleaner
+    if not NEEDS_CLEANING_RE.search(text):
+        return text
+    if _cleaner is None:
+        # Built on first use, so workers that only ever see plain text
+        # never load the sanitizer; nh3.clean() would rebuild the rules
+        # on every call
+        import nh3
+        _cleaner = nh3.Cleaner(tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES,
+                               url_schemes=ALLOWED_PROTOCOLS, link_rel=None)
+    return _cleaner.clean(text)
+
+
+def _spooled_fd(stream):
+    """File descriptor of an upload Werkzeug spooled to disk, else None.
+
+    Uploads under 500 KB stay in memory; asking a SpooledTemporaryFile
+    for its fileno() would force those onto disk, so they are skipped.
+    """
+    if not SENDFILE:
+        return None
+    if isinstance(stream, SpooledTemporaryFile) and not stream._rolled:
+        return None
+    try:
+        return stream.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+
+
+def store_upload(file, subfolder, ext):
+    """Write an uploaded file under uploads/<subfolder>/ and return its URL.
+
+    Uploads already spooled to a temp file are copied in the kernel with
+    sendfile(); in-memory ones go through FileStorage.save().
+    """
+    path = os.path.join(UPLOAD_DIR, subfolder)
+    if subfolder not in _upload_dirs:
+        os.makedirs(path, exist_ok=True)
+        _upload_dirs.add(subfolder)
+    filename = f'{secrets.token_hex(16)}.{ext}'
+    dest = os.path.join(path, filename)
+
+    src = _spooled_fd(file.stream)
+    if src is None:
+        file.save(dest, buffer_size=UPLOAD_BUFFER)
+    else:
+        file.stream.flush()
+        offset = file.stream.tell()
+        out = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            while sent := os.sendfile(out, src, offset, UPLOAD_BUFFER):
+                offset += sent
+        finally:
+            os.close(out)
+    return f'/uploads/{subfolder}/{filename}'
+
+
+# Argon2id parameters for new password hashes (memory cost in KiB).
+# Hashes made with other settings are upgraded on the next login.
+ARGON2_TIME_COST = int(os.environ.get('ARGON2_TIME_COST', 2))
+ARGON2_MEMORY_COST = int(os.environ.get('ARGON2_MEMORY_COST', 64 * 1024))
+ARGON2_PARALLELISM = int(os.environ.get('ARGON2_PARALLELISM', 2))
+
+_hasher = PasswordHasher(time_cost=ARGON2_TIME_COST,
+                         memory_cost=ARGON2_MEMORY_COST,
+                         parallelism=ARGON2_PARALLELISM)
+
+# Both hashers release the GIL, so hashes run on a shared pool sized to
+# the CPU count: a burst of sign-ups can't claim every request thread's
+# core at once, and other requests keep being served meanwhile.
+_hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                thread_name_prefix='password-hash')
+
+
+def hash_password(password):
+    """Return the Argon2id hash of ``password``."""
+    return _hash_pool.submit(_hasher.hash, password).result()
+
+
+# Stand-in hash checked when a login names no account, so unknown and
+# known usernames take the same time to reject.
+_DUMMY_HASH = _hasher.hash('chirp')
+
+
+def _verify(password, password_hash):
+    if password_hash.startswith('$argon2'):
+        try:
+            return _hasher.verify(password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    # Accounts created before the switch to Argon2 still hold bcrypt hashes
+    return bcrypt.checkpw(password.encode(), password_hash.encode())
+
+
+def check_password(password, password_hash):
+    """True if ``password`` matches the stored Argon2id or bcrypt hash.
+
+    ``password_hash`` may be None for a missing user; the check still
+    costs a full hash and returns False.
+    """
+    matched = _hash_pool.submit(
+        _verify, password, password_hash or _DUMMY_HASH
+    ).result()
+    return matched and password_hash is not None
+
+
+def needs_rehash(password_hash):
+    """True if the hash is bcrypt or uses outdated Argon2 parameters."""
+    return (not password_hash.startswith('$argon2')
+            or _hasher.check_needs_rehash(password_hash))
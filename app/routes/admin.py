@@ -1,14 +1,22 @@
 """Administration panel routes."""
 import json
-import bleach
-from datetime import datetime
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from flask import (
     Blueprint, request, redirect, url_for,
     render_template, flash, g, abort
 )
 
+from database import audit_writer, fts_phrase, like_prefix, settings_cache
+from routes import clean
+from routes.feed import active_announcements
+
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
+HEX_COLOR_RE = re.compile(r'#[0-9a-fA-F]{6}')
+
 
 def admin_required(f):
     """Require admin or moderator access."""
@@ -23,50 +31,62 @@ def admin_required(f):
     return decorated
 
 
-def audit_log(db, admin_id, action, target_type=None, target_id=None, details=''):
-    """Record admin action in audit log."""
-    db.execute(
-        'INSERT INTO audit_log (admin_id, action, target_type, target_id, details) VALUES (?, ?, ?, ?, ?)',
-        (admin_id, action, target_type, target_id, details)
-    )
+def commit_and_audit(db, admin_id, action, target_type=None, target_id=None, details=''):
+    """Commit the admin's change, then record it in the audit log.
+
+    The row is queued for the background writer only once the commit has
+    succeeded, so the log never shows an action that was rolled back.
+    """
+    db.commit()
+    audit_writer.log(admin_id, action, target_type, target_id, details)
 
 
 # ── Dashboard ────────────────────────────────────────────────────────
 
+# Every dashboard counter in one round trip; users and posts are each
+# scanned once with conditional sums.
+DASHBOARD_STATS_SQL = '''
+    SELECT u.total_users, u.new_users_today, u.suspended_users,
+           p.total_posts, p.posts_today,
+           (SELECT COUNT(*) FROM reports WHERE status = 'pending') as pending_reports,
+           (SELECT COUNT(*) FROM likes) as total_likes,
+           (SELECT COUNT(*) FROM announcements WHERE is_active = 1) as active_announcements,
+           (SELECT COUNT(*) FROM community_notes WHERE status = 'pending') as pending_notes
+    FROM (SELECT COUNT(*) as total_users,
+                 COALESCE(SUM(created_at > :since), 0) as new_users_today,
+                 COALESCE(SUM(is_suspended = 1), 0) as suspended_users
+          FROM users) u,
+         (SELECT COUNT(*) as total_posts,
+                 COALESCE(SUM(created_at > :since), 0) as posts_today
+          FROM posts WHERE is_deleted = 0) p
+'''
+
+
+DASHBOARD_TTL = 30  # seconds
+
+
+@lru_cache(maxsize=1)
+def _dashboard_stats(bucket):
+    """Dashboard counters, memoized per DASHBOARD_TTL time bucket."""
+    since = (datetime.now(timezone.utc) - timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
+    return dict(g.db.execute(DASHBOARD_STATS_SQL, {'since': since}).fetchone())
+
+
 @admin_bp.route('/')
 @admin_required
 def dashboard():
     db = g.db
-    stats = {
-        'total_users': db.execute('SELECT COUNT(*) as c FROM users').fetchone()['c'],
-        'total_posts': db.execute('SELECT COUNT(*) as c FROM posts WHERE is_deleted = 0').fetchone()['c'],
-        'posts_today': db.execute(
-            "SELECT COUNT(*) as c FROM posts WHERE created_at > datetime('now', '-24 hours') AND is_deleted = 0"
-        ).fetchone()['c'],
-        'pending_reports': db.execute(
-            "SELECT COUNT(*) as c FROM reports WHERE status = 'pending'"
-        ).fetchone()['c'],
-        'new_users_today': db.execute(
-            "SELECT COUNT(*) as c FROM users WHERE created_at > datetime('now', '-24 hours')"
-        ).fetchone()['c'],
-        'total_likes': db.execute('SELECT COUNT(*) as c FROM likes').fetchone()['c'],
-        'suspended_users': db.execute(
-            'SELECT COUNT(*) as c FROM users WHERE is_suspended = 1'
-        ).fetchone()['c'],
-        'active_announcements': db.execute(
-            'SELECT COUNT(*) as c FROM announcements WHERE is_active = 1'
-        ).fetchone()['c'],
-        'pending_notes': db.execute(
-            "SELECT COUNT(*) as c FROM community_notes WHERE status = 'pending'"
-        ).fetchone()['c'],
-    }
+    # The counters may be up to DASHBOARD_TTL old; ?fresh=1 recomputes them.
+    if request.args.get('fresh'):
+        _dashboard_stats.cache_clear()
+    stats = _dashboard_stats(int(time.time() // DASHBOARD_TTL))
 
     recent_users = db.execute(
-        'SELECT * FROM users ORDER BY created_at DESC LIMIT 10'
+        'SELECT id, username, email, created_at FROM users ORDER BY created_at DESC LIMIT 10'
     ).fetchall()
 
     recent_reports = db.execute('''
-        SELECT r.*, u.username as reporter_name
+        SELECT r.id, r.reason, u.username as reporter_name
         FROM reports r
         JOIN users u ON r.reporter_id = u.id
         WHERE r.status = 'pending'
@@ -79,6 +99,12 @@ def dashboard():
 
 # ── User Management ──────────────────────────────────────────────────
 
+# Only what the user list template shows (never password_hash or bio).
+USER_LIST_COLUMNS = '''id, username, display_name, profile_pic, created_at,
+    is_verified, is_corp_verified, affiliated_with,
+    is_admin, is_moderator, is_suspended'''
+
+
 @admin_bp.route('/users')
 @admin_required
 def users():
@@ -88,17 +114,35 @@ def users():
     per_page = 25
     offset = (page - 1) * per_page
 
+    # Page the users first, then count posts for just that page with one
+    # grouped join (served by idx_posts_user_time).
     if query:
-        users_list = db.execute('''
-            SELECT u.*, (SELECT COUNT(*) FROM posts WHERE user_id = u.id AND is_deleted = 0) as post_count
-            FROM users u
-            WHERE u.username LIKE ? OR u.email LIKE ? OR u.display_name LIKE ?
-            ORDER BY u.created_at DESC LIMIT ? OFFSET ?
-        ''', (f'%{query}%', f'%{query}%', f'%{query}%', per_page + 1, offset)).fetchall()
+        phrase = fts_phrase(query)
+        if phrase:
+            where = 'id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)'
+            params = ('{username email display_name}: ' + phrase,)
+        else:
+            # Too short for the trigram index: prefix-match the NOCASE
+            # unique indexes on username and email instead
+            where = "username LIKE ? ESCAPE '\\' OR email LIKE ? ESCAPE '\\'"
+            params = (like_prefix(query),) * 2
+        users_list = db.execute(f'''
+            SELECT u.*, COUNT(p.id) as post_count
+            FROM (SELECT {USER_LIST_COLUMNS} FROM users
+                  WHERE {where}
+                  ORDER BY created_at DESC LIMIT ? OFFSET ?) u
+            LEFT JOIN posts p ON p.user_id = u.id AND p.is_deleted = 0
+            GROUP BY u.id
+            ORDER BY u.created_at DESC
+        ''', params + (per_page + 1, offset)).fetchall()
     else:
-        users_list = db.execute('''
-            SELECT u.*, (SELECT COUNT(*) FROM posts WHERE user_id = u.id AND is_deleted = 0) as post_count
-            FROM users u ORDER BY u.created_at DESC LIMIT ? OFFSET ?
+        users_list = db.execute(f'''
+            SELECT u.*, COUNT(p.id) as post_count
+            FROM (SELECT {USER_LIST_COLUMNS} FROM users
+                  ORDER BY created_at DESC LIMIT ? OFFSET ?) u
+            LEFT JOIN posts p ON p.user_id = u.id AND p.is_deleted = 0
+            GROUP BY u.id
+            ORDER BY u.created_at DESC
         ''', (per_page + 1, offset)).fetchall()
 
     has_next = len(users_list) > per_page
@@ -129,6 +173,14 @@ def user_detail(user_id):
                            post_count=post_count, recent_posts=recent_posts)
 
 
+def _fetch_or_404(db, sql, params):
+    """Run a statement (usually UPDATE ... RETURNING) and 404 if no row comes back."""
+    row = db.execute(sql, params).fetchone()
+    if row is None:
+        abort(404)
+    return row
+
+
 @admin_bp.route('/users/<int:user_id>/action', methods=['POST'])
 @admin_required
 def user_action(user_id):
@@ -136,54 +188,69 @@ def user_action(user_id):
         abort(403)
 
     db = g.db
-    user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    if not user:
-        abort(404)
-
     action = request.form.get('action', '')
 
+    audited, details = None, ''
+
+    # Each action changes the row and reads back what the flash message
+    # needs in one statement, so toggles can't race a concurrent admin.
     if action == 'verify':
-        new_val = 0 if user['is_verified'] else 1
-        db.execute('UPDATE users SET is_verified = ? WHERE id = ?', (new_val, user_id))
-        audit_log(db, g.user['id'], 'toggle_verify', 'user', user_id)
-        flash(f"{'Verified' if new_val else 'Unverified'} @{user['username']}", 'success')
+        user = _fetch_or_404(db, '''
+            UPDATE users SET is_verified = NOT is_verified WHERE id = ?
+            RETURNING username, is_verified
+        ''', (user_id,))
+        audited = 'toggle_verify'
+        flash(f"{'Verified' if user['is_verified'] else 'Unverified'} @{user['username']}", 'success')
 
     elif action == 'corp_verify':
-        new_val = 0 if user['is_corp_verified'] else 1
-        db.execute('UPDATE users SET is_corp_verified = ?, is_verified = 1 WHERE id = ?', (new_val, user_id))
-        if not new_val:
+        user = _fetch_or_404(db, '''
+            UPDATE users SET is_corp_verified = NOT is_corp_verified, is_verified = 1
+            WHERE id = ? RETURNING username, is_corp_verified
+        ''', (user_id,))
+        if not user['is_corp_verified']:
             # Remove all affiliations when corp verification is revoked
             db.execute('UPDATE users SET affiliated_with = NULL WHERE affiliated_with = ?', (user_id,))
-        audit_log(db, g.user['id'], 'toggle_corp_verify', 'user', user_id)
-        flash(f"{'Granted' if new_val else 'Revoked'} corporation verification for @{user['username']}", 'success')
+        audited = 'toggle_corp_verify'
+        flash(f"{'Granted' if user['is_corp_verified'] else 'Revoked'} corporation verification for @{user['username']}", 'success')
 
     elif action == 'suspend':
-        reason = bleach.clean(request.form.get('reason', ''))
-        db.execute('UPDATE users SET is_suspended = 1, suspend_reason = ? WHERE id = ?',
-                   (reason, user_id))
-        audit_log(db, g.user['id'], 'suspend_user', 'user', user_id, reason)
+        reason = clean(request.form.get('reason', ''))
+        user = _fetch_or_404(db, '''
+            UPDATE users SET is_suspended = 1, suspend_reason = ? WHERE id = ?
+            RETURNING username
+        ''', (reason, user_id))
+        audited, details = 'suspend_user', reason
         flash(f"Suspended @{user['username']}", 'success')
 
     elif action == 'unsuspend':
-        db.execute('UPDATE users SET is_suspended = 0, suspend_reason = ? WHERE id = ?',
-                   ('', user_id))
-        audit_log(db, g.user['id'], 'unsuspend_user', 'user', user_id)
+        user = _fetch_or_404(db, '''
+            UPDATE users SET is_suspended = 0, suspend_reason = '' WHERE id = ?
+            RETURNING username
+        ''', (user_id,))
+        audited = 'unsuspend_user'
         flash(f"Unsuspended @{user['username']}", 'success')
 
     elif action == 'make_mod':
-        new_val = 0 if user['is_moderator'] else 1
-        db.execute('UPDATE users SET is_moderator = ? WHERE id = ?', (new_val, user_id))
-        audit_log(db, g.user['id'], 'toggle_moderator', 'user', user_id)
-        flash(f"{'Granted' if new_val else 'Revoked'} moderator for @{user['username']}", 'success')
+        user = _fetch_or_404(db, '''
+            UPDATE users SET is_moderator = NOT is_moderator WHERE id = ?
+            RETURNING username, is_moderator
+        ''', (user_id,))
+        audited = 'toggle_moderator'
+        flash(f"{'Granted' if user['is_moderator'] else 'Revoked'} moderator for @{user['username']}", 'success')
 
     elif action == 'delete':
-        db.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        audit_log(db, g.user['id'], 'delete_user', 'user', user_id)
+        user = _fetch_or_404(db, 'DELETE FROM users WHERE id = ? RETURNING username', (user_id,))
+        commit_and_audit(db, g.user['id'], 'delete_user', 'user', user_id)
         flash(f"Deleted @{user['username']}", 'success')
-        db.commit()
         return redirect(url_for('admin.users'))
 
-    db.commit()
+    else:
+        _fetch_or_404(db, 'SELECT id FROM users WHERE id = ?', (user_id,))
+
+    if audited:
+        commit_and_audit(db, g.user['id'], audited, 'user', user_id, details)
+    else:
+        db.commit()
     return redirect(url_for('admin.user_detail', user_id=user_id))
 
 
@@ -195,7 +262,7 @@ def reports():
     db = g.db
     status_filter = request.args.get('status', 'pending')
     reports_list = db.execute('''
-        SELECT r.*, 
+        SELECT r.id, r.reason, r.status, r.reported_post_id,
                reporter.username as reporter_name,
                reported_user.username as reported_username,
                p.content as post_content
@@ -219,20 +286,21 @@ def report_action(report_id):
         abort(404)
 
     action = request.form.get('action', '')
+    audited = None
 
     if action == 'resolve':
         db.execute(
             'UPDATE reports SET status = ?, resolved_by = ?, resolved_at = CURRENT_TIMESTAMP WHERE id = ?',
             ('resolved', g.user['id'], report_id)
         )
-        audit_log(db, g.user['id'], 'resolve_report', 'report', report_id)
+        audited = 'resolve_report'
 
     elif action == 'dismiss':
         db.execute(
             'UPDATE reports SET status = ?, resolved_by = ?, resolved_at = CURRENT_TIMESTAMP WHERE id = ?',
             ('dismissed', g.user['id'], report_id)
         )
-        audit_log(db, g.user['id'], 'dismiss_report', 'report', report_id)
+        audited = 'dismiss_report'
 
     elif action == 'delete_post':
         if report['reported_post_id']:
@@ -241,9 +309,12 @@ def report_action(report_id):
             'UPDATE reports SET status = ?, resolved_by = ?, resolved_at = CURRENT_TIMESTAMP WHERE id = ?',
             ('resolved', g.user['id'], report_id)
         )
-        audit_log(db, g.user['id'], 'delete_reported_post', 'report', report_id)
+        audited = 'delete_reported_post'
 
-    db.commit()
+    if audited:
+        commit_and_audit(db, g.user['id'], audited, 'report', report_id)
+    else:
+        db.commit()
     flash('Report handled.', 'success')
     return redirect(url_for('admin.reports'))
 
@@ -255,7 +326,8 @@ def report_action(report_id):
 def staff_notes():
     db = g.db
     notes = db.execute('''
-        SELECT sn.*, u.username as author_name, p.content as post_content
+        SELECT sn.post_id, sn.content, sn.note_type, sn.created_at,
+               u.username as author_name, p.content as post_content
         FROM staff_notes sn
         JOIN users u ON sn.author_id = u.id
         JOIN posts p ON sn.post_id = p.id
@@ -268,7 +340,7 @@ def staff_notes():
 @admin_required
 def add_staff_note(post_id):
     db = g.db
-    content = bleach.clean(request.form.get('content', '').strip())
+    content = clean(request.form.get('content', '').strip())
     note_type = request.form.get('note_type', 'info')
 
     valid_types = ['info', 'warning', 'misleading', 'investigation', 'violation']
@@ -283,8 +355,7 @@ def add_staff_note(post_id):
         'INSERT INTO staff_notes (post_id, author_id, content, note_type) VALUES (?, ?, ?, ?)',
         (post_id, g.user['id'], content, note_type)
     )
-    audit_log(db, g.user['id'], 'add_staff_note', 'post', post_id)
-    db.commit()
+    commit_and_audit(db, g.user['id'], 'add_staff_note', 'post', post_id)
 
     flash('Staff note added.', 'success')
     return redirect(url_for('posts.view_post', post_id=post_id))
@@ -297,7 +368,9 @@ def add_staff_note(post_id):
 def community_notes():
     db = g.db
     notes = db.execute('''
-        SELECT cn.*, u.username as author_name, p.content as post_content
+        SELECT cn.id, cn.content, cn.category, cn.status,
+               cn.helpful_count, cn.not_helpful_count,
+               u.username as author_name, p.content as post_content
         FROM community_notes cn
         JOIN users u ON cn.author_id = u.id
         JOIN posts p ON cn.post_id = p.id
@@ -319,8 +392,7 @@ def community_note_action(note_id):
     elif action == 'delete':
         db.execute('DELETE FROM community_notes WHERE id = ?', (note_id,))
 
-    audit_log(db, g.user['id'], f'community_note_{action}', 'community_note', note_id)
-    db.commit()
+    commit_and_audit(db, g.user['id'], f'community_note_{action}', 'community_note', note_id)
 
     flash('Community note updated.', 'success')
     return redirect(url_for('admin.community_notes'))
@@ -333,7 +405,8 @@ def community_note_action(note_id):
 def announcements():
     db = g.db
     announcements_list = db.execute('''
-        SELECT a.*, u.username as author_name
+        SELECT a.id, a.title, a.content, a.type, a.is_active, a.created_at,
+               u.username as author_name
         FROM announcements a
         JOIN users u ON a.author_id = u.id
         ORDER BY a.created_at DESC
@@ -345,8 +418,8 @@ def announcements():
 @admin_required
 def create_announcement():
     if request.method == 'POST':
-        title = bleach.clean(request.form.get('title', '').strip())
-        content = bleach.clean(request.form.get('content', '').strip())
+        title = clean(request.form.get('title', '').strip())
+        content = clean(request.form.get('content', '').strip())
         ann_type = request.form.get('type', 'banner')
         target = request.form.get('target', 'all')
 
@@ -360,8 +433,8 @@ def create_announcement():
                VALUES (?, ?, ?, ?, ?)''',
             (g.user['id'], title, content, ann_type, target)
         )
-        audit_log(db, g.user['id'], 'create_announcement', 'announcement', None, title)
-        db.commit()
+        commit_and_audit(db, g.user['id'], 'create_announcement', 'announcement', None, title)
+        active_announcements.cache_clear()
 
         flash('Announcement created!', 'success')
         return redirect(url_for('admin.announcements'))
@@ -373,14 +446,12 @@ def create_announcement():
 @admin_required
 def toggle_announcement(ann_id):
     db = g.db
-    ann = db.execute('SELECT * FROM announcements WHERE id = ?', (ann_id,)).fetchone()
-    if not ann:
-        abort(404)
-
-    new_val = 0 if ann['is_active'] else 1
-    db.execute('UPDATE announcements SET is_active = ? WHERE id = ?', (new_val, ann_id))
-    audit_log(db, g.user['id'], 'toggle_announcement', 'announcement', ann_id)
-    db.commit()
+    _fetch_or_404(db, '''
+        UPDATE announcements SET is_active = NOT is_active WHERE id = ?
+        RETURNING id
+    ''', (ann_id,))
+    commit_and_audit(db, g.user['id'], 'toggle_announcement', 'announcement', ann_id)
+    active_announcements.cache_clear()
 
     return redirect(url_for('admin.announcements'))
 
@@ -390,8 +461,8 @@ def toggle_announcement(ann_id):
 def delete_announcement(ann_id):
     db = g.db
     db.execute('DELETE FROM announcements WHERE id = ?', (ann_id,))
-    audit_log(db, g.user['id'], 'delete_announcement', 'announcement', ann_id)
-    db.commit()
+    commit_and_audit(db, g.user['id'], 'delete_announcement', 'announcement', ann_id)
+    active_announcements.cache_clear()
 
     flash('Announcement deleted.', 'success')
     return redirect(url_for('admin.announcements'))
@@ -408,17 +479,16 @@ def site_settings():
     db = g.db
 
     if request.method == 'POST':
-        import re as _re
         errors = []
         updates = {}
 
-        site_name = bleach.clean(request.form.get('site_name', '').strip())
+        site_name = clean(request.form.get('site_name', '').strip())
         if site_name:
             updates['site_name'] = site_name[:50]
         else:
             errors.append('Site name cannot be empty.')
 
-        updates['site_description'] = bleach.clean(
+        updates['site_description'] = clean(
             request.form.get('site_description', '').strip())[:200]
 
         mode = request.form.get('registration_mode', 'open')
@@ -427,13 +497,13 @@ def site_settings():
         else:
             errors.append('Invalid registration mode.')
 
-        updates['invite_code'] = bleach.clean(
+        updates['invite_code'] = clean(
             request.form.get('invite_code', '').strip())[:64]
         if updates.get('registration_mode') == 'invite' and not updates['invite_code']:
             errors.append('An invite code is required when registration is invite-only.')
 
         theme_color = request.form.get('theme_color', '').strip()
-        if _re.match(r'^#[0-9a-fA-F]{6}$', theme_color):
+        if HEX_COLOR_RE.fullmatch(theme_color):
             updates['theme_color'] = theme_color
         else:
             errors.append('Theme color must be a hex color like #6750A4.')
@@ -464,22 +534,16 @@ def site_settings():
             for e in errors:
                 flash(e, 'error')
         else:
-            for key, val in updates.items():
-                db.execute(
-                    'INSERT OR REPLACE INTO site_settings (key, value) VALUES (?, ?)',
-                    (key, val)
-                )
-            audit_log(db, g.user['id'], 'update_site_settings')
-            db.commit()
+            db.executemany(
+                'INSERT OR REPLACE INTO site_settings (key, value) VALUES (?, ?)',
+                updates.items()
+            )
+            commit_and_audit(db, g.user['id'], 'update_site_settings')
+            settings_cache.invalidate()
             flash('Settings saved!', 'success')
         return redirect(url_for('admin.site_settings'))
 
-    settings = {}
-    rows = db.execute('SELECT * FROM site_settings').fetchall()
-    for row in rows:
-        settings[row['key']] = row['value']
-
-    return render_template('admin/settings.html', settings=settings)
+    return render_template('admin/settings.html', settings=settings_cache.get())
 
 
 # ── Audit Log ────────────────────────────────────────────────────────
@@ -490,6 +554,7 @@ def audit_log_view():
     if not g.user['is_admin']:
         abort(403)
 
+    audit_writer.flush()
     db = g.db
     logs = db.execute('''
         SELECT al.*, u.username as admin_name
@@ -2,16 +2,78 @@
 import json
 import secrets
 import time
-from functools import wraps
+from collections import defaultdict, deque
+from functools import lru_cache, wraps
+
 from flask import (
     Blueprint, request, jsonify, g, abort
 )
 
+from cache import profile_counts, redis, redis_client
+from database import fts_phrase, like_prefix
+from routes import PAGE_COUNTS_SQL, clean, decode_cursor, encode_cursor
+
 api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
 
-# Simple in-memory rate limiter
-_rate_limits = {}
+# Rate limiting: a sliding window of RATE_LIMIT hits per RATE_WINDOW per
+# client. With REDIS_URL set the window lives in Redis and is shared by
+# every gunicorn worker; otherwise each process keeps its own.
 RATE_LIMIT = 60  # requests per minute
+RATE_WINDOW = 60  # seconds
+
+# Trim the window, then record the hit only if there is room. Runs
+# atomically inside Redis; returns 1 if the request is allowed.
+RATE_LIMIT_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1] - ARGV[2])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+_rate_script = None
+if redis_client is not None:
+    _rate_script = redis_client.register_script(RATE_LIMIT_LUA)
+
+# Per-process fallback: one bounded deque of hit times per client
+_rate_limits = defaultdict(lambda: deque(maxlen=RATE_LIMIT))
+_last_sweep = 0.0
+
+
+def _sweep_rate_limits(now):
+    """Forget clients that have been idle for a whole window."""
+    global _last_sweep
+    if now - _last_sweep < RATE_WINDOW:
+        return
+    _last_sweep = now
+    for key, hits in list(_rate_limits.items()):
+        if not hits or now - hits[-1] >= RATE_WINDOW:
+            _rate_limits.pop(key, None)
+
+
+def _allow_local(key):
+    """Record a hit in this process's window; False if over the limit."""
+    now = time.monotonic()
+    _sweep_rate_limits(now)
+
+    hits = _rate_limits[key]
+    while hits and now - hits[0] >= RATE_WINDOW:
+        hits.popleft()
+
+    if len(hits) >= RATE_LIMIT:
+        return False
+    hits.append(now)
+    return True
+
+
+def _allow_redis(key):
+    """Record a hit in the shared Redis window; False if over the limit."""
+    now = time.time()
+    member = f'{now}:{secrets.token_hex(4)}'
+    return bool(_rate_script(keys=[f'rl:{key}'],
+                             args=[now, RATE_WINDOW, RATE_LIMIT, member]))
 
 
 def rate_limit(f):
@@ -19,22 +81,55 @@ def rate_limit(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         key = request.remote_addr
-        now = time.time()
-
-        if key not in _rate_limits:
-            _rate_limits[key] = []
-
-        # Clean old entries
-        _rate_limits[key] = [t for t in _rate_limits[key] if now - t < 60]
-
-        if len(_rate_limits[key]) >= RATE_LIMIT:
+        if _rate_script is not None:
+            try:
+                allowed = _allow_redis(key)
+            except redis.RedisError:
+                # Fail open to the per-process window if Redis is down
+                allowed = _allow_local(key)
+        else:
+            allowed = _allow_local(key)
+
+        if not allowed:
             return jsonify({'error': 'Rate limit exceeded'}), 429
-
-        _rate_limits[key].append(now)
         return f(*args, **kwargs)
     return decorated
 
 
+# Hot queries are assembled once at import instead of per request; the
+# connection's statement cache then reuses their prepared statements.
+# The timeline's author set (followees plus the user) is built once and
+# drives one idx_posts_user_time range scan per author.
+TIMELINE_SQL = '''
+    WITH authors(user_id) AS MATERIALIZED (
+        SELECT following_id FROM follows WHERE follower_id = :user_id
+        UNION SELECT :user_id
+    ),
+    page AS MATERIALIZED (
+        SELECT p.id, p.content, p.media, p.created_at, p.is_edited,
+               u.username, u.display_name, u.profile_pic, u.is_verified
+        FROM authors a
+        JOIN posts p ON p.user_id = a.user_id
+        JOIN users u ON p.user_id = u.id
+        WHERE p.is_deleted = 0
+          AND (p.created_at, p.id) < (:before_created, :before_id)
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT :limit OFFSET :offset
+    )
+''' + PAGE_COUNTS_SQL + '''
+    ORDER BY page.created_at DESC, page.id DESC
+'''
+
+POST_SQL = '''
+    WITH page AS MATERIALIZED (
+        SELECT p.id, p.content, p.media, p.created_at, p.is_edited, p.parent_id,
+               u.username, u.display_name, u.profile_pic, u.is_verified
+        FROM posts p JOIN users u ON p.user_id = u.id
+        WHERE p.id = ? AND p.is_deleted = 0
+    )
+''' + PAGE_COUNTS_SQL
+
+
 def api_auth_required(f):
     """Require API authentication via session or API key."""
     @wraps(f)
@@ -54,26 +149,38 @@ def timeline():
     db = g.db
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 20, type=int), 100)
-    offset = (page - 1) * per_page
 
-    posts = db.execute('''
-        SELECT p.id, p.content, p.media, p.created_at, p.is_edited,
-               u.username, u.display_name, u.profile_pic, u.is_verified,
-               (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-               (SELECT COUNT(*) FROM posts r WHERE r.parent_id = p.id AND r.is_deleted = 0) as reply_count,
-               (SELECT COUNT(*) FROM posts rp WHERE rp.repost_id = p.id) as repost_count
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        WHERE p.is_deleted = 0
-          AND (p.user_id = ? OR p.user_id IN (SELECT following_id FROM follows WHERE follower_id = ?))
-        ORDER BY p.created_at DESC
-        LIMIT ? OFFSET ?
-    ''', (g.user['id'], g.user['id'], per_page, offset)).fetchall()
+    # Keyset pagination: a cursor resumes strictly after the last post of
+    # the previous page, so deep pages cost the same as the first one.
+    # Plain ?page= still works for older clients.
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            before_created, before_id = decode_cursor(cursor)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        offset = 0
+    else:
+        before_created, before_id = '9999-12-31', 2 ** 63 - 1
+        offset = (max(page, 1) - 1) * per_page
+
+    posts = db.execute(TIMELINE_SQL, {
+        'user_id': g.user['id'],
+        'before_created': before_created,
+        'before_id': before_id,
+        'limit': per_page,
+        'offset': offset,
+    }).fetchall()
+
+    next_cursor = None
+    if len(posts) == per_page:
+        next_cursor = encode_cursor(posts[-1]['created_at'], posts[-1]['id'])
 
     return jsonify({
         'posts': [dict(p) for p in posts],
         'page': page,
-        'per_page': per_page
+        'per_page': per_page,
+        'next_cursor': next_cursor,
     })
 
 
@@ -83,15 +190,7 @@ def timeline():
 @rate_limit
 def get_post(post_id):
     db = g.db
-    post = db.execute('''
-        SELECT p.id, p.content, p.media, p.created_at, p.is_edited, p.parent_id,
-               u.username, u.display_name, u.profile_pic, u.is_verified,
-               (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-               (SELECT COUNT(*) FROM posts r WHERE r.parent_id = p.id AND r.is_deleted = 0) as reply_count,
-               (SELECT COUNT(*) FROM posts rp WHERE rp.repost_id = p.id) as repost_count
-        FROM posts p JOIN users u ON p.user_id = u.id
-        WHERE p.id = ? AND p.is_deleted = 0
-    ''', (post_id,)).fetchone()
+    post = db.execute(POST_SQL, (post_id,)).fetchone()
 
     if not post:
         return jsonify({'error': 'Post not found'}), 404
@@ -113,16 +212,16 @@ def create_post():
     if len(content) > 500:
         return jsonify({'error': 'Content exceeds 500 characters'}), 400
 
-    import bleach
-    content = bleach.clean(content)
+    content = clean(content)
 
     db = g.db
-    db.execute(
+    cur = db.execute(
         'INSERT INTO posts (user_id, content) VALUES (?, ?)',
         (g.user['id'], content)
     )
     db.commit()
-    post_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+    profile_counts.invalidate(g.user['id'])
+    post_id = cur.lastrowid
 
     return jsonify({'id': post_id, 'content': content}), 201
 
@@ -134,23 +233,19 @@ def create_post():
 @api_auth_required
 def api_like(post_id):
     db = g.db
-    existing = db.execute(
-        'SELECT id FROM likes WHERE user_id = ? AND post_id = ?',
-        (g.user['id'], post_id)
-    ).fetchone()
-
-    if existing:
-        db.execute('DELETE FROM likes WHERE id = ?', (existing['id'],))
-        liked = False
-    else:
-        db.execute('INSERT INTO likes (user_id, post_id) VALUES (?, ?)',
-                   (g.user['id'], post_id))
-        liked = True
-    db.commit()
-
+    params = (g.user['id'], post_id)
+    # Toggle in place: the UNIQUE(user_id, post_id) constraint makes a
+    # duplicate insert from a double-click a no-op.
+    liked = db.execute(
+        'DELETE FROM likes WHERE user_id = ? AND post_id = ? RETURNING 1', params
+    ).fetchone() is None
+    if liked:
+        db.execute('INSERT OR IGNORE INTO likes (user_id, post_id) VALUES (?, ?)',
+                   params)
     count = db.execute(
         'SELECT COUNT(*) as c FROM likes WHERE post_id = ?', (post_id,)
     ).fetchone()['c']
+    db.commit()
 
     return jsonify({'liked': liked, 'count': count})
 
@@ -162,23 +257,17 @@ def api_like(post_id):
 def get_user(username):
     db = g.db
     user = db.execute('''
-        SELECT id, username, display_name, bio, location, website,
-               profile_pic, banner_pic, is_verified, created_at
-        FROM users WHERE username = ? AND is_suspended = 0
+        SELECT u.id, u.username, u.display_name, u.bio, u.location, u.website,
+               u.profile_pic, u.banner_pic, u.is_verified, u.created_at,
+               (SELECT COUNT(*) FROM follows WHERE following_id = u.id) as follower_count,
+               (SELECT COUNT(*) FROM follows WHERE follower_id = u.id) as following_count
+        FROM users u WHERE u.username = ? AND u.is_suspended = 0
     ''', (username,)).fetchone()
 
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
-    user_dict = dict(user)
-    user_dict['follower_count'] = db.execute(
-        'SELECT COUNT(*) as c FROM follows WHERE following_id = ?', (user['id'],)
-    ).fetchone()['c']
-    user_dict['following_count'] = db.execute(
-        'SELECT COUNT(*) as c FROM follows WHERE follower_id = ?', (user['id'],)
-    ).fetchone()['c']
-
-    return jsonify(user_dict)
+    return jsonify(dict(user))
 
 
 # ── Search ───────────────────────────────────────────────────────────
@@ -193,31 +282,45 @@ def api_search():
         return jsonify({'results': []})
 
     db = g.db
+    phrase = fts_phrase(query)
 
     if search_type == 'users':
-        results = db.execute('''
+        if phrase:
+            where = 'id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)'
+            params = ('{username display_name}: ' + phrase,)
+        else:
+            # Too short for the trigram index: match username prefixes only
+            where = "username LIKE ? ESCAPE '\\'"
+            params = (like_prefix(query),)
+        results = db.execute(f'''
             SELECT id, username, display_name, bio, profile_pic, is_verified
-            FROM users WHERE (username LIKE ? OR display_name LIKE ?) AND is_suspended = 0
+            FROM users WHERE {where} AND is_suspended = 0
             LIMIT 20
-        ''', (f'%{query}%', f'%{query}%')).fetchall()
+        ''', params).fetchall()
     else:
+        # One- and two-character post searches would scan every post
+        if not phrase:
+            return jsonify({'results': []})
         results = db.execute('''
             SELECT p.id, p.content, p.created_at, u.username, u.display_name
             FROM posts p JOIN users u ON p.user_id = u.id
-            WHERE p.content LIKE ? AND p.is_deleted = 0
+            WHERE p.id IN (SELECT rowid FROM posts_fts WHERE posts_fts MATCH ?)
+              AND p.is_deleted = 0
             ORDER BY p.created_at DESC LIMIT 20
-        ''', (f'%{query}%',)).fetchall()
+        ''', (phrase,)).fetchall()
 
     return jsonify({'results': [dict(r) for r in results]})
 
 
 # ── Trending ─────────────────────────────────────────────────────────
 
-@api_bp.route('/trending')
-@rate_limit
-def trending():
-    db = g.db
-    tags = db.execute('''
+TRENDING_TTL = 60  # seconds
+
+
+@lru_cache(maxsize=1)
+def _trending_tags(bucket):
+    """7-day hashtag counts, memoized per TRENDING_TTL time bucket."""
+    tags = g.db.execute('''
         SELECT h.tag, COUNT(ph.post_id) as count
         FROM hashtags h
         JOIN post_hashtags ph ON h.id = ph.hashtag_id
@@ -226,5 +329,11 @@ def trending():
         GROUP BY h.id
         ORDER BY count DESC LIMIT 10
     ''').fetchall()
+    return [dict(t) for t in tags]
+
 
-    return jsonify({'trending': [dict(t) for t in tags]})
+@api_bp.route('/trending')
+@rate_limit
+def trending():
+    tags = _trending_tags(int(time.time() // TRENDING_TTL))
+    return jsonify({'trending': tags})
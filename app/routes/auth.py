@@ -2,40 +2,31 @@
 import os
 import re
 import secrets
-import uuid
 from datetime import datetime, timedelta
 
-import bcrypt
-import bleach
 from flask import (
     Blueprint, request, session, redirect, url_for,
     render_template, flash, g, abort, jsonify, current_app
 )
 from werkzeug.utils import secure_filename
 
-auth_bp = Blueprint('auth', __name__)
-
-ALLOWED_IMAGE_EXT = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads')
+from cache import profile_counts
+from routes import (
+    PAGE_COUNTS_SQL, check_password, clean, hash_password, image_ext, needs_rehash,
+    store_upload
+)
 
+auth_bp = Blueprint('auth', __name__)
 
-def allowed_image(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_IMAGE_EXT
+USERNAME_RE = re.compile(r'[A-Za-z0-9_]{3,30}')
 
 
 def save_upload(file, subfolder='avatars'):
     """Save an uploaded file and return its path."""
-    if not file or not file.filename:
-        return None
-    if not allowed_image(file.filename):
+    ext = image_ext(file.filename) if file and file.filename else None
+    if ext is None:
         return None
-    ext = file.filename.rsplit('.', 1)[1].lower()
-    filename = f"{uuid.uuid4().hex}.{ext}"
-    path = os.path.join(UPLOAD_DIR, subfolder)
-    os.makedirs(path, exist_ok=True)
-    filepath = os.path.join(path, filename)
-    file.save(filepath)
-    return f"/uploads/{subfolder}/{filename}"
+    return store_upload(file, subfolder, ext)
 
 
 # ── Registration ─────────────────────────────────────────────────────
@@ -52,11 +43,11 @@ def register():
         return redirect(url_for('auth.login'))
 
     if request.method == 'POST':
-        username = bleach.clean(request.form.get('username', '').strip())
+        username = clean(request.form.get('username', '').strip())
         email = request.form.get('email', '').strip().lower()
         password = request.form.get('password', '')
         confirm = request.form.get('confirm_password', '')
-        display_name = bleach.clean(request.form.get('display_name', '').strip())
+        display_name = clean(request.form.get('display_name', '').strip())
 
         errors = []
 
@@ -65,10 +56,8 @@ def register():
             supplied = request.form.get('invite_code', '').strip()
             if not expected or not secrets.compare_digest(supplied, expected):
                 errors.append('A valid invite code is required to register.')
-        if not username or len(username) < 3 or len(username) > 30:
-            errors.append('Username must be 3-30 characters.')
-        if not re.match(r'^[a-zA-Z0-9_]+$', username):
-            errors.append('Username can only contain letters, numbers, and underscores.')
+        if not USERNAME_RE.fullmatch(username):
+            errors.append('Username must be 3-30 letters, numbers, or underscores.')
         if not email or '@' not in email:
             errors.append('Valid email is required.')
         if len(password) < 8:
@@ -79,7 +68,7 @@ def register():
         if not errors:
             db = g.db
             existing = db.execute(
-                'SELECT id FROM users WHERE username = ? OR email = ?',
+                'SELECT 1 FROM users WHERE username = ? OR email = ? LIMIT 1',
                 (username, email)
             ).fetchone()
             if existing:
@@ -92,19 +81,18 @@ def register():
                                    username=username, email=email,
                                    display_name=display_name)
 
-        password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+        password_hash = hash_password(password)
         if not display_name:
             display_name = username
 
         db = g.db
-        db.execute(
+        user = db.execute(
             '''INSERT INTO users (username, email, password_hash, display_name)
-               VALUES (?, ?, ?, ?)''',
+               VALUES (?, ?, ?, ?) RETURNING id''',
             (username, email, password_hash, display_name)
-        )
+        ).fetchone()
         db.commit()
 
-        user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
         session['user_id'] = user['id']
         session.permanent = True
         flash('Welcome to Chirp! 🐦', 'success')
@@ -130,11 +118,16 @@ def login():
             (login_id, login_id.lower())
         ).fetchone()
 
-        if user and bcrypt.checkpw(password.encode(), user['password_hash'].encode()):
+        if check_password(password, user['password_hash'] if user else None):
             if user['is_suspended']:
                 flash('Your account has been suspended.', 'error')
                 return render_template('auth/login.html')
 
+            if needs_rehash(user['password_hash']):
+                db.execute('UPDATE users SET password_hash = ? WHERE id = ?',
+                           (hash_password(password), user['id']))
+                db.commit()
+
             session['user_id'] = user['id']
             session.permanent = True
 
@@ -156,91 +149,73 @@ def logout():
     return redirect(url_for('auth.login'))
 
 
+PROFILE_COUNTS_SQL = '''
+    SELECT (SELECT COUNT(*) FROM posts
+            WHERE user_id = :user_id AND is_deleted = 0
+              AND parent_id IS NULL AND repost_id IS NULL) as post_count,
+           (SELECT COUNT(*) FROM follows WHERE following_id = :user_id) as follower_count,
+           (SELECT COUNT(*) FROM follows WHERE follower_id = :user_id) as following_count
+'''
+
+PROFILE_POSTS_SQL = '''
+    WITH page AS MATERIALIZED (
+        SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
+               u.is_corp_verified, u.affiliated_with,
+               corp.profile_pic as corp_profile_pic,
+               l_me.id IS NOT NULL as is_liked,
+               b_me.id IS NOT NULL as is_bookmarked
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        LEFT JOIN users corp ON u.affiliated_with = corp.id
+        LEFT JOIN likes l_me ON l_me.post_id = p.id AND l_me.user_id = :viewer_id
+        LEFT JOIN bookmarks b_me ON b_me.post_id = p.id AND b_me.user_id = :viewer_id
+        WHERE p.user_id = :user_id AND p.is_deleted = 0
+        ORDER BY p.is_pinned DESC, p.created_at DESC
+        LIMIT 50
+    )
+''' + PAGE_COUNTS_SQL + '''
+    ORDER BY page.is_pinned DESC, page.created_at DESC
+'''
+
+
 # ── Profile ──────────────────────────────────────────────────────────
 
 @auth_bp.route('/user/<username>')
 def profile(username):
     db = g.db
+    viewer_id = g.user['id'] if g.user else None
     user = db.execute('''
-        SELECT u.*, corp.profile_pic as corp_profile_pic
+        SELECT u.*, corp.profile_pic as corp_profile_pic,
+               EXISTS(SELECT 1 FROM follows
+                      WHERE follower_id = :viewer_id AND following_id = u.id) as is_following
         FROM users u
         LEFT JOIN users corp ON u.affiliated_with = corp.id
-        WHERE u.username = ?
-    ''', (username,)).fetchone()
+        WHERE u.username = :username
+    ''', {'viewer_id': viewer_id, 'username': username}).fetchone()
     if not user:
         abort(404)
 
-    # Get counts
-    post_count = db.execute(
-        'SELECT COUNT(*) as c FROM posts WHERE user_id = ? AND is_deleted = 0 AND parent_id IS NULL AND repost_id IS NULL',
-        (user['id'],)
-    ).fetchone()['c']
-
-    follower_count = db.execute(
-        'SELECT COUNT(*) as c FROM follows WHERE following_id = ?',
-        (user['id'],)
-    ).fetchone()['c']
-
-    following_count = db.execute(
-        'SELECT COUNT(*) as c FROM follows WHERE follower_id = ?',
-        (user['id'],)
-    ).fetchone()['c']
-
-    # Check if current user follows this user
-    is_following = False
-    is_own_profile = False
-    if g.user:
-        is_own_profile = g.user['id'] == user['id']
-        if not is_own_profile:
-            f = db.execute(
-                'SELECT id FROM follows WHERE follower_id = ? AND following_id = ?',
-                (g.user['id'], user['id'])
-            ).fetchone()
-            is_following = f is not None
+    # Get counts (cached briefly; follow/block/post handlers invalidate)
+    counts = profile_counts.get(user['id'], lambda: dict(
+        db.execute(PROFILE_COUNTS_SQL, {'user_id': user['id']}).fetchone()))
 
-    # Get user's posts
-    posts = db.execute('''
-        SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
-               u.is_corp_verified, u.affiliated_with,
-               corp.profile_pic as corp_profile_pic,
-               (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-               (SELECT COUNT(*) FROM posts WHERE parent_id = p.id AND is_deleted = 0) as reply_count,
-               (SELECT COUNT(*) FROM posts WHERE repost_id = p.id) as repost_count
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        LEFT JOIN users corp ON u.affiliated_with = corp.id
-        WHERE p.user_id = ? AND p.is_deleted = 0
-        ORDER BY p.is_pinned DESC, p.created_at DESC
-        LIMIT 50
-    ''', (user['id'],)).fetchall()
-
-    # Enrich posts with current user's interactions
-    enriched_posts = []
-    for post in posts:
-        post_dict = dict(post)
-        if g.user:
-            liked = db.execute(
-                'SELECT id FROM likes WHERE user_id = ? AND post_id = ?',
-                (g.user['id'], post['id'])
-            ).fetchone()
-            post_dict['is_liked'] = liked is not None
-            bookmarked = db.execute(
-                'SELECT id FROM bookmarks WHERE user_id = ? AND post_id = ?',
-                (g.user['id'], post['id'])
-            ).fetchone()
-            post_dict['is_bookmarked'] = bookmarked is not None
-        else:
-            post_dict['is_liked'] = False
-            post_dict['is_bookmarked'] = False
-        enriched_posts.append(post_dict)
+    is_own_profile = viewer_id == user['id']
+
+    # Get user's posts, flagged with the viewer's likes and bookmarks.
+    # A NULL viewer id (logged out) matches nothing in either join. The
+    # rows go to the template as-is; nothing here needs to mutate them.
+    posts = db.execute(PROFILE_POSTS_SQL, {
+        'viewer_id': viewer_id,
+        'user_id': user['id'],
+    }).fetchall()
 
     return render_template('auth/profile.html',
                            profile_user=user,
-                           posts=enriched_posts,
-                           post_count=post_count,
-                           follower_count=follower_count,
-                           following_count=following_count,
-                           is_following=is_following,
+                           posts=posts,
+                           post_count=counts['post_count'],
+                           follower_count=counts['follower_count'],
+                           following_count=counts['following_count'],
+                           is_following=bool(user['is_following']),
                            is_own_profile=is_own_profile)
 
 
@@ -252,10 +227,10 @@ def edit_profile():
         return redirect(url_for('auth.login'))
 
     if request.method == 'POST':
-        display_name = bleach.clean(request.form.get('display_name', '').strip())
-        bio = bleach.clean(request.form.get('bio', '').strip())[:280]
-        location = bleach.clean(request.form.get('location', '').strip())
-        website = bleach.clean(request.form.get('website', '').strip())
+        display_name = clean(request.form.get('display_name', '').strip())
+        bio = clean(request.form.get('bio', '').strip())[:280]
+        location = clean(request.form.get('location', '').strip())
+        website = clean(request.form.get('website', '').strip())
 
         db = g.db
         updates = {
@@ -323,14 +298,14 @@ def settings():
             new_pass = request.form.get('new_password', '')
             confirm = request.form.get('confirm_password', '')
 
-            if not bcrypt.checkpw(current.encode(), g.user['password_hash'].encode()):
+            if not check_password(current, g.user['password_hash']):
                 flash('Current password is incorrect.', 'error')
             elif len(new_pass) < 8:
                 flash('New password must be at least 8 characters.', 'error')
             elif new_pass != confirm:
                 flash('New passwords do not match.', 'error')
             else:
-                new_hash = bcrypt.hashpw(new_pass.encode(), bcrypt.gensalt()).decode()
+                new_hash = hash_password(new_pass)
                 db.execute('UPDATE users SET password_hash = ? WHERE id = ?',
                            (new_hash, g.user['id']))
                 db.commit()
@@ -351,39 +326,42 @@ def follow(user_id):
         abort(400)
 
     db = g.db
-    target = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    me = g.user['id']
+    target = db.execute('''
+        SELECT username,
+               EXISTS(SELECT 1 FROM blocks
+                      WHERE (blocker_id = :me AND blocked_id = :them)
+                         OR (blocker_id = :them AND blocked_id = :me)) as blocked
+        FROM users WHERE id = :them
+    ''', {'me': me, 'them': user_id}).fetchone()
     if not target:
         abort(404)
 
-    # Check if blocked
-    blocked = db.execute(
-        'SELECT id FROM blocks WHERE (blocker_id = ? AND blocked_id = ?) OR (blocker_id = ? AND blocked_id = ?)',
-        (g.user['id'], user_id, user_id, g.user['id'])
-    ).fetchone()
-    if blocked:
+    if target['blocked']:
         flash('Unable to follow this user.', 'error')
         return redirect(url_for('auth.profile', username=target['username']))
 
-    existing = db.execute(
-        'SELECT id FROM follows WHERE follower_id = ? AND following_id = ?',
-        (g.user['id'], user_id)
+    # Toggle in place, then commit the follow and its notification as
+    # one transaction.
+    unfollowed = db.execute(
+        'DELETE FROM follows WHERE follower_id = ? AND following_id = ? RETURNING 1',
+        (me, user_id)
     ).fetchone()
 
-    if existing:
-        db.execute('DELETE FROM follows WHERE follower_id = ? AND following_id = ?',
-                    (g.user['id'], user_id))
+    if unfollowed:
         db.commit()
         flash(f'Unfollowed @{target["username"]}', 'info')
     else:
-        db.execute('INSERT INTO follows (follower_id, following_id) VALUES (?, ?)',
-                    (g.user['id'], user_id))
+        db.execute('INSERT OR IGNORE INTO follows (follower_id, following_id) VALUES (?, ?)',
+                    (me, user_id))
         # Create notification
         db.execute(
             'INSERT INTO notifications (user_id, actor_id, type) VALUES (?, ?, ?)',
-            (user_id, g.user['id'], 'follow')
+            (user_id, me, 'follow')
         )
         db.commit()
         flash(f'Following @{target["username"]}!', 'success')
+    profile_counts.invalidate(g.user['id'], user_id)
 
     return redirect(url_for('auth.profile', username=target['username']))
 
@@ -396,21 +374,19 @@ def block_user(user_id):
         abort(400)
 
     db = g.db
-    existing = db.execute(
-        'SELECT id FROM blocks WHERE blocker_id = ? AND blocked_id = ?',
+    unblocked = db.execute(
+        'DELETE FROM blocks WHERE blocker_id = ? AND blocked_id = ? RETURNING 1',
         (g.user['id'], user_id)
     ).fetchone()
 
-    if existing:
-        db.execute('DELETE FROM blocks WHERE blocker_id = ? AND blocked_id = ?',
-                    (g.user['id'], user_id))
-    else:
-        db.execute('INSERT INTO blocks (blocker_id, blocked_id) VALUES (?, ?)',
+    if not unblocked:
+        db.execute('INSERT OR IGNORE INTO blocks (blocker_id, blocked_id) VALUES (?, ?)',
                     (g.user['id'], user_id))
         # Remove any follows between users
-        db.execute('DELETE FROM follows WHERE (follower_id = ? AND following_id = ?) OR (follower_id = ? AND following_id = ?)',
-                    (g.user['id'], user_id, user_id, g.user['id']))
+        db.execute('DELETE FROM follows WHERE (follower_id = :me AND following_id = :them) OR (follower_id = :them AND following_id = :me)',
+                    {'me': g.user['id'], 'them': user_id})
     db.commit()
+    profile_counts.invalidate(g.user['id'], user_id)
 
     return redirect(request.referrer or url_for('feed.home'))
 
@@ -421,16 +397,13 @@ def mute_user(user_id):
         abort(400)
 
     db = g.db
-    existing = db.execute(
-        'SELECT id FROM mutes WHERE muter_id = ? AND muted_id = ?',
+    unmuted = db.execute(
+        'DELETE FROM mutes WHERE muter_id = ? AND muted_id = ? RETURNING 1',
         (g.user['id'], user_id)
     ).fetchone()
 
-    if existing:
-        db.execute('DELETE FROM mutes WHERE muter_id = ? AND muted_id = ?',
-                    (g.user['id'], user_id))
-    else:
-        db.execute('INSERT INTO mutes (muter_id, muted_id) VALUES (?, ?)',
+    if not unmuted:
+        db.execute('INSERT OR IGNORE INTO mutes (muter_id, muted_id) VALUES (?, ?)',
                     (g.user['id'], user_id))
     db.commit()
 
@@ -1,46 +1,185 @@
 """Feed and discovery routes - home timeline, explore, search, trending."""
 import json
+import time
+from functools import lru_cache
+
 from flask import (
     Blueprint, request, redirect, url_for,
     render_template, flash, g, abort
 )
 
-from routes.posts import enrich_post
+from database import fts_phrase, like_prefix
+from routes import PAGE_COUNTS_SQL
+from routes.posts import enrich_posts
 
 feed_bp = Blueprint('feed', __name__)
 
+# Post list queries are assembled once at import rather than per request,
+# so each pooled connection prepares them once.
+# The author set (followees plus the user, minus anyone muted or blocked)
+# is built once; each author is then an idx_posts_user_time range scan.
+HOME_FEED_SQL = '''
+    WITH authors(user_id) AS MATERIALIZED (
+        SELECT a.user_id FROM (
+            SELECT following_id as user_id FROM follows WHERE follower_id = :user_id
+            UNION SELECT :user_id
+        ) a
+        WHERE NOT EXISTS (SELECT 1 FROM mutes
+                          WHERE muter_id = :user_id AND muted_id = a.user_id)
+          AND NOT EXISTS (SELECT 1 FROM blocks
+                          WHERE blocker_id = :user_id AND blocked_id = a.user_id)
+    ),
+    page AS MATERIALIZED (
+        SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
+               u.is_corp_verified, u.affiliated_with,
+               corp.profile_pic as corp_profile_pic
+        FROM authors a
+        JOIN posts p ON p.user_id = a.user_id
+        JOIN users u ON p.user_id = u.id
+        LEFT JOIN users corp ON u.affiliated_with = corp.id
+        WHERE p.is_deleted = 0
+        ORDER BY p.created_at DESC
+        LIMIT :limit OFFSET :offset
+    )
+''' + PAGE_COUNTS_SQL + '''
+    ORDER BY page.created_at DESC
+'''
+
 
-def get_feed_posts(db, user, page=1, per_page=20):
-    """Get home timeline posts for a user (from people they follow + own)."""
-    offset = (page - 1) * per_page
-    posts = db.execute('''
+TRENDING_POSTS_SQL = '''
+    WITH page AS MATERIALIZED (
         SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
                u.is_corp_verified, u.affiliated_with,
-               corp.profile_pic as corp_profile_pic,
-               (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-               (SELECT COUNT(*) FROM posts r WHERE r.parent_id = p.id AND r.is_deleted = 0) as reply_count,
-               (SELECT COUNT(*) FROM posts rp WHERE rp.repost_id = p.id) as repost_count
+               corp.profile_pic as corp_profile_pic
         FROM posts p
         JOIN users u ON p.user_id = u.id
         LEFT JOIN users corp ON u.affiliated_with = corp.id
-        LEFT JOIN mutes m ON m.muter_id = ? AND m.muted_id = p.user_id
-        LEFT JOIN blocks b ON b.blocker_id = ? AND b.blocked_id = p.user_id
         WHERE p.is_deleted = 0
-          AND m.muter_id IS NULL
-          AND b.blocker_id IS NULL
-          AND (
-            p.user_id = ?
-            OR p.user_id IN (SELECT following_id FROM follows WHERE follower_id = ?)
-          )
+          AND p.parent_id IS NULL
+          AND p.created_at > datetime('now', '-24 hours')
+    )
+''' + PAGE_COUNTS_SQL + '''
+    ORDER BY like_count DESC
+    LIMIT 20
+'''
+
+TRENDING_TAGS_SQL = '''
+    SELECT h.tag, COUNT(ph.post_id) as recent_count
+    FROM hashtags h
+    JOIN post_hashtags ph ON h.id = ph.hashtag_id
+    JOIN posts p ON ph.post_id = p.id
+    WHERE p.created_at > datetime('now', '-7 days')
+      AND p.is_deleted = 0
+    GROUP BY h.id
+    ORDER BY recent_count DESC
+    LIMIT 10
+'''
+
+# Who-to-follow cards only need the fields the card and badges render
+SUGGESTIONS_SQL = '''
+    SELECT u.id, u.username, u.display_name, u.profile_pic, u.is_verified,
+           u.is_corp_verified, u.affiliated_with,
+           (SELECT COUNT(*) FROM follows WHERE following_id = u.id) as follower_count
+    FROM users u
+    WHERE u.id != :user_id
+      AND NOT EXISTS (SELECT 1 FROM follows
+                      WHERE follower_id = :user_id AND following_id = u.id)
+      AND u.is_suspended = 0
+    ORDER BY follower_count DESC
+    LIMIT 5
+'''
+
+ACTIVE_ANNOUNCEMENTS_SQL = '''
+    SELECT * FROM announcements
+    WHERE is_active = 1
+      AND (expires_at IS NULL OR expires_at > datetime('now'))
+      AND publish_at <= datetime('now')
+    ORDER BY created_at DESC LIMIT 10
+'''
+
+
+SEARCH_POSTS_SQL = '''
+    WITH page AS MATERIALIZED (
+        SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
+               u.is_corp_verified, u.affiliated_with,
+               corp.profile_pic as corp_profile_pic
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        LEFT JOIN users corp ON u.affiliated_with = corp.id
+        WHERE p.id IN (SELECT rowid FROM posts_fts WHERE posts_fts MATCH ?)
+          AND p.is_deleted = 0
         ORDER BY p.created_at DESC
-        LIMIT ? OFFSET ?
-    ''', (user['id'], user['id'], user['id'], user['id'], per_page, offset)).fetchall()
+        LIMIT 50
+    )
+''' + PAGE_COUNTS_SQL + '''
+    ORDER BY page.created_at DESC
+'''
+
+
+HASHTAG_POSTS_SQL = '''
+    WITH page AS MATERIALIZED (
+        SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
+               u.is_corp_verified, u.affiliated_with,
+               corp.profile_pic as corp_profile_pic
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        LEFT JOIN users corp ON u.affiliated_with = corp.id
+        JOIN post_hashtags ph ON p.id = ph.post_id
+        JOIN hashtags h ON ph.hashtag_id = h.id
+        WHERE h.tag = ? AND p.is_deleted = 0
+        ORDER BY p.created_at DESC
+        LIMIT 50
+    )
+''' + PAGE_COUNTS_SQL + '''
+    ORDER BY page.created_at DESC
+'''
+
+
+BOOKMARKS_SQL = '''
+    WITH page AS MATERIALIZED (
+        SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
+               u.is_corp_verified, u.affiliated_with,
+               corp.profile_pic as corp_profile_pic,
+               b.created_at as bookmarked_at
+        FROM bookmarks b
+        JOIN posts p ON b.post_id = p.id
+        JOIN users u ON p.user_id = u.id
+        LEFT JOIN users corp ON u.affiliated_with = corp.id
+        WHERE b.user_id = ? AND p.is_deleted = 0
+        ORDER BY b.created_at DESC
+        LIMIT 50
+    )
+''' + PAGE_COUNTS_SQL + '''
+    ORDER BY page.bookmarked_at DESC
+'''
+
+
+def get_feed_posts(db, user, page=1, per_page=20):
+    """Get home timeline posts for a user (from people they follow + own)."""
+    offset = (page - 1) * per_page
+    posts = db.execute(HOME_FEED_SQL, {
+        'user_id': user['id'],
+        'limit': per_page,
+        'offset': offset,
+    }).fetchall()
 
-    return [enrich_post(p, db, user) for p in posts]
+    return enrich_posts(posts, db, user)
 
 
 # ── Home Timeline ────────────────────────────────────────────────────
 
+ANNOUNCEMENTS_TTL = 30  # seconds
+
+
+@lru_cache(maxsize=1)
+def active_announcements(bucket):
+    """Live announcements, memoized per ANNOUNCEMENTS_TTL bucket.
+
+    Admin handlers call cache_clear() after changing announcements.
+    """
+    return [dict(a) for a in g.db.execute(ACTIVE_ANNOUNCEMENTS_SQL)]
+
+
 @feed_bp.route('/home')
 def home():
     if not g.user:
@@ -54,17 +193,16 @@ def home():
         per_page = 20
     posts = get_feed_posts(db, g.user, page, per_page)
 
-    # Get active announcements
-    announcements = db.execute('''
-        SELECT a.* FROM announcements a
-        LEFT JOIN announcement_dismissals ad
-            ON a.id = ad.announcement_id AND ad.user_id = ?
-        WHERE a.is_active = 1
-          AND ad.announcement_id IS NULL
-          AND (a.expires_at IS NULL OR a.expires_at > datetime('now'))
-          AND a.publish_at <= datetime('now')
-        ORDER BY a.created_at DESC LIMIT 3
-    ''', (g.user['id'],)).fetchall()
+    # Active announcements are shared; only this user's dismissals are
+    # looked up per request.
+    announcements = active_announcements(int(time.time() // ANNOUNCEMENTS_TTL))
+    if announcements:
+        ids = [a['id'] for a in announcements]
+        dismissed = {row[0] for row in db.execute(
+            f'''SELECT announcement_id FROM announcement_dismissals
+                WHERE user_id = ? AND announcement_id IN ({','.join('?' * len(ids))})''',
+            (g.user['id'], *ids))}
+        announcements = [a for a in announcements if a['id'] not in dismissed][:3]
 
     return render_template('feed/home.html', posts=posts, page=page,
                            announcements=announcements)
@@ -72,55 +210,35 @@ def home():
 
 # ── Explore ──────────────────────────────────────────────────────────
 
+TRENDING_TTL = 60  # seconds
+
+
+@lru_cache(maxsize=1)
+def _trending(bucket):
+    """Trending tags (7 days) and posts (24 hours), memoized per TRENDING_TTL bucket.
+
+    Both are the same for every viewer; per-viewer flags are added by
+    enrich_posts() on each request.
+    """
+    db = g.db
+    tags = [dict(t) for t in db.execute(TRENDING_TAGS_SQL)]
+    posts = [dict(p) for p in db.execute(TRENDING_POSTS_SQL)]
+    return tags, posts
+
+
 @feed_bp.route('/explore')
 def explore():
     db = g.db
 
-    # Trending hashtags (last 7 days)
-    trending_tags = db.execute('''
-        SELECT h.tag, COUNT(ph.post_id) as recent_count
-        FROM hashtags h
-        JOIN post_hashtags ph ON h.id = ph.hashtag_id
-        JOIN posts p ON ph.post_id = p.id
-        WHERE p.created_at > datetime('now', '-7 days')
-          AND p.is_deleted = 0
-        GROUP BY h.id
-        ORDER BY recent_count DESC
-        LIMIT 10
-    ''').fetchall()
+    # Trending hashtags (last 7 days) and posts (most liked in last 24h)
+    trending_tags, trending_posts = _trending(int(time.time() // TRENDING_TTL))
 
-    # Trending posts (most liked in last 24h)
-    trending_posts = db.execute('''
-        SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
-               u.is_corp_verified, u.affiliated_with,
-               corp.profile_pic as corp_profile_pic,
-               (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-               (SELECT COUNT(*) FROM posts r WHERE r.parent_id = p.id AND r.is_deleted = 0) as reply_count,
-               (SELECT COUNT(*) FROM posts rp WHERE rp.repost_id = p.id) as repost_count
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        LEFT JOIN users corp ON u.affiliated_with = corp.id
-        WHERE p.is_deleted = 0
-          AND p.parent_id IS NULL
-          AND p.created_at > datetime('now', '-24 hours')
-        ORDER BY like_count DESC
-        LIMIT 20
-    ''').fetchall()
-
-    enriched = [enrich_post(p, db, g.user) for p in trending_posts]
+    enriched = enrich_posts(trending_posts, db, g.user)
 
     # Who to follow suggestions
     suggestions = []
     if g.user:
-        suggestions = db.execute('''
-            SELECT u.*, (SELECT COUNT(*) FROM follows WHERE following_id = u.id) as follower_count
-            FROM users u
-            WHERE u.id != ?
-              AND u.id NOT IN (SELECT following_id FROM follows WHERE follower_id = ?)
-              AND u.is_suspended = 0
-            ORDER BY follower_count DESC
-            LIMIT 5
-        ''', (g.user['id'], g.user['id'])).fetchall()
+        suggestions = db.execute(SUGGESTIONS_SQL, {'user_id': g.user['id']}).fetchall()
 
     return render_template('feed/explore.html',
                            trending_tags=trending_tags,
@@ -141,44 +259,42 @@ def search():
     db = g.db
     results = []
 
+    phrase = fts_phrase(query)
+
     if search_type == 'users':
-        results = db.execute('''
+        if phrase:
+            where = 'u.id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)'
+            params = ('{username display_name}: ' + phrase,)
+        else:
+            # Too short for the trigram index: match username prefixes only
+            where = "u.username LIKE ? ESCAPE '\\'"
+            params = (like_prefix(query),)
+        results = db.execute(f'''
             SELECT u.*, (SELECT COUNT(*) FROM follows WHERE following_id = u.id) as follower_count
             FROM users u
-            WHERE (u.username LIKE ? OR u.display_name LIKE ?)
+            WHERE {where}
               AND u.is_suspended = 0
             ORDER BY follower_count DESC
             LIMIT 50
-        ''', (f'%{query}%', f'%{query}%')).fetchall()
+        ''', params).fetchall()
 
     elif search_type == 'hashtags':
+        # Substring match: there is one row per distinct tag, so the scan
+        # is cheap. Each matching tag's uses are counted from
+        # idx_post_hashtags_tag
         results = db.execute('''
-            SELECT h.*, COUNT(ph.post_id) as recent_count
+            SELECT h.*,
+                   (SELECT COUNT(*) FROM post_hashtags ph
+                    WHERE ph.hashtag_id = h.id) as recent_count
             FROM hashtags h
-            LEFT JOIN post_hashtags ph ON h.id = ph.hashtag_id
-            WHERE h.tag LIKE ?
-            GROUP BY h.id
+            WHERE h.tag LIKE ? ESCAPE '\\'
             ORDER BY recent_count DESC
             LIMIT 50
-        ''', (f'%{query}%',)).fetchall()
+        ''', ('%' + like_prefix(query),)).fetchall()
 
-    else:  # posts
-        results = db.execute('''
-            SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
-                   u.is_corp_verified, u.affiliated_with,
-                   corp.profile_pic as corp_profile_pic,
-                   (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                   (SELECT COUNT(*) FROM posts r WHERE r.parent_id = p.id AND r.is_deleted = 0) as reply_count,
-                   (SELECT COUNT(*) FROM posts rp WHERE rp.repost_id = p.id) as repost_count
-            FROM posts p
-            JOIN users u ON p.user_id = u.id
-            LEFT JOIN users corp ON u.affiliated_with = corp.id
-            WHERE p.content LIKE ?
-              AND p.is_deleted = 0
-            ORDER BY p.created_at DESC
-            LIMIT 50
-        ''', (f'%{query}%',)).fetchall()
-        results = [enrich_post(p, db, g.user) for p in results]
+    elif phrase:  # posts; shorter queries would scan every post
+        results = db.execute(SEARCH_POSTS_SQL, (phrase,)).fetchall()
+        results = enrich_posts(results, db, g.user)
 
     return render_template('feed/search.html', results=results, query=query,
                            search_type=search_type)
@@ -189,24 +305,9 @@ def search():
 @feed_bp.route('/hashtag/<tag>')
 def hashtag(tag):
     db = g.db
-    posts = db.execute('''
-        SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
-               u.is_corp_verified, u.affiliated_with,
-               corp.profile_pic as corp_profile_pic,
-               (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-               (SELECT COUNT(*) FROM posts r WHERE r.parent_id = p.id AND r.is_deleted = 0) as reply_count,
-               (SELECT COUNT(*) FROM posts rp WHERE rp.repost_id = p.id) as repost_count
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        LEFT JOIN users corp ON u.affiliated_with = corp.id
-        JOIN post_hashtags ph ON p.id = ph.post_id
-        JOIN hashtags h ON ph.hashtag_id = h.id
-        WHERE h.tag = ? AND p.is_deleted = 0
-        ORDER BY p.created_at DESC
-        LIMIT 50
-    ''', (tag,)).fetchall()
+    posts = db.execute(HASHTAG_POSTS_SQL, (tag,)).fetchall()
 
-    enriched = [enrich_post(p, db, g.user) for p in posts]
+    enriched = enrich_posts(posts, db, g.user)
     return render_template('feed/hashtag.html', tag=tag, posts=enriched)
 
 
@@ -218,23 +319,9 @@ def bookmarks():
         return redirect(url_for('auth.login'))
 
     db = g.db
-    posts = db.execute('''
-        SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
-               u.is_corp_verified, u.affiliated_with,
-               corp.profile_pic as corp_profile_pic,
-               (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-               (SELECT COUNT(*) FROM posts r WHERE r.parent_id = p.id AND r.is_deleted = 0) as reply_count,
-               (SELECT COUNT(*) FROM posts rp WHERE rp.repost_id = p.id) as repost_count
-        FROM bookmarks b
-        JOIN posts p ON b.post_id = p.id
-        JOIN users u ON p.user_id = u.id
-        LEFT JOIN users corp ON u.affiliated_with = corp.id
-        WHERE b.user_id = ? AND p.is_deleted = 0
-        ORDER BY b.created_at DESC
-        LIMIT 50
-    ''', (g.user['id'],)).fetchall()
+    posts = db.execute(BOOKMARKS_SQL, (g.user['id'],)).fetchall()
 
-    enriched = [enrich_post(p, db, g.user) for p in posts]
+    enriched = enrich_posts(posts, db, g.user)
     return render_template('feed/bookmarks.html', posts=enriched)
 
 
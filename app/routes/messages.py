@@ -1,13 +1,188 @@
 """Direct messaging routes."""
 import json
-import bleach
+import threading
+from collections import OrderedDict, defaultdict
+
 from flask import (
     Blueprint, request, redirect, url_for,
-    render_template, flash, g, abort, jsonify
+    render_template, flash, g, abort, jsonify, current_app
 )
 
+from database import get_db_write
+from routes import clean, decode_cursor, encode_cursor
+
 messages_bp = Blueprint('messages', __name__, url_prefix='/messages')
 
+# The user's conversations with their newest message and unread count.
+# Each conversation costs two lookups on idx_messages_conv_recent: the
+# newest message id is the first entry of its range, and the unread
+# count is covered by the index. A window function or grouped CTE over
+# the same rows makes SQLite build a temporary index per inbox load.
+# Ties on created_at break on id, which the index also orders by.
+INBOX_SQL = '''
+    SELECT c.*, cm.last_read_at,
+           lm.content as last_message,
+           lm.created_at as last_message_at,
+           (SELECT COUNT(*) FROM messages m
+            WHERE m.conversation_id = c.id
+              AND m.created_at > COALESCE(cm.last_read_at, '1970-01-01')
+              AND m.sender_id != :user_id) as unread_count
+    FROM conversation_members cm
+    JOIN conversations c ON c.id = cm.conversation_id
+    LEFT JOIN messages lm ON lm.id = (
+        SELECT id FROM messages
+        WHERE conversation_id = c.id
+        ORDER BY created_at DESC, id DESC LIMIT 1
+    )
+    WHERE cm.user_id = :user_id
+    ORDER BY last_message_at DESC
+'''
+
+# The other members of every conversation the user belongs to, fetched
+# in one round trip and grouped by conversation_id in Python.
+INBOX_MEMBERS_SQL = '''
+    SELECT cm.conversation_id, u.id, u.username, u.display_name, u.profile_pic,
+           u.is_verified, u.is_corp_verified, u.affiliated_with,
+           corp.profile_pic as corp_profile_pic
+    FROM conversation_members cm
+    JOIN users u ON cm.user_id = u.id
+    LEFT JOIN users corp ON u.affiliated_with = corp.id
+    WHERE cm.conversation_id IN (
+        SELECT conversation_id FROM conversation_members WHERE user_id = :user_id
+    )
+      AND cm.user_id != :user_id
+'''
+
+SEND_MESSAGE_SQL = '''
+    INSERT INTO messages (conversation_id, sender_id, content)
+    SELECT :conv_id, :user_id, :content
+    WHERE EXISTS (SELECT 1 FROM conversation_members
+                  WHERE conversation_id = :conv_id AND user_id = :user_id)
+'''
+
+NOTIFY_MEMBERS_SQL = '''
+    INSERT INTO notifications (user_id, actor_id, type, message)
+    SELECT user_id, :user_id, 'message', 'sent you a message'
+    FROM conversation_members
+    WHERE conversation_id = :conv_id AND user_id != :user_id
+'''
+
+
+class ConversationView:
+    """An inbox row with its members and rendered HTML attached.
+
+    Reads fall through to the underlying sqlite3.Row, so templates see
+    the same fields without the row being copied into a dict.
+    """
+
+    __slots__ = ('row', 'members', 'html')
+
+    def __init__(self, row, members):
+        self.row = row
+        self.members = members
+        self.html = None
+
+    def __getitem__(self, key):
+        return self.row[key]
+
+
+# Rendered inbox rows, keyed on everything a row displays. A row only
+# re-renders when its preview, unread count or members change, so the
+# key never goes stale and nothing has to invalidate it. The key keeps
+# only the 50 characters of the preview the row shows, and the least
+# recently used rows are evicted once ROW_CACHE_SIZE is reached.
+ROW_CACHE_SIZE = 1024
+_row_cache = OrderedDict()
+_row_cache_lock = threading.Lock()
+
+
+def render_conversation_rows(conversations):
+    """Set ``conv.html`` on each ConversationView, reusing cached renders."""
+    render = current_app.jinja_env.get_template(
+        'components/conversation_row.html').module.render_conversation
+    for conv in conversations:
+        preview = conv['last_message']
+        key = (conv['id'], preview[:50] if preview else preview,
+               conv['last_message_at'], conv['unread_count'],
+               tuple(tuple(m) for m in conv.members))
+        with _row_cache_lock:
+            html = _row_cache.get(key)
+            if html is not None:
+                _row_cache.move_to_end(key)
+        if html is None:
+            # Rendered outside the lock; a concurrent miss on the same
+            # row just renders it twice.
+            html = render(conv)
+            with _row_cache_lock:
+                _row_cache[key] = html
+                if len(_row_cache) > ROW_CACHE_SIZE:
+                    _row_cache.popitem(last=False)
+        conv.html = html
+
+
+# Membership check that also reports whether anything would be marked
+# read: the same test the inbox uses for its unread count.
+READ_STATE_SQL = '''
+    SELECT EXISTS (
+        SELECT 1 FROM messages m
+        WHERE m.conversation_id = cm.conversation_id
+          AND m.created_at > COALESCE(cm.last_read_at, '1970-01-01')
+          AND m.sender_id != cm.user_id
+    ) as has_unread
+    FROM conversation_members cm
+    WHERE cm.conversation_id = ? AND cm.user_id = ?
+'''
+
+CONVERSATION_MEMBERS_SQL = '''
+    SELECT u.id, u.username, u.display_name, u.profile_pic, u.is_verified,
+           u.is_corp_verified, u.affiliated_with,
+           corp.profile_pic as corp_profile_pic
+    FROM conversation_members cm
+    JOIN users u ON cm.user_id = u.id
+    LEFT JOIN users corp ON u.affiliated_with = corp.id
+    WHERE cm.conversation_id = ?
+'''
+
+# One page of a conversation, newest first, resuming strictly before the
+# (created_at, id) of the oldest message already shown.
+MESSAGES_PER_PAGE = 50
+
+MESSAGES_SQL = '''
+    SELECT m.*, u.username, u.display_name, u.profile_pic, u.is_verified,
+           u.is_corp_verified, u.affiliated_with,
+           corp.profile_pic as corp_profile_pic
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    LEFT JOIN users corp ON u.affiliated_with = corp.id
+    WHERE m.conversation_id = :conv_id AND m.is_deleted = 0
+      AND (m.created_at, m.id) < (:before_created, :before_id)
+    ORDER BY m.created_at DESC, m.id DESC
+    LIMIT :limit
+'''
+
+
+def load_messages(db, conv_id, cursor=None):
+    """Return a page of messages, oldest first, and the cursor for the page before it.
+
+    Raises ValueError if ``cursor`` is malformed. The cursor is None once
+    the start of the conversation is reached.
+    """
+    if cursor:
+        before_created, before_id = decode_cursor(cursor)
+    else:
+        before_created, before_id = '9999-12-31', 2 ** 63 - 1
+    messages = db.execute(MESSAGES_SQL, {
+        'conv_id': conv_id,
+        'before_created': before_created,
+        'before_id': before_id,
+        'limit': MESSAGES_PER_PAGE,
+    }).fetchall()
+    older = None
+    if len(messages) == MESSAGES_PER_PAGE:
+        older = encode_cursor(messages[-1]['created_at'], messages[-1]['id'])
+    messages.reverse()
+    return messages, older
+
 
 # ── Conversations List ───────────────────────────────────────────────
 
@@ -17,34 +192,15 @@ def inbox():
         return redirect(url_for('auth.login'))
 
     db = g.db
-    conversations = db.execute('''
-        SELECT c.*, cm.last_read_at,
-               (SELECT content FROM messages WHERE conversation_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message,
-               (SELECT created_at FROM messages WHERE conversation_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message_at,
-               (SELECT COUNT(*) FROM messages m2 WHERE m2.conversation_id = c.id
-                AND m2.created_at > COALESCE(cm.last_read_at, '1970-01-01')
-                AND m2.sender_id != ?) as unread_count
-        FROM conversations c
-        JOIN conversation_members cm ON c.id = cm.conversation_id
-        WHERE cm.user_id = ?
-        ORDER BY last_message_at DESC
-    ''', (g.user['id'], g.user['id'])).fetchall()
-
-    # Get other members for each conversation
-    conv_list = []
-    for conv in conversations:
-        members = db.execute('''
-            SELECT u.id, u.username, u.display_name, u.profile_pic, u.is_verified,
-                   u.is_corp_verified, u.affiliated_with,
-                   corp.profile_pic as corp_profile_pic
-            FROM conversation_members cm
-            JOIN users u ON cm.user_id = u.id
-            LEFT JOIN users corp ON u.affiliated_with = corp.id
-            WHERE cm.conversation_id = ? AND cm.user_id != ?
-        ''', (conv['id'], g.user['id'])).fetchall()
-        conv_dict = dict(conv)
-        conv_dict['members'] = [dict(m) for m in members]
-        conv_list.append(conv_dict)
+    conversations = db.execute(INBOX_SQL, {'user_id': g.user['id']}).fetchall()
+
+    members_by_conv = defaultdict(list)
+    for m in db.execute(INBOX_MEMBERS_SQL, {'user_id': g.user['id']}):
+        members_by_conv[m['conversation_id']].append(m)
+
+    conv_list = [ConversationView(conv, members_by_conv[conv['id']])
+                 for conv in conversations]
+    render_conversation_rows(conv_list)
 
     return render_template('messages/inbox.html', conversations=conv_list)
 
@@ -58,87 +214,79 @@ def conversation(conv_id):
 
     db = g.db
 
-    # Verify membership
-    member = db.execute(
-        'SELECT * FROM conversation_members WHERE conversation_id = ? AND user_id = ?',
-        (conv_id, g.user['id'])
-    ).fetchone()
+    member = db.execute(READ_STATE_SQL, (conv_id, g.user['id'])).fetchone()
     if not member:
         abort(404)
 
-    messages = db.execute('''
-        SELECT m.*, u.username, u.display_name, u.profile_pic, u.is_verified,
-               u.is_corp_verified, u.affiliated_with,
-               corp.profile_pic as corp_profile_pic
-        FROM messages m
-        JOIN users u ON m.sender_id = u.id
-        LEFT JOIN users corp ON u.affiliated_with = corp.id
-        WHERE m.conversation_id = ? AND m.is_deleted = 0
-        ORDER BY m.created_at ASC
-    ''', (conv_id,)).fetchall()
-
-    # Mark as read
-    db.execute(
-        'UPDATE conversation_members SET last_read_at = CURRENT_TIMESTAMP WHERE conversation_id = ? AND user_id = ?',
-        (conv_id, g.user['id'])
-    )
-    db.commit()
+    try:
+        messages, older = load_messages(db, conv_id, request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+    # Mark as read, skipping the write when a refresh has nothing new
+    if member['has_unread']:
+        writer = get_db_write()
+        writer.execute(
+            'UPDATE conversation_members SET last_read_at = CURRENT_TIMESTAMP '
+            'WHERE conversation_id = ? AND user_id = ?',
+            (conv_id, g.user['id'])
+        )
+        writer.commit()
 
     # Get other members
-    members = db.execute('''
-        SELECT u.id, u.username, u.display_name, u.profile_pic, u.is_verified,
-               u.is_corp_verified, u.affiliated_with,
-               corp.profile_pic as corp_profile_pic
-        FROM conversation_members cm
-        JOIN users u ON cm.user_id = u.id
-        LEFT JOIN users corp ON u.affiliated_with = corp.id
-        WHERE cm.conversation_id = ?
-    ''', (conv_id,)).fetchall()
+    members = db.execute(CONVERSATION_MEMBERS_SQL, (conv_id,)).fetchall()
 
     return render_template('messages/conversation.html',
-                           messages=messages, conv_id=conv_id, members=members)
+                           messages=messages, conv_id=conv_id, members=members,
+                           older=older)
 
 
-# ── Send Message ─────────────────────────────────────────────────────
-
-@messages_bp.route('/<int:conv_id>/send', methods=['POST'])
-def send_message(conv_id):
+@messages_bp.route('/<int:conv_id>/page')
+def message_page(conv_id):
+    """Older messages as JSON, for loading history on scroll."""
     if not g.user:
-        return redirect(url_for('auth.login'))
+        return jsonify({'error': 'Login required'}), 401
 
     db = g.db
-
-    # Verify membership
     member = db.execute(
-        'SELECT * FROM conversation_members WHERE conversation_id = ? AND user_id = ?',
+        'SELECT 1 FROM conversation_members WHERE conversation_id = ? AND user_id = ?',
         (conv_id, g.user['id'])
     ).fetchone()
     if not member:
         abort(404)
 
-    content = bleach.clean(request.form.get('content', '').strip())
+    try:
+        messages, older = load_messages(db, conv_id, request.args.get('before'))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    return jsonify({'messages': [dict(m) for m in messages], 'next_cursor': older})
+
+
+# ── Send Message ─────────────────────────────────────────────────────
+
+@messages_bp.route('/<int:conv_id>/send', methods=['POST'])
+def send_message(conv_id):
+    if not g.user:
+        return redirect(url_for('auth.login'))
+
+    content = clean(request.form.get('content', '').strip())
     if not content:
         return redirect(url_for('messages.conversation', conv_id=conv_id))
 
-    db.execute(
-        'INSERT INTO messages (conversation_id, sender_id, content) VALUES (?, ?, ?)',
-        (conv_id, g.user['id'], content)
-    )
+    db = g.db
+    params = {'conv_id': conv_id, 'user_id': g.user['id'], 'content': content}
+    # Nothing is inserted for non-members, so this is the membership check
+    if not db.execute(SEND_MESSAGE_SQL, params).rowcount:
+        abort(404)
+
     db.execute(
         'UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ?',
         (conv_id,)
     )
 
-    # Notify other members
-    other_members = db.execute(
-        'SELECT user_id FROM conversation_members WHERE conversation_id = ? AND user_id != ?',
-        (conv_id, g.user['id'])
-    ).fetchall()
-    for om in other_members:
-        db.execute(
-            'INSERT INTO notifications (user_id, actor_id, type, message) VALUES (?, ?, ?, ?)',
-            (om['user_id'], g.user['id'], 'message', 'sent you a message')
-        )
+    # Notify the other members in one statement
+    db.execute(NOTIFY_MEMBERS_SQL, params)
     db.commit()
 
     return redirect(url_for('messages.conversation', conv_id=conv_id))
@@ -153,7 +301,6 @@ def new_conversation():
 
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
-        content = bleach.clean(request.form.get('content', '').strip())
 
         db = g.db
         target = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
@@ -165,6 +312,9 @@ def new_conversation():
             flash("You can't message yourself.", 'error')
             return render_template('messages/new.html')
 
+        # Only sanitize once the request can no longer be rejected
+        content = clean(request.form.get('content', '').strip())
+
         # Check if conversation exists
         existing = db.execute('''
             SELECT c.id FROM conversations c
@@ -183,12 +333,11 @@ def new_conversation():
             return redirect(url_for('messages.conversation', conv_id=existing['id']))
 
         # Create new conversation
-        db.execute('INSERT INTO conversations (is_group) VALUES (0)')
-        conv_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
-        db.execute('INSERT INTO conversation_members (conversation_id, user_id) VALUES (?, ?)',
-                   (conv_id, g.user['id']))
-        db.execute('INSERT INTO conversation_members (conversation_id, user_id) VALUES (?, ?)',
-                   (conv_id, target['id']))
+        conv_id = db.execute(
+            'INSERT INTO conversations (is_group) VALUES (0) RETURNING id'
+        ).fetchone()[0]
+        db.execute('INSERT INTO conversation_members (conversation_id, user_id) VALUES (?, ?), (?, ?)',
+                   (conv_id, g.user['id'], conv_id, target['id']))
 
         if content:
             db.execute(
@@ -4,8 +4,27 @@ from flask import (
     render_template, flash, g, abort, jsonify
 )
 
+from database import notification_reads
+
 notifications_bp = Blueprint('notifications', __name__, url_prefix='/notifications')
 
+# The page only shows an 80-character preview of the post, so only that
+# much of its body is copied out of SQLite.
+NOTIFICATIONS_SQL = '''
+    SELECT n.*, u.username as actor_name, u.display_name as actor_display,
+           u.profile_pic as actor_pic, u.is_verified as actor_verified,
+           u.is_corp_verified as actor_corp_verified, u.affiliated_with as actor_affiliated_with,
+           corp.profile_pic as actor_corp_profile_pic,
+           substr(p.content, 1, 80) as post_content
+    FROM notifications n
+    LEFT JOIN users u ON n.actor_id = u.id
+    LEFT JOIN users corp ON u.affiliated_with = corp.id
+    LEFT JOIN posts p ON n.post_id = p.id
+    WHERE n.user_id = ?
+    ORDER BY n.created_at DESC
+    LIMIT 50
+'''
+
 
 @notifications_bp.route('/')
 def index():
@@ -13,24 +32,13 @@ def index():
         return redirect(url_for('auth.login'))
 
     db = g.db
-    notifications = db.execute('''
-        SELECT n.*, u.username as actor_name, u.display_name as actor_display,
-               u.profile_pic as actor_pic, u.is_verified as actor_verified,
-               u.is_corp_verified as actor_corp_verified, u.affiliated_with as actor_affiliated_with,
-               corp.profile_pic as actor_corp_profile_pic,
-               p.content as post_content
-        FROM notifications n
-        LEFT JOIN users u ON n.actor_id = u.id
-        LEFT JOIN users corp ON u.affiliated_with = corp.id
-        LEFT JOIN posts p ON n.post_id = p.id
-        WHERE n.user_id = ?
-        ORDER BY n.created_at DESC
-        LIMIT 50
-    ''', (g.user['id'],)).fetchall()
-
-    # Mark all as read
-    db.execute('UPDATE notifications SET is_read = 1 WHERE user_id = ?', (g.user['id'],))
-    db.commit()
+    notifications = db.execute(NOTIFICATIONS_SQL, (g.user['id'],)).fetchall()
+
+    # Mark everything up to the newest shown notification read, off the
+    # request path
+    if notifications:
+        notification_reads.mark(g.user['id'], max(n['id'] for n in notifications))
+    g.unread_count = 0
 
     return render_template('notifications/index.html', notifications=notifications)
 
@@ -41,7 +49,8 @@ def mark_all_read():
         return redirect(url_for('auth.login'))
 
     db = g.db
-    db.execute('UPDATE notifications SET is_read = 1 WHERE user_id = ?', (g.user['id'],))
+    db.execute('UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0',
+               (g.user['id'],))
     db.commit()
 
     if request.headers.get('Accept') == 'application/json':
@@ -51,13 +60,5 @@ def mark_all_read():
 
 @notifications_bp.route('/count')
 def unread_count():
-    if not g.user:
-        return jsonify({'count': 0})
-
-    db = g.db
-    count = db.execute(
-        'SELECT COUNT(*) as c FROM notifications WHERE user_id = ? AND is_read = 0',
-        (g.user['id'],)
-    ).fetchone()['c']
-
-    return jsonify({'count': count})
+    # before_request already counted unread notifications with the user
+    return jsonify({'count': g.unread_count})
@@ -2,21 +2,36 @@
 import os
 import re
 import json
-import uuid
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 
-import bleach
 from flask import (
     Blueprint, request, redirect, url_for,
     render_template, flash, g, abort, jsonify
 )
 from werkzeug.utils import secure_filename
 
+from cache import profile_counts
+from routes import PAGE_COUNTS_SQL, clean, image_ext, store_upload
+
 posts_bp = Blueprint('posts', __name__)
 
-UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads')
-ALLOWED_IMAGE_EXT = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 MAX_IMAGES = int(os.environ.get('MAX_IMAGES_PER_POST', 4))
+NO_MEDIA = '[]'  # posts.media for the common post without attachments
+HASHTAG_RE = re.compile(r'#(\w+)')
+MENTION_RE = re.compile(r'@(\w+)')
+
+# Statements shared by several routes below
+ACTIVE_POST_SQL = 'SELECT * FROM posts WHERE id = ? AND is_deleted = 0'
+OWN_POST_SQL = 'SELECT * FROM posts WHERE id = ? AND user_id = ?'
+POLL_SQL = 'SELECT * FROM polls WHERE id = ?'
+NOTIFY_SQL = 'INSERT INTO notifications (user_id, actor_id, type, post_id) VALUES (?, ?, ?, ?)'
+
+# Creates a hashtag on first use, else bumps its count
+HASHTAG_UPSERT_SQL = '''
+    INSERT INTO hashtags (tag, post_count) VALUES (?, 1)
+    ON CONFLICT(tag) DO UPDATE SET post_count = post_count + 1
+'''
 
 
 def max_post_length():
@@ -28,85 +43,127 @@ def max_post_length():
 
 
 def extract_hashtags(content):
-    """Extract hashtags from post content."""
-    return list(set(re.findall(r'#(\w+)', content)))
+    """Extract hashtags from post content, deduplicated in order."""
+    return list(dict.fromkeys(HASHTAG_RE.findall(content)))
 
 
 def extract_mentions(content):
-    """Extract @mentions from post content."""
-    return list(set(re.findall(r'@(\w+)', content)))
+    """Extract @mentions from post content, deduplicated in order."""
+    return list(dict.fromkeys(MENTION_RE.findall(content)))
+
+
+def notify_mentions(db, content, post_id, actor_id):
+    """Notify every user @mentioned in ``content``, except the author."""
+    mentions = extract_mentions(content)
+    if mentions:
+        db.execute(f'''
+            INSERT INTO notifications (user_id, actor_id, type, post_id)
+            SELECT id, ?, 'mention', ? FROM users
+            WHERE username IN ({','.join('?' * len(mentions))}) AND id != ?
+        ''', (actor_id, post_id, *mentions, actor_id))
+
+
+def is_web_url(value):
+    """True for an absolute http(s) URL."""
+    try:
+        parts = urlsplit(value)
+    except ValueError:
+        return False
+    return parts.scheme in ('http', 'https') and bool(parts.netloc)
 
 
 def save_media(files):
     """Save uploaded media files and return paths."""
     paths = []
     for f in files:
-        if f and f.filename:
-            ext = f.filename.rsplit('.', 1)[1].lower() if '.' in f.filename else ''
-            if ext in ALLOWED_IMAGE_EXT:
-                filename = f"{uuid.uuid4().hex}.{ext}"
-                path = os.path.join(UPLOAD_DIR, 'media')
-                os.makedirs(path, exist_ok=True)
-                f.save(os.path.join(path, filename))
-                paths.append(f"/uploads/media/{filename}")
-                if len(paths) >= MAX_IMAGES:
-                    break
+        if len(paths) >= MAX_IMAGES:
+            break
+        ext = image_ext(f.filename) if f and f.filename else None
+        if ext:
+            paths.append(store_upload(f, 'media', ext))
     return paths
 
 
-def enrich_post(post, db, current_user=None):
-    """Add interaction data to a post dict."""
-    p = dict(post)
+def enrich_posts(posts, db, current_user=None):
+    """Add interaction data, notes and quoted posts to a page of posts.
+
+    Runs a fixed number of queries per page (each keyed by ``post_id IN
+    (...)``) instead of several per post.
+    """
+    posts = [dict(p) for p in posts]
+    if not posts:
+        return []
+    ids = [p['id'] for p in posts]
+    marks = ','.join('?' * len(ids))
+
+    liked, bookmarked = set(), set()
     if current_user:
-        liked = db.execute(
-            'SELECT id FROM likes WHERE user_id = ? AND post_id = ?',
-            (current_user['id'], post['id'])
-        ).fetchone()
-        p['is_liked'] = liked is not None
-        bookmarked = db.execute(
-            'SELECT id FROM bookmarks WHERE user_id = ? AND post_id = ?',
-            (current_user['id'], post['id'])
-        ).fetchone()
-        p['is_bookmarked'] = bookmarked is not None
-    else:
-        p['is_liked'] = False
-        p['is_bookmarked'] = False
-
-    # Get community notes
-    notes = db.execute('''
-        SELECT cn.*, u.username, u.display_name, u.is_verified
-        FROM community_notes cn
-        JOIN users u ON cn.author_id = u.id
-        WHERE cn.post_id = ? AND cn.status = 'approved'
-        ORDER BY cn.helpful_count DESC LIMIT 3
-    ''', (post['id'],)).fetchall()
-    p['community_notes'] = [dict(n) for n in notes]
-
-    # Get staff notes
-    staff = db.execute('''
-        SELECT sn.*, u.username, u.display_name
-        FROM staff_notes sn
-        JOIN users u ON sn.author_id = u.id
-        WHERE sn.post_id = ?
-        ORDER BY sn.created_at DESC LIMIT 3
-    ''', (post['id'],)).fetchall()
-    p['staff_notes'] = [dict(n) for n in staff]
-
-    # Get quote post if exists
-    if post['quote_id']:
-        quoted = db.execute('''
+        # The user's likes and bookmarks among these posts in one pass
+        user_ids = (current_user['id'], *ids)
+        for r in db.execute(f'''
+            SELECT 'like' as kind, post_id FROM likes
+            WHERE user_id = ? AND post_id IN ({marks})
+            UNION ALL
+            SELECT 'bookmark', post_id FROM bookmarks
+            WHERE user_id = ? AND post_id IN ({marks})
+        ''', user_ids + user_ids):
+            (liked if r['kind'] == 'like' else bookmarked).add(r['post_id'])
+
+    # Top 3 approved community notes per post
+    community_notes = {}
+    for n in db.execute(f'''
+        SELECT * FROM (
+            SELECT cn.*, u.username, u.display_name, u.is_verified,
+                   ROW_NUMBER() OVER (PARTITION BY cn.post_id
+                                      ORDER BY cn.helpful_count DESC) as note_rank
+            FROM community_notes cn
+            JOIN users u ON cn.author_id = u.id
+            WHERE cn.post_id IN ({marks}) AND cn.status = 'approved'
+        ) WHERE note_rank <= 3
+        ORDER BY post_id, note_rank
+    ''', ids):
+        community_notes.setdefault(n['post_id'], []).append(dict(n))
+
+    # Latest 3 staff notes per post
+    staff_notes = {}
+    for n in db.execute(f'''
+        SELECT * FROM (
+            SELECT sn.*, u.username, u.display_name,
+                   ROW_NUMBER() OVER (PARTITION BY sn.post_id
+                                      ORDER BY sn.created_at DESC) as note_rank
+            FROM staff_notes sn
+            JOIN users u ON sn.author_id = u.id
+            WHERE sn.post_id IN ({marks})
+        ) WHERE note_rank <= 3
+        ORDER BY post_id, note_rank
+    ''', ids):
+        staff_notes.setdefault(n['post_id'], []).append(dict(n))
+
+    quoted = {}
+    quote_ids = list({p['quote_id'] for p in posts if p['quote_id']})
+    if quote_ids:
+        for q in db.execute(f'''
             SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
                    u.is_corp_verified, u.affiliated_with,
                    corp.profile_pic as corp_profile_pic
             FROM posts p JOIN users u ON p.user_id = u.id
             LEFT JOIN users corp ON u.affiliated_with = corp.id
-            WHERE p.id = ? AND p.is_deleted = 0
-        ''', (post['quote_id'],)).fetchone()
-        p['quoted_post'] = dict(quoted) if quoted else None
-    else:
-        p['quoted_post'] = None
+            WHERE p.id IN ({','.join('?' * len(quote_ids))}) AND p.is_deleted = 0
+        ''', quote_ids):
+            quoted[q['id']] = dict(q)
 
-    return p
+    for p in posts:
+        p['is_liked'] = p['id'] in liked
+        p['is_bookmarked'] = p['id'] in bookmarked
+        p['community_notes'] = community_notes.get(p['id'], [])
+        p['staff_notes'] = staff_notes.get(p['id'], [])
+        p['quoted_post'] = quoted.get(p['quote_id'])
+    return posts
+
+
+def enrich_post(post, db, current_user=None):
+    """Add interaction data to a post dict."""
+    return enrich_posts([post], db, current_user)[0]
 
 
 # ── Create Post ──────────────────────────────────────────────────────
@@ -123,7 +180,7 @@ def compose():
             flash(f'Post must be 1-{limit} characters.', 'error')
             return render_template('posts/compose.html')
 
-        content = bleach.clean(content)
+        content = clean(content)
         db = g.db
 
         # Handle media uploads
@@ -132,74 +189,43 @@ def compose():
             files = request.files.getlist('media')
             media = save_media(files)
 
-        # Handle poll
-        poll_id = None
-        if request.form.get('poll_option_0'):
-            options = []
-            for i in range(4):
-                opt = request.form.get(f'poll_option_{i}', '').strip()
-                if opt:
-                    options.append(opt)
-            if len(options) >= 2:
-                duration_hours = int(request.form.get('poll_duration', 24))
-                expires = datetime.now() + timedelta(hours=duration_hours)
-                # Create post first, then poll
-                pass  # handled below
+        # Poll options; it takes two to make a poll
+        poll_options = [opt for opt in (request.form.get(f'poll_option_{i}', '').strip()
+                                        for i in range(4)) if opt]
 
         # Quote post
         quote_id = request.form.get('quote_id', type=int)
 
-        db.execute(
+        post_id = db.execute(
             '''INSERT INTO posts (user_id, content, media, quote_id)
                VALUES (?, ?, ?, ?)''',
-            (g.user['id'], content, json.dumps(media), quote_id)
-        )
-        db.commit()
-
-        post_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+            (g.user['id'], content, json.dumps(media) if media else NO_MEDIA, quote_id)
+        ).lastrowid
 
         # Create poll if needed
-        if request.form.get('poll_option_0'):
-            options = []
-            for i in range(4):
-                opt = request.form.get(f'poll_option_{i}', '').strip()
-                if opt:
-                    options.append(opt)
-            if len(options) >= 2:
-                duration_hours = int(request.form.get('poll_duration', 24))
-                expires = datetime.now() + timedelta(hours=duration_hours)
-                db.execute(
-                    'INSERT INTO polls (post_id, options, expires_at) VALUES (?, ?, ?)',
-                    (post_id, json.dumps(options), expires.isoformat())
-                )
-                db.commit()
-                poll_row = db.execute('SELECT last_insert_rowid()').fetchone()[0]
-                db.execute('UPDATE posts SET poll_id = ? WHERE id = ?', (poll_row, post_id))
-                db.commit()
+        if len(poll_options) >= 2:
+            duration_hours = request.form.get('poll_duration', 24, type=int)
+            expires = datetime.now() + timedelta(hours=duration_hours)
+            poll_row = db.execute(
+                'INSERT INTO polls (post_id, options, expires_at) VALUES (?, ?, ?)',
+                (post_id, json.dumps(poll_options), expires.isoformat())
+            ).lastrowid
+            db.execute('UPDATE posts SET poll_id = ? WHERE id = ?', (poll_row, post_id))
 
         # Process hashtags
         tags = extract_hashtags(content)
-        for tag in tags:
-            db.execute('INSERT OR IGNORE INTO hashtags (tag) VALUES (?)', (tag,))
-            hashtag = db.execute('SELECT id FROM hashtags WHERE tag = ?', (tag,)).fetchone()
-            db.execute('INSERT OR IGNORE INTO post_hashtags (post_id, hashtag_id) VALUES (?, ?)',
-                       (post_id, hashtag['id']))
-            db.execute('UPDATE hashtags SET post_count = post_count + 1 WHERE id = ?',
-                       (hashtag['id'],))
-        db.commit()
+        if tags:
+            db.executemany(HASHTAG_UPSERT_SQL, [(tag,) for tag in tags])
+            db.execute(f'''
+                INSERT OR IGNORE INTO post_hashtags (post_id, hashtag_id)
+                SELECT ?, id FROM hashtags WHERE tag IN ({','.join('?' * len(tags))})
+            ''', (post_id, *tags))
 
         # Process mentions -> notifications
-        mentions = extract_mentions(content)
-        for mention in mentions:
-            mentioned_user = db.execute(
-                'SELECT id FROM users WHERE username = ?', (mention,)
-            ).fetchone()
-            if mentioned_user and mentioned_user['id'] != g.user['id']:
-                db.execute(
-                    'INSERT INTO notifications (user_id, actor_id, type, post_id) VALUES (?, ?, ?, ?)',
-                    (mentioned_user['id'], g.user['id'], 'mention', post_id)
-                )
+        notify_mentions(db, content, post_id, g.user['id'])
+        # The post, poll, tags and notifications land in one transaction
         db.commit()
+        profile_counts.invalidate(g.user['id'])
 
         flash('Chirp posted! 🐦', 'success')
         return redirect(url_for('feed.home'))
@@ -222,69 +248,57 @@ def compose():
 
 # ── View Single Post ─────────────────────────────────────────────────
 
-@posts_bp.route('/post/<int:post_id>')
-def view_post(post_id):
-    db = g.db
-    post = db.execute('''
+# A post and its visible replies, the post first, with counts for both
+# aggregated in one pass.
+THREAD_SQL = '''
+    WITH page AS MATERIALIZED (
         SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
                u.is_corp_verified, u.affiliated_with,
-               corp.profile_pic as corp_profile_pic,
-               (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-               (SELECT COUNT(*) FROM posts WHERE parent_id = p.id AND is_deleted = 0) as reply_count,
-               (SELECT COUNT(*) FROM posts WHERE repost_id = p.id) as repost_count
+               corp.profile_pic as corp_profile_pic
         FROM posts p
         JOIN users u ON p.user_id = u.id
         LEFT JOIN users corp ON u.affiliated_with = corp.id
-        WHERE p.id = ? AND p.is_deleted = 0
-    ''', (post_id,)).fetchone()
+        WHERE (p.id = :post_id OR p.parent_id = :post_id) AND p.is_deleted = 0
+    )
+''' + PAGE_COUNTS_SQL + '''
+    ORDER BY page.id != :post_id, page.created_at ASC
+'''
 
-    if not post:
+# Votes per option, flagging the one (if any) cast by the given user
+POLL_VOTES_SQL = '''
+    SELECT option_index, COUNT(*) as c, MAX(user_id = ?) as mine
+    FROM poll_votes WHERE poll_id = ?
+    GROUP BY option_index
+'''
+
+
+@posts_bp.route('/post/<int:post_id>')
+def view_post(post_id):
+    db = g.db
+    rows = db.execute(THREAD_SQL, {'post_id': post_id}).fetchall()
+    if not rows or rows[0]['id'] != post_id:
         abort(404)
+    post, *replies = rows
 
-    post = enrich_post(post, db, g.user)
+    # The post and its replies share one enrichment pass
+    post, *enriched_replies = enrich_posts([post, *replies], db, g.user)
 
     # Get poll data
     poll = None
     if post.get('poll_id'):
-        poll = db.execute('SELECT * FROM polls WHERE id = ?', (post['poll_id'],)).fetchone()
+        poll = db.execute(POLL_SQL, (post['poll_id'],)).fetchone()
         if poll:
             poll = dict(poll)
             poll['options'] = json.loads(poll['options'])
-            poll['total_votes'] = db.execute(
-                'SELECT COUNT(*) as c FROM poll_votes WHERE poll_id = ?', (poll['id'],)
-            ).fetchone()['c']
-            poll['vote_counts'] = []
-            for i in range(len(poll['options'])):
-                c = db.execute(
-                    'SELECT COUNT(*) as c FROM poll_votes WHERE poll_id = ? AND option_index = ?',
-                    (poll['id'], i)
-                ).fetchone()['c']
-                poll['vote_counts'].append(c)
+            counts = [0] * len(poll['options'])
             poll['user_voted'] = None
-            if g.user:
-                vote = db.execute(
-                    'SELECT option_index FROM poll_votes WHERE poll_id = ? AND user_id = ?',
-                    (poll['id'], g.user['id'])
-                ).fetchone()
-                if vote:
-                    poll['user_voted'] = vote['option_index']
-
-    # Get replies
-    replies = db.execute('''
-        SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_verified,
-               u.is_corp_verified, u.affiliated_with,
-               corp.profile_pic as corp_profile_pic,
-               (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-               (SELECT COUNT(*) FROM posts WHERE parent_id = p.id AND is_deleted = 0) as reply_count,
-               (SELECT COUNT(*) FROM posts WHERE repost_id = p.id) as repost_count
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        LEFT JOIN users corp ON u.affiliated_with = corp.id
-        WHERE p.parent_id = ? AND p.is_deleted = 0
-        ORDER BY p.created_at ASC
-    ''', (post_id,)).fetchall()
-
-    enriched_replies = [enrich_post(r, db, g.user) for r in replies]
+            for r in db.execute(POLL_VOTES_SQL,
+                                (g.user['id'] if g.user else None, poll['id'])):
+                counts[r['option_index']] = r['c']
+                if r['mine']:
+                    poll['user_voted'] = r['option_index']
+            poll['vote_counts'] = counts
+            poll['total_votes'] = sum(counts)
 
     return render_template('posts/view.html', post=post, replies=enriched_replies, poll=poll)
 
@@ -297,11 +311,11 @@ def reply(post_id):
         return redirect(url_for('auth.login'))
 
     db = g.db
-    parent = db.execute('SELECT * FROM posts WHERE id = ? AND is_deleted = 0', (post_id,)).fetchone()
+    parent = db.execute(ACTIVE_POST_SQL, (post_id,)).fetchone()
     if not parent:
         abort(404)
 
-    content = bleach.clean(request.form.get('content', '').strip())
+    content = clean(request.form.get('content', '').strip())
     limit = max_post_length()
     if not content or len(content) > limit:
         flash(f'Reply must be 1-{limit} characters.', 'error')
@@ -312,29 +326,17 @@ def reply(post_id):
         files = request.files.getlist('media')
         media = save_media(files)
 
-    db.execute(
+    reply_id = db.execute(
         'INSERT INTO posts (user_id, content, parent_id, media) VALUES (?, ?, ?, ?)',
-        (g.user['id'], content, post_id, json.dumps(media))
-    )
+        (g.user['id'], content, post_id, json.dumps(media) if media else NO_MEDIA)
+    ).lastrowid
 
     # Notification
     if parent['user_id'] != g.user['id']:
-        db.execute(
-            'INSERT INTO notifications (user_id, actor_id, type, post_id) VALUES (?, ?, ?, ?)',
-            (parent['user_id'], g.user['id'], 'reply', post_id)
-        )
-    db.commit()
+        db.execute(NOTIFY_SQL, (parent['user_id'], g.user['id'], 'reply', post_id))
 
     # Process mentions
-    mentions = extract_mentions(content)
-    reply_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
-    for mention in mentions:
-        mentioned_user = db.execute('SELECT id FROM users WHERE username = ?', (mention,)).fetchone()
-        if mentioned_user and mentioned_user['id'] != g.user['id']:
-            db.execute(
-                'INSERT INTO notifications (user_id, actor_id, type, post_id) VALUES (?, ?, ?, ?)',
-                (mentioned_user['id'], g.user['id'], 'mention', reply_id)
-            )
+    notify_mentions(db, content, reply_id, g.user['id'])
     db.commit()
 
     flash('Reply posted!', 'success')
@@ -349,8 +351,7 @@ def edit_post(post_id):
         return redirect(url_for('auth.login'))
 
     db = g.db
-    post = db.execute('SELECT * FROM posts WHERE id = ? AND user_id = ?',
-                       (post_id, g.user['id'])).fetchone()
+    post = db.execute(OWN_POST_SQL, (post_id, g.user['id'])).fetchone()
     if not post:
         abort(404)
 
@@ -360,7 +361,7 @@ def edit_post(post_id):
         flash('Posts can only be edited within 30 minutes.', 'error')
         return redirect(url_for('posts.view_post', post_id=post_id))
 
-    new_content = bleach.clean(request.form.get('content', '').strip())
+    new_content = clean(request.form.get('content', '').strip())
     limit = max_post_length()
     if not new_content or len(new_content) > limit:
         flash(f'Post must be 1-{limit} characters.', 'error')
@@ -402,6 +403,7 @@ def delete_post(post_id):
 
     db.execute('UPDATE posts SET is_deleted = 1 WHERE id = ?', (post_id,))
     db.commit()
+    profile_counts.invalidate(post['user_id'])
 
     flash('Post deleted.', 'info')
     return redirect(url_for('feed.home'))
@@ -417,37 +419,28 @@ def like_post(post_id):
         return redirect(url_for('auth.login'))
 
     db = g.db
-    post = db.execute('SELECT * FROM posts WHERE id = ? AND is_deleted = 0', (post_id,)).fetchone()
+    post = db.execute(ACTIVE_POST_SQL, (post_id,)).fetchone()
     if not post:
         abort(404)
 
-    existing = db.execute(
-        'SELECT id FROM likes WHERE user_id = ? AND post_id = ?',
-        (g.user['id'], post_id)
-    ).fetchone()
-
-    if existing:
-        db.execute('DELETE FROM likes WHERE user_id = ? AND post_id = ?',
-                    (g.user['id'], post_id))
-        liked = False
-    else:
-        db.execute('INSERT INTO likes (user_id, post_id) VALUES (?, ?)',
-                    (g.user['id'], post_id))
+    params = (g.user['id'], post_id)
+    liked = db.execute(
+        'DELETE FROM likes WHERE user_id = ? AND post_id = ? RETURNING 1', params
+    ).fetchone() is None
+    if liked:
+        db.execute('INSERT OR IGNORE INTO likes (user_id, post_id) VALUES (?, ?)', params)
         if post['user_id'] != g.user['id']:
-            db.execute(
-                'INSERT INTO notifications (user_id, actor_id, type, post_id) VALUES (?, ?, ?, ?)',
-                (post['user_id'], g.user['id'], 'like', post_id)
-            )
-        liked = True
-    db.commit()
-
-    like_count = db.execute(
-        'SELECT COUNT(*) as c FROM likes WHERE post_id = ?', (post_id,)
-    ).fetchone()['c']
+            db.execute(NOTIFY_SQL, (post['user_id'], g.user['id'], 'like', post_id))
 
     if request.headers.get('Accept') == 'application/json':
+        # Counted inside the write transaction, so it reflects this toggle
+        like_count = db.execute(
+            'SELECT COUNT(*) as c FROM likes WHERE post_id = ?', (post_id,)
+        ).fetchone()['c']
+        db.commit()
         return jsonify({'liked': liked, 'count': like_count})
 
+    db.commit()
     return redirect(request.referrer or url_for('feed.home'))
 
 
@@ -459,19 +452,12 @@ def bookmark_post(post_id):
         return redirect(url_for('auth.login'))
 
     db = g.db
-    existing = db.execute(
-        'SELECT id FROM bookmarks WHERE user_id = ? AND post_id = ?',
-        (g.user['id'], post_id)
-    ).fetchone()
-
-    if existing:
-        db.execute('DELETE FROM bookmarks WHERE user_id = ? AND post_id = ?',
-                    (g.user['id'], post_id))
-        bookmarked = False
-    else:
-        db.execute('INSERT INTO bookmarks (user_id, post_id) VALUES (?, ?)',
-                    (g.user['id'], post_id))
-        bookmarked = True
+    params = (g.user['id'], post_id)
+    bookmarked = db.execute(
+        'DELETE FROM bookmarks WHERE user_id = ? AND post_id = ? RETURNING 1', params
+    ).fetchone() is None
+    if bookmarked:
+        db.execute('INSERT OR IGNORE INTO bookmarks (user_id, post_id) VALUES (?, ?)', params)
     db.commit()
 
     if request.headers.get('Accept') == 'application/json':
@@ -488,33 +474,35 @@ def repost(post_id):
         return redirect(url_for('auth.login'))
 
     db = g.db
-    original = db.execute('SELECT * FROM posts WHERE id = ? AND is_deleted = 0', (post_id,)).fetchone()
+    original = db.execute(ACTIVE_POST_SQL, (post_id,)).fetchone()
     if not original:
         abort(404)
 
-    # Check if already reposted
-    existing = db.execute(
-        'SELECT id FROM posts WHERE user_id = ? AND repost_id = ?',
-        (g.user['id'], post_id)
-    ).fetchone()
-
-    if existing:
-        db.execute('DELETE FROM posts WHERE id = ?', (existing['id'],))
-        db.commit()
-        flash('Rechirp removed.', 'info')
-    else:
+    # Undo an existing rechirp, else make one
+    reposted = db.execute(
+        'DELETE FROM posts WHERE repost_id = ? AND user_id = ? RETURNING 1',
+        (post_id, g.user['id'])
+    ).fetchone() is None
+    if reposted:
         db.execute(
             'INSERT INTO posts (user_id, content, repost_id) VALUES (?, ?, ?)',
             (g.user['id'], '', post_id)
         )
         if original['user_id'] != g.user['id']:
-            db.execute(
-                'INSERT INTO notifications (user_id, actor_id, type, post_id) VALUES (?, ?, ?, ?)',
-                (original['user_id'], g.user['id'], 'repost', post_id)
-            )
+            db.execute(NOTIFY_SQL, (original['user_id'], g.user['id'], 'repost', post_id))
+
+    if request.headers.get('Accept') == 'application/json':
+        repost_count = db.execute(
+            'SELECT COUNT(*) as c FROM posts WHERE repost_id = ?', (post_id,)
+        ).fetchone()['c']
         db.commit()
-        flash('Rechirped! 🔁', 'success')
+        return jsonify({'reposted': reposted, 'count': repost_count})
 
+    db.commit()
+    if reposted:
+        flash('Rechirped! 🔁', 'success')
+    else:
+        flash('Rechirp removed.', 'info')
     return redirect(request.referrer or url_for('feed.home'))
 
 
@@ -526,8 +514,7 @@ def pin_post(post_id):
         return redirect(url_for('auth.login'))
 
     db = g.db
-    post = db.execute('SELECT * FROM posts WHERE id = ? AND user_id = ?',
-                       (post_id, g.user['id'])).fetchone()
+    post = db.execute(OWN_POST_SQL, (post_id, g.user['id'])).fetchone()
     if not post:
         abort(404)
 
@@ -548,7 +535,7 @@ def vote_poll(poll_id):
         return redirect(url_for('auth.login'))
 
     db = g.db
-    poll = db.execute('SELECT * FROM polls WHERE id = ?', (poll_id,)).fetchone()
+    poll = db.execute(POLL_SQL, (poll_id,)).fetchone()
     if not poll:
         abort(404)
 
@@ -583,21 +570,21 @@ def add_community_note(post_id):
         return redirect(url_for('auth.login'))
 
     db = g.db
-    post = db.execute('SELECT * FROM posts WHERE id = ? AND is_deleted = 0', (post_id,)).fetchone()
+    post = db.execute(ACTIVE_POST_SQL, (post_id,)).fetchone()
     if not post:
         abort(404)
 
-    content = bleach.clean(request.form.get('content', '').strip())[:280]
-    source1 = bleach.clean(request.form.get('source1', '').strip())
-    source2 = bleach.clean(request.form.get('source2', '').strip())
-    source3 = bleach.clean(request.form.get('source3', '').strip())
+    # Notes and their sources are only ever shown autoescaped, so they
+    # are stored as typed rather than run through clean()
+    content = request.form.get('content', '').strip()[:280]
+    sources = [request.form.get(f'source{i}', '').strip() for i in (1, 2, 3)]
     category = request.form.get('category', 'missing_context')
 
     if not content:
         flash('Note content is required.', 'error')
         return redirect(url_for('posts.view_post', post_id=post_id))
 
-    sources = [s for s in [source1, source2, source3] if s]
+    sources = [s for s in sources if is_web_url(s)]
     if not sources:
         flash('At least one source link is required.', 'error')
         return redirect(url_for('posts.view_post', post_id=post_id))
@@ -617,6 +604,23 @@ def add_community_note(post_id):
     return redirect(url_for('posts.view_post', post_id=post_id))
 
 
+RATE_NOTE_SQL = '''
+    INSERT INTO community_note_ratings (note_id, user_id, rating) VALUES (?, ?, ?)
+    ON CONFLICT(note_id, user_id) DO UPDATE SET rating = excluded.rating
+'''
+
+NOTE_TALLY_SQL = '''
+    UPDATE community_notes
+    SET helpful_count = r.helpful,
+        not_helpful_count = r.not_helpful,
+        status = CASE WHEN r.helpful >= 3 THEN 'approved' ELSE status END
+    FROM (SELECT SUM(rating = 'helpful') as helpful,
+                 SUM(rating = 'not_helpful') as not_helpful
+          FROM community_note_ratings WHERE note_id = ?) r
+    WHERE community_notes.id = ?
+'''
+
+
 @posts_bp.route('/community-note/<int:note_id>/rate', methods=['POST'])
 def rate_community_note(note_id):
     if not g.user:
@@ -631,40 +635,9 @@ def rate_community_note(note_id):
     if rating not in ('helpful', 'not_helpful'):
         abort(400)
 
-    # Upsert rating
-    existing = db.execute(
-        'SELECT id, rating FROM community_note_ratings WHERE note_id = ? AND user_id = ?',
-        (note_id, g.user['id'])
-    ).fetchone()
-
-    if existing:
-        if existing['rating'] != rating:
-            db.execute('UPDATE community_note_ratings SET rating = ? WHERE id = ?',
-                       (rating, existing['id']))
-    else:
-        db.execute(
-            'INSERT INTO community_note_ratings (note_id, user_id, rating) VALUES (?, ?, ?)',
-            (note_id, g.user['id'], rating)
-        )
-
-    # Update counts
-    helpful = db.execute(
-        "SELECT COUNT(*) as c FROM community_note_ratings WHERE note_id = ? AND rating = 'helpful'",
-        (note_id,)
-    ).fetchone()['c']
-    not_helpful = db.execute(
-        "SELECT COUNT(*) as c FROM community_note_ratings WHERE note_id = ? AND rating = 'not_helpful'",
-        (note_id,)
-    ).fetchone()['c']
-
-    db.execute(
-        'UPDATE community_notes SET helpful_count = ?, not_helpful_count = ? WHERE id = ?',
-        (helpful, not_helpful, note_id)
-    )
-
-    # Auto-approve if 3+ helpful ratings
-    if helpful >= 3:
-        db.execute("UPDATE community_notes SET status = 'approved' WHERE id = ?", (note_id,))
+    db.execute(RATE_NOTE_SQL, (note_id, g.user['id'], rating))
+    # Refresh both tallies, auto-approving at 3+ helpful ratings
+    db.execute(NOTE_TALLY_SQL, (note_id, note_id))
 
     db.commit()
     return redirect(url_for('posts.view_post', post_id=note['post_id']))
@@ -678,8 +651,9 @@ def report_post(post_id):
         return redirect(url_for('auth.login'))
 
     db = g.db
-    reason = bleach.clean(request.form.get('reason', '').strip())
-    details = bleach.clean(request.form.get('details', '').strip())
+    # Shown to moderators autoescaped; no markup to sanitize
+    reason = request.form.get('reason', '').strip()
+    details = request.form.get('details', '').strip()
 
     if not reason:
         flash('Please select a reason for reporting.', 'error')
@@ -1,24 +1,41 @@
 """First-run setup wizard."""
-import bcrypt
-import bleach
 from flask import (
     Blueprint, request, redirect, url_for,
     render_template, flash, g, session
 )
 
+from database import settings_cache
+from routes import clean, hash_password
+from routes.admin import HEX_COLOR_RE
+
 setup_bp = Blueprint('setup', __name__)
 
 
+_admin_exists = False
+
+
 def has_admin():
-    """Check if an admin user exists."""
-    db = g.db
-    admin = db.execute('SELECT id FROM users WHERE is_admin = 1').fetchone()
-    return admin is not None
+    """Check if an admin user exists.
+
+    Once one does, setup stays closed, so a True answer is remembered
+    for the life of the process.
+    """
+    global _admin_exists
+    if not _admin_exists:
+        _admin_exists = g.db.execute(
+            'SELECT 1 FROM users WHERE is_admin = 1 LIMIT 1'
+        ).fetchone() is not None
+    return _admin_exists
 
 
 @setup_bp.route('/setup', methods=['GET', 'POST'])
 def setup():
-    if has_admin():
+    # Step 2 is only open to the session that just ran step 1; other
+    # admins change settings from the admin panel, which is audited
+    finishing = (request.method == 'POST' and request.form.get('step') == '2'
+                 and session.get('setup_pending')
+                 and g.user is not None and g.user['is_admin'])
+    if has_admin() and not finishing:
         flash('Setup already complete.', 'info')
         return redirect(url_for('auth.login'))
 
@@ -27,7 +44,7 @@ def setup():
 
         if step == '1':
             # Create admin account
-            username = bleach.clean(request.form.get('username', '').strip())
+            username = clean(request.form.get('username', '').strip())
             email = request.form.get('email', '').strip().lower()
             password = request.form.get('password', '')
 
@@ -44,19 +61,19 @@ def setup():
                     flash(e, 'error')
                 return render_template('setup/index.html', step=1)
 
-            password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+            password_hash = hash_password(password)
 
             db = g.db
-            db.execute(
+            user = db.execute(
                 '''INSERT INTO users (username, email, password_hash, display_name,
                    is_admin, is_verified, email_verified)
-                   VALUES (?, ?, ?, ?, 1, 1, 1)''',
+                   VALUES (?, ?, ?, ?, 1, 1, 1) RETURNING id''',
                 (username, email, password_hash, username)
-            )
+            ).fetchone()
             db.commit()
 
-            user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
             session['user_id'] = user['id']
+            session['setup_pending'] = True
             session.permanent = True
 
             flash('Admin account created!', 'success')
@@ -64,18 +81,22 @@ def setup():
 
         elif step == '2':
             # Site settings
-            site_name = bleach.clean(request.form.get('site_name', 'Chirp').strip())
-            site_desc = bleach.clean(request.form.get('site_description', '').strip())
-            theme_color = request.form.get('theme_color', '#6750A4')
+            site_name = clean(request.form.get('site_name', 'Chirp').strip())
+            site_desc = clean(request.form.get('site_description', '').strip())
+            theme_color = request.form.get('theme_color', '#6750A4').strip()
+            if not HEX_COLOR_RE.fullmatch(theme_color):
+                flash('Theme color must be a hex color like #6750A4.', 'error')
+                return render_template('setup/index.html', step=2)
 
             db = g.db
-            db.execute('INSERT OR REPLACE INTO site_settings (key, value) VALUES (?, ?)',
-                       ('site_name', site_name))
-            db.execute('INSERT OR REPLACE INTO site_settings (key, value) VALUES (?, ?)',
-                       ('site_description', site_desc))
-            db.execute('INSERT OR REPLACE INTO site_settings (key, value) VALUES (?, ?)',
-                       ('theme_color', theme_color))
+            db.executemany('INSERT OR REPLACE INTO site_settings (key, value) VALUES (?, ?)', [
+                ('site_name', site_name),
+                ('site_description', site_desc),
+                ('theme_color', theme_color),
+            ])
             db.commit()
+            settings_cache.invalidate()
+            session.pop('setup_pending', None)
 
             flash('Setup complete! Welcome to your new Chirp instance! 🐦', 'success')
             return redirect(url_for('feed.home'))
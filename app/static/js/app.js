@@ -48,6 +48,37 @@ function sharePost(postId) {
     }
 }
 
+// Like, bookmark and rechirp in place; without JS the forms post and redirect
+const TOGGLE_STATE = { like: 'liked', bookmark: 'bookmarked', repost: 'reposted' };
+
+document.addEventListener('submit', (e) => {
+    const form = e.target.closest('form[data-toggle]');
+    if (!form) return;
+    e.preventDefault();
+
+    const kind = form.dataset.toggle;
+    const button = form.querySelector('button');
+    button.disabled = true;
+    fetch(form.action, {
+        method: 'POST',
+        body: new FormData(form),
+        headers: { 'Accept': 'application/json' },
+    })
+        .then(r => {
+            if (!r.ok) throw new Error(r.status);
+            return r.json();
+        })
+        .then(data => {
+            const active = data[TOGGLE_STATE[kind]];
+            button.classList.toggle(TOGGLE_STATE[kind], active);
+            const count = button.querySelector('.action-count');
+            if (count && data.count !== undefined) count.textContent = data.count;
+            if (kind === 'repost') showSnackbar(active ? 'Rechirped!' : 'Rechirp removed.');
+        })
+        .catch(() => form.submit())
+        .finally(() => { button.disabled = false; });
+});
+
 // Show snackbar notification
 function showSnackbar(message) {
     const container = document.querySelector('.flash-messages') ||
@@ -80,7 +111,7 @@ function updateNotificationCount() {
             const notifLink = document.querySelector('a[href*="notifications"] .badge');
             if (data.count > 0) {
                 if (notifLink) {
-                    notifLink.textContent = data.count;
+                    notifLink.textContent = data.count > 99 ? '99+' : data.count;
                 }
             } else if (notifLink) {
                 notifLink.style.display = 'none';
@@ -0,0 +1,179 @@
+"""Shared fixtures for the Chirp test suite."""
+import os
+import sys
+
+import pytest
+
+# Add app directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+os.environ['DATABASE_PATH'] = ':memory:'
+os.environ['SECRET_KEY'] = 'test-secret-key'
+os.environ['ARGON2_TIME_COST'] = '1'
+os.environ['ARGON2_MEMORY_COST'] = '1024'
+
+
+@pytest.fixture(scope='session')
+def app():
+    """The Flask app, imported once for the whole run."""
+    from main import app
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture(scope='session')
+def db_template(app):
+    """A freshly initialized database, built once and copied into each test."""
+    import database
+    database._memory_db = None
+    with app.app_context():
+        database.init_db()
+    template = database._memory_db
+    database._memory_db = None
+    return template
+
+
+@pytest.fixture
+def db(db_template):
+    """An empty in-memory database with cold caches; returns its connection.
+
+    Not autouse: tests that never touch the database skip the reset.
+    """
+    import cache
+    import database
+    from routes import admin, api, feed, messages, setup
+
+    # Restore the initialized schema page by page rather than re-running it
+    database._memory_db = None
+    conn = database.get_db_write()
+    db_template.backup(conn)
+    database.settings_cache.invalidate()
+
+    admin._dashboard_stats.cache_clear()
+    api._trending_tags.cache_clear()
+    feed._trending.cache_clear()
+    feed.active_announcements.cache_clear()
+    messages._row_cache.clear()
+    setup._admin_exists = False
+    cache.profile_counts.clear()
+    return conn
+
+
+@pytest.fixture
+def client(app, db):
+    """A test client; every request reads site settings, so it needs ``db``."""
+    return app.test_client()
+
+
+@pytest.fixture(scope='session')
+def password_hash(app):
+    """Hash of the default test password, computed once per run."""
+    from routes import hash_password
+    return hash_password('password123')
+
+
+@pytest.fixture
+def make_user(db, password_hash):
+    """Insert a user whose password is 'password123'; returns their id.
+
+    Much cheaper than register_user() for users a test only needs to
+    exist; the client stays logged out.
+    """
+    def make(username='testuser', email=None):
+        user_id = db.execute(
+            '''INSERT INTO users (username, email, password_hash, display_name)
+               VALUES (?, ?, ?, ?) RETURNING id''',
+            (username, email or f'{username}@test.com', password_hash, username.title())
+        ).fetchone()[0]
+        db.commit()
+        return user_id
+    return make
+
+
+@pytest.fixture
+def login_as(client):
+    """Log the client in as ``user_id`` without going through /login."""
+    def login(user_id):
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess.permanent = True
+        return user_id
+    return login
+
+
+@pytest.fixture
+def testuser(make_user, login_as):
+    """Log the client in as a freshly created 'testuser'; returns their id."""
+    return login_as(make_user('testuser', 'test@test.com'))
+
+
+@pytest.fixture
+def csrf_from(client):
+    """The client session's CSRF token, read without rendering a page.
+
+    Minted like main.csrf_token() if the session has none yet, so it
+    follows the session through login and logout.
+    """
+    def fetch():
+        from main import new_csrf
+        with client.session_transaction() as sess:
+            if 'csrf_token' not in sess:
+                sess['csrf_token'] = new_csrf()
+            return sess['csrf_token']
+    return fetch
+
+
+@pytest.fixture
+def flashes(client):
+    """Pop the messages flashed since the last page render.
+
+    Reading them from the session lets a test check a POST's outcome
+    without following its redirect.
+    """
+    def pop():
+        with client.session_transaction() as sess:
+            return [message for _, message in sess.pop('_flashes', [])]
+    return pop
+
+
+@pytest.fixture
+def register_user(client, csrf_from):
+    """Register a test user; the client stays logged in as them."""
+    def register(username='testuser', email='test@test.com', password='password123'):
+        csrf = csrf_from()
+        return client.post('/register', data={
+            'csrf_token': csrf,
+            'username': username,
+            'email': email,
+            'password': password,
+            'confirm_password': password,
+            'display_name': username.title(),
+        }, follow_redirects=True)
+    return register
+
+
+@pytest.fixture
+def login_user(client, csrf_from):
+    def login(login_id='testuser', password='password123'):
+        csrf = csrf_from()
+        return client.post('/login', data={
+            'csrf_token': csrf,
+            'login': login_id,
+            'password': password,
+        }, follow_redirects=True)
+    return login
+
+
+@pytest.fixture
+def create_admin(client, csrf_from):
+    """Create the admin account through the setup wizard (logs it in)."""
+    def create():
+        csrf = csrf_from()
+        return client.post('/setup', data={
+            'csrf_token': csrf,
+            'step': '1',
+            'username': 'admin',
+            'email': 'admin@test.com',
+            'password': 'adminpass123',
+        })
+    return create
@@ -1,379 +1,623 @@
 """Tests for Chirp application - critical functions."""
 import os
-import sys
-import json
+import re
 import tempfile
-import unittest
+import time
 
-# Add app directory to path
-sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+import pytest
 
-os.environ['DATABASE_PATH'] = ':memory:'
-os.environ['SECRET_KEY'] = 'test-secret-key'
+try:
+    from orjson import loads
+except ImportError:  # optional; falls back to the stdlib parser
+    from json import loads
 
 
-class ChirpTestCase(unittest.TestCase):
-    """Base test case with app setup."""
-
-    def setUp(self):
-        import database
-        database._memory_db = None  # Reset shared in-memory DB
-
-        from main import app
-        from database import init_db, get_db
-
-        self.app = app
-        self.app.config['TESTING'] = True
-        self.client = self.app.test_client()
-
-        with self.app.app_context():
-            init_db()
-
-    def _get_csrf_token(self, response):
-        """Extract CSRF token from response."""
-        data = response.data.decode()
-        idx = data.find('name="csrf_token" value="')
-        if idx == -1:
-            return ''
-        start = idx + len('name="csrf_token" value="')
-        end = data.find('"', start)
-        return data[start:end]
-
-    def _register_user(self, username='testuser', email='test@test.com',
-                       password='password123'):
-        """Register a test user and return the session client."""
-        # Get CSRF token
-        resp = self.client.get('/register')
-        csrf = self._get_csrf_token(resp)
-
-        return self.client.post('/register', data={
-            'csrf_token': csrf,
-            'username': username,
-            'email': email,
-            'password': password,
-            'confirm_password': password,
-            'display_name': username.title(),
-        }, follow_redirects=True)
-
-    def _login_user(self, login_id='testuser', password='password123'):
-        """Login a test user."""
-        resp = self.client.get('/login')
-        csrf = self._get_csrf_token(resp)
-
-        return self.client.post('/login', data={
-            'csrf_token': csrf,
-            'login': login_id,
-            'password': password,
-        }, follow_redirects=True)
-
-    def _get_csrf_from_page(self, path='/home'):
-        """Get a CSRF token from any page."""
-        resp = self.client.get(path)
-        return self._get_csrf_token(resp)
-
-
-class TestDatabaseInit(ChirpTestCase):
+class TestDatabaseInit:
     """Test database initialization."""
 
-    def test_tables_created(self):
+    def test_tables_created(self, db):
         """All required tables should be created."""
-        with self.app.app_context():
-            from database import get_db
-            db = get_db()
-            tables = db.execute(
-                "SELECT name FROM sqlite_master WHERE type='table'"
-            ).fetchall()
-            table_names = [t['name'] for t in tables]
-
-            required = ['users', 'posts', 'follows', 'likes', 'bookmarks',
-                        'notifications', 'community_notes', 'staff_notes',
-                        'announcements', 'reports', 'sessions', 'hashtags',
-                        'conversations', 'messages', 'site_settings',
-                        'audit_log', 'polls', 'blocks', 'mutes']
-            for table in required:
-                self.assertIn(table, table_names, f"Missing table: {table}")
-
-    def test_default_settings(self):
+        table_names = {row['name'] for row in db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'"
+        )}
+
+        required = {'users', 'posts', 'follows', 'likes', 'bookmarks',
+                    'notifications', 'community_notes', 'staff_notes',
+                    'announcements', 'reports', 'sessions', 'hashtags',
+                    'conversations', 'messages', 'site_settings',
+                    'audit_log', 'polls', 'blocks', 'mutes'}
+        missing = required - table_names
+        assert not missing, f"Missing tables: {sorted(missing)}"
+
+    def test_default_settings(self, db):
         """Default site settings should be inserted."""
-        with self.app.app_context():
-            from database import get_db
-            db = get_db()
-            setting = db.execute(
-                "SELECT value FROM site_settings WHERE key = 'site_name'"
-            ).fetchone()
-            self.assertIsNotNone(setting)
-            self.assertEqual(setting['value'], 'Chirp')
+        setting = db.execute(
+            "SELECT value FROM site_settings WHERE key = 'site_name'"
+        ).fetchone()
+        assert setting is not None
+        assert setting['value'] == 'Chirp'
 
 
-class TestAuth(ChirpTestCase):
+class TestAuth:
     """Test authentication system."""
 
-    def test_login_page_renders(self):
-        resp = self.client.get('/login')
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'Welcome back', resp.data)
+    def test_login_page_renders(self, client):
+        resp = client.get('/login')
+        assert resp.status_code == 200
+        assert b'Welcome back' in resp.data
 
-    def test_register_page_renders(self):
-        resp = self.client.get('/register')
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'Create your account', resp.data)
+    def test_register_page_renders(self, client):
+        resp = client.get('/register')
+        assert resp.status_code == 200
+        assert b'Create your account' in resp.data
 
-    def test_registration_success(self):
-        resp = self._register_user()
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'Welcome to Chirp', resp.data)
+    def test_registration_success(self, register_user):
+        resp = register_user()
+        assert resp.status_code == 200
+        assert b'Welcome to Chirp' in resp.data
 
-    def test_registration_duplicate_username(self):
-        self._register_user()
+    def test_registration_duplicate_username(self, client, register_user, csrf_from):
+        register_user()
         # Logout
-        csrf = self._get_csrf_from_page()
-        self.client.post('/logout', data={'csrf_token': csrf})
+        csrf = csrf_from()
+        client.post('/logout', data={'csrf_token': csrf})
         # Try to register same username
-        resp = self._register_user()
-        self.assertIn(b'already taken', resp.data)
+        resp = register_user()
+        assert b'already taken' in resp.data
 
-    def test_registration_short_password(self):
-        resp = self.client.get('/register')
-        csrf = self._get_csrf_token(resp)
-        resp = self.client.post('/register', data={
+    def test_registration_short_password(self, client, csrf_from):
+        csrf = csrf_from()
+        resp = client.post('/register', data={
             'csrf_token': csrf,
             'username': 'newuser',
             'email': 'new@test.com',
             'password': 'short',
             'confirm_password': 'short',
         }, follow_redirects=True)
-        self.assertIn(b'at least 8 characters', resp.data)
-
-    def test_login_success(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page()
-        self.client.post('/logout', data={'csrf_token': csrf})
-        resp = self._login_user()
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'Welcome back', resp.data)
-
-    def test_login_wrong_password(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page()
-        self.client.post('/logout', data={'csrf_token': csrf})
-        resp = self._login_user(password='wrongpassword')
-        self.assertIn(b'Invalid', resp.data)
-
-    def test_profile_page(self):
-        self._register_user()
-        resp = self.client.get('/user/testuser')
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'Testuser', resp.data)
-
-    def test_profile_404(self):
-        resp = self.client.get('/user/nonexistent')
-        self.assertEqual(resp.status_code, 404)
-
-
-class TestPosts(ChirpTestCase):
+        assert b'at least 8 characters' in resp.data
+
+    def test_registration_invalid_username(self, register_user):
+        for username in ('ab', 'bad name', 'x' * 31):
+            resp = register_user(username=username)
+            assert b'Username must be 3-30' in resp.data
+
+    def test_session_cookie_reissued_lazily(self, client, register_user):
+        from unittest import mock
+        register_user()
+        client.get('/home')
+        resp = client.get('/home')
+        assert 'Set-Cookie' not in resp.headers
+
+        with mock.patch('main.time.time', return_value=time.time() + 3600):
+            resp = client.get('/home')
+        assert 'session=' in resp.headers.get('Set-Cookie', '')
+
+    def test_login_success(self, make_user, login_user):
+        make_user()
+        resp = login_user()
+        assert resp.status_code == 200
+        assert b'Welcome back' in resp.data
+
+    def test_login_wrong_password(self, make_user, login_user):
+        make_user()
+        resp = login_user(password='wrongpassword')
+        assert b'Invalid' in resp.data
+
+    def test_login_unknown_user(self, login_user):
+        resp = login_user(login_id='nobody')
+        assert b'Invalid' in resp.data
+
+        from routes import check_password
+        assert not check_password('chirp', None)
+
+    def test_password_hash_uses_configured_argon2(self, app, register_user):
+        register_user()
+        with app.app_context():
+            from database import get_db
+            row = get_db().execute('SELECT password_hash FROM users').fetchone()
+        assert row['password_hash'].startswith('$argon2id$v=19$m=1024,t=1,p=2$')
+
+    def test_login_upgrades_bcrypt_hash(self, app, make_user, login_user):
+        import bcrypt
+        make_user()
+        legacy = bcrypt.hashpw(b'password123', bcrypt.gensalt(4)).decode()
+        with app.app_context():
+            from database import get_db_write
+            db = get_db_write()
+            db.execute('UPDATE users SET password_hash = ?', (legacy,))
+            db.commit()
+
+        resp = login_user()
+        assert b'Welcome back' in resp.data
+        with app.app_context():
+            from database import get_db
+            row = get_db().execute('SELECT password_hash FROM users').fetchone()
+        assert row['password_hash'].startswith('$argon2id$')
+
+    def test_profile_page(self, client, testuser):
+        resp = client.get('/user/testuser')
+        assert resp.status_code == 200
+        assert b'Testuser' in resp.data
+
+    def test_profile_marks_viewer_interactions(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        for content in ('Liked post', 'Plain post'):
+            client.post('/compose', data={'csrf_token': csrf, 'content': content})
+        client.post('/post/1/like', data={'csrf_token': csrf})
+        client.post('/post/1/bookmark', data={'csrf_token': csrf})
+
+        resp = client.get('/user/testuser')
+        assert resp.data.count(b'like-btn liked') == 1
+        assert resp.data.count(b'bookmark-btn bookmarked') == 1
+
+        client.post('/logout', data={'csrf_token': csrf})
+        resp = client.get('/user/testuser')
+        assert resp.status_code == 200
+        assert b'like-btn liked' not in resp.data
+
+    def test_profile_counts_follow_changes(self, client, make_user, login_as, csrf_from):
+        make_user('alice')
+        login_as(make_user('bob'))
+        csrf = csrf_from()
+
+        resp = client.get('/user/alice')
+        assert b'<strong>0</strong> Followers' in resp.data
+
+        client.post('/follow/1', data={'csrf_token': csrf})
+        resp = client.get('/user/alice')
+        assert b'<strong>1</strong> Followers' in resp.data
+
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'Hello'})
+        resp = client.get('/user/bob')
+        assert b'1 chirps' in resp.data
+
+    def test_counts_cache_is_bounded(self):
+        from cache import CountsCache
+        counts = CountsCache('test-counts', max_entries=2)
+        loads_done = []
+        for user_id in (1, 2, 3, 1):
+            counts.get(user_id, lambda: loads_done.append(user_id) or {})
+        assert len(counts._local) == 2
+        assert loads_done == [1, 2, 3, 1]
+
+    def test_profile_404(self, client):
+        resp = client.get('/user/nonexistent')
+        assert resp.status_code == 404
+
+
+class TestPosts:
     """Test post/chirp system."""
 
-    def test_compose_page(self):
-        self._register_user()
-        resp = self.client.get('/compose')
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'New Chirp', resp.data)
+    def test_compose_page(self, client, testuser):
+        resp = client.get('/compose')
+        assert resp.status_code == 200
+        assert b'New Chirp' in resp.data
 
-    def test_create_post(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        resp = self.client.post('/compose', data={
+    def test_create_post(self, client, testuser, csrf_from, flashes):
+        csrf = csrf_from()
+        resp = client.post('/compose', data={
             'csrf_token': csrf,
             'content': 'Hello world! #test',
-        }, follow_redirects=True)
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'Chirp posted', resp.data)
-
-    def test_create_post_too_long(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        resp = self.client.post('/compose', data={
+        })
+        assert resp.status_code == 302
+        assert 'Chirp posted! 🐦' in flashes()
+
+    def test_create_post_with_image(self, app, client, testuser, csrf_from):
+        import io
+        import routes
+        csrf = csrf_from()
+        with tempfile.TemporaryDirectory() as tmp:
+            saved_dir, routes.UPLOAD_DIR = routes.UPLOAD_DIR, tmp
+            routes._upload_dirs.clear()
+            try:
+                client.post('/compose', data={
+                    'csrf_token': csrf,
+                    'content': 'Picture time',
+                    'media': (io.BytesIO(b'fake image bytes'), 'photo.PNG'),
+                }, content_type='multipart/form-data')
+            finally:
+                routes.UPLOAD_DIR = saved_dir
+                routes._upload_dirs.clear()
+            stored = os.listdir(os.path.join(tmp, 'media'))
+
+        assert len(stored) == 1
+        assert re.search(r'^[0-9a-f]{32}\.png$', stored[0])
+        with app.app_context():
+            from database import get_db
+            media = get_db().execute('SELECT media FROM posts WHERE id = 1').fetchone()['media']
+        assert loads(media) == [f'/uploads/media/{stored[0]}']
+
+    def test_large_upload_copied_intact(self, client, testuser, csrf_from):
+        import io
+        import routes
+        csrf = csrf_from()
+        payload = os.urandom(3 * 1024 * 1024 + 7)  # spooled to disk by Werkzeug
+        with tempfile.TemporaryDirectory() as tmp:
+            saved_dir, routes.UPLOAD_DIR = routes.UPLOAD_DIR, tmp
+            routes._upload_dirs.clear()
+            try:
+                client.post('/compose', data={
+                    'csrf_token': csrf,
+                    'content': 'Big picture',
+                    'media': (io.BytesIO(payload), 'big.jpg'),
+                }, content_type='multipart/form-data')
+            finally:
+                routes.UPLOAD_DIR = saved_dir
+                routes._upload_dirs.clear()
+            media_dir = os.path.join(tmp, 'media')
+            with open(os.path.join(media_dir, os.listdir(media_dir)[0]), 'rb') as f:
+                assert f.read() == payload
+
+    def test_create_post_too_long(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        resp = client.post('/compose', data={
             'csrf_token': csrf,
             'content': 'x' * 501,
         }, follow_redirects=True)
-        self.assertIn(b'1-500 characters', resp.data)
+        assert b'1-500 characters' in resp.data
 
-    def test_view_post(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        self.client.post('/compose', data={
+    def test_view_post(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
             'csrf_token': csrf,
             'content': 'Test post content',
-        }, follow_redirects=True)
-        resp = self.client.get('/post/1')
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'Test post content', resp.data)
-
-    def test_like_post(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        self.client.post('/compose', data={
-            'csrf_token': csrf,
-            'content': 'Likeable post',
-        }, follow_redirects=True)
+        })
+        resp = client.get('/post/1')
+        assert resp.status_code == 200
+        assert b'Test post content' in resp.data
 
-        csrf = self._get_csrf_from_page()
-        resp = self.client.post('/post/1/like', data={
+    def test_like_post(self, db, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
             'csrf_token': csrf,
-        }, follow_redirects=True)
-        self.assertEqual(resp.status_code, 200)
+            'content': 'Likeable post',
+        })
 
-    def test_bookmark_post(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        self.client.post('/compose', data={
+        resp = client.post('/post/1/like', data={'csrf_token': csrf})
+        assert resp.status_code == 302
+        assert db.execute('SELECT COUNT(*) FROM likes WHERE post_id = 1').fetchone()[0] == 1
+
+    def test_like_post_json_toggles(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'Likeable'})
+
+        headers = {'Accept': 'application/json'}
+        resp = client.post('/post/1/like', data={'csrf_token': csrf}, headers=headers)
+        assert resp.get_json() == {'liked': True, 'count': 1}
+        resp = client.post('/post/1/like', data={'csrf_token': csrf}, headers=headers)
+        assert resp.get_json() == {'liked': False, 'count': 0}
+
+    def test_bookmark_and_repost_json_toggles(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'Shareable'})
+
+        headers = {'Accept': 'application/json'}
+        resp = client.post('/post/1/bookmark', data={'csrf_token': csrf}, headers=headers)
+        assert resp.get_json() == {'bookmarked': True}
+        resp = client.post('/post/1/repost', data={'csrf_token': csrf}, headers=headers)
+        assert resp.get_json() == {'reposted': True, 'count': 1}
+        resp = client.post('/post/1/repost', data={'csrf_token': csrf}, headers=headers)
+        assert resp.get_json() == {'reposted': False, 'count': 0}
+
+        resp = client.get('/post/1')
+        assert b'data-toggle="bookmark"' in resp.data
+        assert b'bookmark-btn bookmarked' in resp.data
+
+    def test_bookmark_post(self, db, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
             'csrf_token': csrf,
             'content': 'Bookmarkable post',
-        }, follow_redirects=True)
+        })
 
-        csrf = self._get_csrf_from_page()
-        resp = self.client.post('/post/1/bookmark', data={
-            'csrf_token': csrf,
-        }, follow_redirects=True)
-        self.assertEqual(resp.status_code, 200)
+        resp = client.post('/post/1/bookmark', data={'csrf_token': csrf})
+        assert resp.status_code == 302
+        assert db.execute('SELECT COUNT(*) FROM bookmarks WHERE post_id = 1').fetchone()[0] == 1
 
-    def test_delete_post(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        self.client.post('/compose', data={
+    def test_delete_post(self, client, testuser, csrf_from, flashes):
+        csrf = csrf_from()
+        client.post('/compose', data={
             'csrf_token': csrf,
             'content': 'Post to delete',
-        }, follow_redirects=True)
+        })
 
-        csrf = self._get_csrf_from_page()
-        resp = self.client.post('/post/1/delete', data={
+        resp = client.post('/post/1/delete', data={
             'csrf_token': csrf,
-        }, follow_redirects=True)
-        self.assertIn(b'Post deleted', resp.data)
+        })
+        assert resp.status_code == 302
+        assert 'Post deleted.' in flashes()
 
-    def test_reply_to_post(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        self.client.post('/compose', data={
+    def test_reply_to_post(self, client, testuser, csrf_from, flashes):
+        csrf = csrf_from()
+        client.post('/compose', data={
             'csrf_token': csrf,
             'content': 'Original post',
-        }, follow_redirects=True)
+        })
 
-        csrf = self._get_csrf_from_page('/post/1')
-        resp = self.client.post('/post/1/reply', data={
+        resp = client.post('/post/1/reply', data={
             'csrf_token': csrf,
             'content': 'This is a reply',
-        }, follow_redirects=True)
-        self.assertIn(b'Reply posted', resp.data)
-
-    def test_hashtag_extraction(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        self.client.post('/compose', data={
+        })
+        assert resp.status_code == 302
+        assert 'Reply posted!' in flashes()
+
+    def test_view_post_marks_likes_and_bookmarks(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'Parent'})
+        client.post('/post/1/reply', data={'csrf_token': csrf, 'content': 'Child'})
+        client.post('/post/1/like', data={'csrf_token': csrf})
+        client.post('/post/2/bookmark', data={'csrf_token': csrf})
+
+        resp = client.get('/post/1')
+        assert resp.data.count(b'like-btn liked') == 1
+        assert resp.data.count(b'bookmark-btn bookmarked') == 1
+
+    def test_view_deleted_post_with_replies(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'Parent'})
+        client.post('/post/1/reply', data={'csrf_token': csrf, 'content': 'Child'})
+        client.post('/post/1/delete', data={'csrf_token': csrf})
+
+        assert client.get('/post/1').status_code == 404
+        resp = client.get('/post/2')
+        assert resp.status_code == 200
+        assert b'Child' in resp.data
+
+    def test_hashtag_extraction(self, app, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
             'csrf_token': csrf,
             'content': 'Testing #hashtags and #chirp',
-        }, follow_redirects=True)
+        })
 
-        with self.app.app_context():
+        with app.app_context():
             from database import get_db
             db = get_db()
             tags = db.execute('SELECT tag FROM hashtags').fetchall()
             tag_names = [t['tag'] for t in tags]
-            self.assertIn('hashtags', tag_names)
-            self.assertIn('chirp', tag_names)
+            assert 'hashtags' in tag_names
+            assert 'chirp' in tag_names
+
+    def test_poll_vote_counts(self, client, testuser, make_user, login_as, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
+            'csrf_token': csrf, 'content': 'Pick one',
+            'poll_option_0': 'Red', 'poll_option_1': 'Green', 'poll_option_2': 'Blue',
+            'poll_duration': 'soon',
+        })
+        resp = client.get('/post/1')
+        assert b'0 votes' in resp.data
+        assert b'poll-vote-btn' in resp.data
+
+        client.post('/poll/1/vote', data={'csrf_token': csrf, 'option': 1})
+        login_as(make_user('user2'))
+        csrf = csrf_from()
+        client.post('/poll/1/vote', data={'csrf_token': csrf, 'option': 1})
+
+        resp = client.get('/post/1')
+        assert b'2 votes' in resp.data
+        assert b'poll-vote-btn' not in resp.data
+        pcts = re.findall(rb'poll-pct">(\d+)%', resp.data)
+        assert pcts == [b'0', b'100', b'0']
+
+    def test_add_community_note_checks_sources(self, app, client, testuser, csrf_from, flashes):
+        csrf = csrf_from()
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'Claim'})
+
+        resp = client.post('/post/1/community-note', data={
+            'csrf_token': csrf, 'content': 'Cats & dogs',
+            'source1': 'javascript:alert(1)', 'source2': 'not a url',
+        })
+        assert resp.status_code == 302
+        assert 'At least one source link is required.' in flashes()
 
+        client.post('/post/1/community-note', data={
+            'csrf_token': csrf, 'content': 'Cats & dogs',
+            'source1': 'ftp://example.com', 'source2': 'https://example.com/a?b=1&c=2',
+        })
+        with app.app_context():
+            from database import get_db
+            note = get_db().execute('SELECT content, sources FROM community_notes').fetchone()
+            assert note['content'] == 'Cats & dogs'
+            assert loads(note['sources']) == ['https://example.com/a?b=1&c=2']
+
+    def test_rate_community_note(self, app, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'Claim'})
+        with app.app_context():
+            from database import get_db_write
+            db = get_db_write()
+            db.execute("INSERT INTO community_notes (post_id, author_id, content, sources) "
+                       "VALUES (1, 1, 'Context', '[]')")
+            db.commit()
+
+        def note():
+            from database import get_db
+            with app.app_context():
+                return tuple(get_db().execute(
+                    'SELECT helpful_count, not_helpful_count, status FROM community_notes'
+                ).fetchone())
+
+        client.post('/community-note/1/rate', data={'csrf_token': csrf, 'rating': 'helpful'})
+        assert note() == (1, 0, 'proposed')
+        client.post('/community-note/1/rate', data={'csrf_token': csrf, 'rating': 'not_helpful'})
+        assert note() == (0, 1, 'proposed')
+
+        with app.app_context():
+            from database import get_db_write
+            db = get_db_write()
+            db.executemany("INSERT INTO users (username, email, password_hash) VALUES (?, ?, 'x')",
+                           [('a', 'a@test.com'), ('b', 'b@test.com')])
+            db.execute("INSERT INTO community_note_ratings (note_id, user_id, rating) "
+                       "SELECT 1, id, 'helpful' FROM users WHERE id > 1")
+            db.commit()
+        client.post('/community-note/1/rate', data={'csrf_token': csrf, 'rating': 'helpful'})
+        assert note() == (3, 0, 'approved')
+
+    def test_reused_hashtag_counts_and_links_posts(self, app, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'First #chirp'})
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'Second #chirp #new'})
+
+        with app.app_context():
+            from database import get_db
+            db = get_db()
+            counts = dict(db.execute('SELECT tag, post_count FROM hashtags').fetchall())
+            assert counts == {'chirp': 2, 'new': 1}
+            links = db.execute('''
+                SELECT ph.post_id, h.tag FROM post_hashtags ph
+                JOIN hashtags h ON h.id = ph.hashtag_id ORDER BY 1, 2
+            ''').fetchall()
+            assert [tuple(r) for r in links] == [(1, 'chirp'), (2, 'chirp'), (2, 'new')]
 
-class TestFeed(ChirpTestCase):
+
+class TestFeed:
     """Test feed and discovery."""
 
-    def test_home_feed(self):
-        self._register_user()
-        resp = self.client.get('/home')
-        self.assertEqual(resp.status_code, 200)
+    def test_home_feed(self, client, testuser):
+        resp = client.get('/home')
+        assert resp.status_code == 200
+
+    def test_explore_page(self, client, testuser):
+        resp = client.get('/explore')
+        assert resp.status_code == 200
+
+    def test_explore_trending_is_cached(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'First #launch'})
+        client.post('/post/1/like', data={'csrf_token': csrf})
+
+        resp = client.get('/explore')
+        assert b'#launch' in resp.data
+        assert b'like-btn liked' in resp.data
 
-    def test_explore_page(self):
-        self._register_user()
-        resp = self.client.get('/explore')
-        self.assertEqual(resp.status_code, 200)
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'Second #later'})
+        assert b'#later' not in client.get('/explore').data
 
-    def test_search_page(self):
-        resp = self.client.get('/search')
-        self.assertEqual(resp.status_code, 200)
+        from routes import feed
+        feed._trending.cache_clear()
+        assert b'#later' in client.get('/explore').data
 
-    def test_search_posts(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        self.client.post('/compose', data={
+    def test_explore_suggestions(self, client, make_user, login_as, csrf_from):
+        make_user()
+        login_as(make_user('user2'))
+
+        resp = client.get('/explore')
+        assert b'suggestion-card' in resp.data
+        assert b'@testuser' in resp.data
+
+        csrf = csrf_from()
+        client.post('/follow/1', data={'csrf_token': csrf})
+        resp = client.get('/explore')
+        assert b'suggestion-card' not in resp.data
+
+    def test_search_page(self, client):
+        resp = client.get('/search')
+        assert resp.status_code == 200
+
+    def test_search_posts(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
             'csrf_token': csrf,
             'content': 'Searchable unique content xyz',
-        }, follow_redirects=True)
+        })
 
-        resp = self.client.get('/search?q=xyz&type=posts')
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'Searchable unique content', resp.data)
+        resp = client.get('/search?q=xyz&type=posts')
+        assert resp.status_code == 200
+        assert b'Searchable unique content' in resp.data
 
-    def test_search_users(self):
-        self._register_user()
-        resp = self.client.get('/search?q=testuser&type=users')
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'testuser', resp.data)
+    def test_search_users(self, client, testuser):
+        resp = client.get('/search?q=testuser&type=users')
+        assert resp.status_code == 200
+        assert b'testuser' in resp.data
 
-    def test_bookmarks_page(self):
-        self._register_user()
-        resp = self.client.get('/bookmarks')
-        self.assertEqual(resp.status_code, 200)
+    def test_search_users_and_hashtags(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
+            'csrf_token': csrf, 'content': 'Learning #python today',
+        })
 
-    def test_hashtag_page(self):
-        self._register_user()
-        resp = self.client.get('/hashtag/test')
-        self.assertEqual(resp.status_code, 200)
+        resp = client.get('/search?q=STUS&type=users')
+        assert b'testuser' in resp.data
+        resp = client.get('/search?q=PYT&type=hashtags')
+        assert b'python' in resp.data
+        resp = client.get('/search?q=thon&type=hashtags')
+        assert b'#python' in resp.data
+        resp = client.get('/search?q=t%25&type=hashtags')
+        assert b'#python' not in resp.data
 
+    def test_bookmarks_page(self, client, testuser):
+        resp = client.get('/bookmarks')
+        assert resp.status_code == 200
 
-class TestFollow(ChirpTestCase):
-    """Test follow/unfollow system."""
+    def test_hashtag_page(self, client, testuser):
+        resp = client.get('/hashtag/test')
+        assert resp.status_code == 200
 
-    def test_follow_user(self):
-        self._register_user()
-        # Create second user
-        csrf = self._get_csrf_from_page()
-        self.client.post('/logout', data={'csrf_token': csrf})
 
-        self._register_user('user2', 'user2@test.com')
+class TestFollow:
+    """Test follow/unfollow system."""
 
-        csrf = self._get_csrf_from_page()
-        resp = self.client.post('/follow/1', data={
+    def test_follow_user(self, client, make_user, login_as, csrf_from, flashes):
+        make_user()
+        login_as(make_user('user2'))
+
+        csrf = csrf_from()
+        resp = client.post('/follow/1', data={
             'csrf_token': csrf,
-        }, follow_redirects=True)
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'Following', resp.data)
+        })
+        assert resp.status_code == 302
+        assert 'Following @testuser!' in flashes()
+
+    def test_block_removes_follow_and_prevents_refollow(self, app, client, make_user, login_as, csrf_from, flashes):
+        make_user()
+        login_as(make_user('user2'))
+        csrf = csrf_from()
+
+        client.post('/follow/1', data={'csrf_token': csrf})
+        client.post('/follow/1', data={'csrf_token': csrf})
+        assert 'Unfollowed @testuser' in flashes()
+        client.post('/follow/1', data={'csrf_token': csrf})
+
+        client.post('/block/1', data={'csrf_token': csrf})
+        client.post('/follow/1', data={'csrf_token': csrf})
+        assert 'Unable to follow this user.' in flashes()
+        with app.app_context():
+            from database import get_db
+            db = get_db()
+            assert db.execute('SELECT COUNT(*) FROM follows').fetchone()[0] == 0
+            assert db.execute(
+                "SELECT COUNT(*) FROM notifications WHERE type = 'follow'").fetchone()[0] == 2
 
+        client.post('/block/1', data={'csrf_token': csrf})
+        client.post('/follow/1', data={'csrf_token': csrf})
+        assert 'Following @testuser!' in flashes()
 
-class TestSetup(ChirpTestCase):
+
+class TestSetup:
     """Test setup wizard."""
 
-    def test_setup_page_accessible(self):
-        resp = self.client.get('/setup')
-        self.assertEqual(resp.status_code, 200)
-        self.assertIn(b'Create Admin Account', resp.data)
+    def test_setup_page_accessible(self, client):
+        resp = client.get('/setup')
+        assert resp.status_code == 200
+        assert b'Create Admin Account' in resp.data
 
-    def test_setup_creates_admin(self):
-        resp = self.client.get('/setup')
-        csrf = self._get_csrf_token(resp)
+    def test_setup_creates_admin(self, client, csrf_from):
+        csrf = csrf_from()
 
-        resp = self.client.post('/setup', data={
+        resp = client.post('/setup', data={
             'csrf_token': csrf,
             'step': '1',
             'username': 'admin',
             'email': 'admin@test.com',
             'password': 'adminpass123',
         }, follow_redirects=True)
-        self.assertIn(b'Step 2', resp.data)
+        assert b'Step 2' in resp.data
 
-    def test_setup_blocked_after_admin_exists(self):
+    def test_setup_blocked_after_admin_exists(self, client, csrf_from, flashes):
         # Create admin via setup
-        resp = self.client.get('/setup')
-        csrf = self._get_csrf_token(resp)
-        self.client.post('/setup', data={
+        csrf = csrf_from()
+        client.post('/setup', data={
             'csrf_token': csrf,
             'step': '1',
             'username': 'admin',
@@ -382,121 +626,604 @@ class TestSetup(ChirpTestCase):
         })
 
         # Try to access setup again
-        resp = self.client.get('/setup', follow_redirects=True)
-        self.assertIn(b'Setup already complete', resp.data)
+        client.get('/setup')
+        assert 'Setup already complete.' in flashes()
+
+    def test_setup_step_two_saves_site_settings(self, client, create_admin, csrf_from, flashes):
+        from database import settings_cache
+        create_admin()
+        csrf = csrf_from()
+        resp = client.post('/setup', data={
+            'csrf_token': csrf,
+            'step': '2',
+            'site_name': 'Tweeter',
+            'site_description': 'A test site',
+            'theme_color': '#123456',
+        })
+        assert resp.status_code == 302
+        settings = settings_cache.get()
+        assert (settings['site_name'], settings['site_description'],
+                settings['theme_color']) == ('Tweeter', 'A test site', '#123456')
+
+        csrf = csrf_from()
+        client.post('/logout', data={'csrf_token': csrf})
+        csrf = csrf_from()
+        client.post('/setup', data={
+            'csrf_token': csrf, 'step': '2', 'site_name': 'Hijacked',
+        })
+        assert 'Setup already complete.' in flashes()
+        assert settings_cache.get()['site_name'] == 'Tweeter'
+
+    def test_setup_step_two_closed_to_other_admins(self, db, client, make_user, login_as,
+                                                   create_admin, csrf_from, flashes):
+        from database import settings_cache
+        create_admin()
+        csrf = csrf_from()
+        resp = client.post('/setup', data={
+            'csrf_token': csrf, 'step': '2', 'theme_color': '#000;}body{display:none',
+        })
+        assert b'Theme color must be a hex color' in resp.data
+        assert settings_cache.get()['theme_color'] == '#6750A4'
+
+        client.post('/setup', data={'csrf_token': csrf, 'step': '2', 'site_name': 'Done'})
+        resp = client.post('/setup', data={'csrf_token': csrf, 'step': '2', 'site_name': 'Again'})
+        assert resp.status_code == 302
+        assert settings_cache.get()['site_name'] == 'Done'
+
+        user_id = make_user('second')
+        db.execute('UPDATE users SET is_admin = 1 WHERE id = ?', (user_id,))
+        db.commit()
+        login_as(user_id)
+        flashes()
+        resp = client.post('/setup', data={
+            'csrf_token': csrf_from(), 'step': '2', 'site_name': 'Hijacked',
+        })
+        assert resp.status_code == 302
+        assert 'Setup already complete.' in flashes()
+        assert settings_cache.get()['site_name'] == 'Done'
+
+    def test_site_settings_refresh_cache(self, client, csrf_from):
+        """Saving site settings should invalidate the cached copy."""
+        from database import settings_cache
+        assert settings_cache.get()['site_name'] == 'Chirp'
+
+        csrf = csrf_from()
+        client.post('/setup', data={
+            'csrf_token': csrf,
+            'step': '1',
+            'username': 'admin',
+            'email': 'admin@test.com',
+            'password': 'adminpass123',
+        })
+        client.post('/admin/settings', data={
+            'csrf_token': csrf,
+            'site_name': 'Tweeter',
+            'site_description': 'Renamed',
+            'registration_mode': 'open',
+            'theme_color': '#123456',
+            'default_theme': 'auto',
+            'max_post_length': '500',
+            'posts_per_page': '20',
+        })
+        assert settings_cache.get()['site_name'] == 'Tweeter'
+
+
+class TestAdmin:
+    """Test administration panel."""
+
+    def test_dashboard_stats(self, client, create_admin, csrf_from):
+        create_admin()
+        csrf = csrf_from()
+        client.post('/compose', data={
+            'csrf_token': csrf,
+            'content': 'Counted post',
+        })
+        resp = client.get('/admin/')
+        assert resp.status_code == 200
+        assert b'<span class="stat-value">1</span>' in resp.data
+        assert b'<span class="stat-value"></span>' not in resp.data
+
+        # Counters are cached briefly; ?fresh=1 recomputes them.
+        client.post('/compose', data={
+            'csrf_token': csrf,
+            'content': 'Second post',
+        })
+        resp = client.get('/admin/?fresh=1')
+        assert b'<span class="stat-value">2</span>' in resp.data
+
+    def test_user_action_toggles(self, client, make_user, create_admin, csrf_from, flashes):
+        make_user()
+        create_admin()
+        csrf = csrf_from()
 
+        client.post('/admin/users/1/action', data={
+            'csrf_token': csrf, 'action': 'verify',
+        })
+        assert 'Verified @testuser' in flashes()
+        client.post('/admin/users/1/action', data={
+            'csrf_token': csrf, 'action': 'verify',
+        })
+        assert 'Unverified @testuser' in flashes()
 
-class TestAPI(ChirpTestCase):
+        resp = client.post('/admin/users/99/action', data={
+            'csrf_token': csrf, 'action': 'verify',
+        })
+        assert resp.status_code == 404
+
+    def test_audit_log_records_action(self, client, create_admin, csrf_from):
+        create_admin()
+        csrf = csrf_from()
+        client.post('/admin/announcements/create', data={
+            'csrf_token': csrf,
+            'title': 'Maintenance',
+            'content': 'Tonight',
+        })
+        resp = client.get('/admin/audit-log')
+        assert b'create announcement' in resp.data
+        assert b'Maintenance' in resp.data
+
+    def test_failed_audit_batch_is_logged(self, db, caplog):
+        import sqlite3
+        from database import BackgroundWriter
+
+        class FailingWriter(BackgroundWriter):
+            name = 'failing-writer'
+
+            def write(self, db, batch):
+                raise sqlite3.OperationalError('disk I/O error')
+
+        writer = FailingWriter()
+        writer._start()
+        writer._queue.put(('row',))
+        writer.flush()
+        assert 'failing-writer: failed to write 1 queued rows' in caplog.text
+        assert 'disk I/O error' in caplog.text
+
+    def test_announcement_shown_until_dismissed(self, client, create_admin, csrf_from):
+        create_admin()
+        csrf = csrf_from()
+        client.post('/admin/announcements/create', data={
+            'csrf_token': csrf, 'title': 'Maintenance', 'content': 'Tonight',
+        })
+        assert b'Maintenance' in client.get('/home').data
+
+        client.post('/announcement/1/dismiss', data={'csrf_token': csrf})
+        assert b'Maintenance' not in client.get('/home').data
+
+        client.post('/admin/announcements/create', data={
+            'csrf_token': csrf, 'title': 'Upgrade', 'content': 'Soon',
+        })
+        assert b'Upgrade' in client.get('/home').data
+        client.post('/admin/announcements/2/toggle', data={'csrf_token': csrf})
+        assert b'Upgrade' not in client.get('/home').data
+
+
+class TestAPI:
     """Test REST API endpoints."""
 
-    def test_api_get_post(self):
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        self.client.post('/compose', data={
+    def test_api_get_post(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
             'csrf_token': csrf,
             'content': 'API test post',
         })
 
-        resp = self.client.get('/api/v1/posts/1')
-        self.assertEqual(resp.status_code, 200)
-        data = json.loads(resp.data)
-        self.assertEqual(data['content'], 'API test post')
+        resp = client.get('/api/v1/posts/1')
+        assert resp.status_code == 200
+        data = loads(resp.data)
+        assert data['content'] == 'API test post'
+
+    def test_api_post_counts(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
+            'csrf_token': csrf,
+            'content': 'Counted post',
+        })
+        client.post('/post/1/like', data={'csrf_token': csrf})
+        client.post('/post/1/reply', data={
+            'csrf_token': csrf,
+            'content': 'A reply',
+        })
 
-    def test_api_search(self):
-        resp = self.client.get('/api/v1/search?q=test&type=users')
-        self.assertEqual(resp.status_code, 200)
-        data = json.loads(resp.data)
-        self.assertIn('results', data)
+        data = loads(client.get('/api/v1/posts/1').data)
+        assert data['like_count'] == 1
+        assert data['reply_count'] == 1
+        assert data['repost_count'] == 0
 
-    def test_api_trending(self):
-        resp = self.client.get('/api/v1/trending')
-        self.assertEqual(resp.status_code, 200)
-        data = json.loads(resp.data)
-        self.assertIn('trending', data)
+        data = loads(client.get('/api/v1/timeline').data)
+        counts = {p['id']: p['like_count'] for p in data['posts']}
+        assert counts == {1: 1, 2: 0}
 
-    def test_api_post_not_found(self):
-        resp = self.client.get('/api/v1/posts/9999')
-        self.assertEqual(resp.status_code, 404)
+    def test_api_like_toggle(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
+            'csrf_token': csrf,
+            'content': 'Like me',
+        })
 
+        data = loads(client.post('/api/v1/posts/1/like').data)
+        assert data == {'liked': True, 'count': 1}
+        data = loads(client.post('/api/v1/posts/1/like').data)
+        assert data == {'liked': False, 'count': 0}
+
+    def test_api_timeline_cursor(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        for i in range(3):
+            client.post('/compose', data={
+                'csrf_token': csrf,
+                'content': f'Post {i}',
+            })
+
+        data = loads(client.get('/api/v1/timeline?per_page=2').data)
+        assert [p['id'] for p in data['posts']] == [3, 2]
+        assert data['next_cursor'] is not None
+
+        resp = client.get(f"/api/v1/timeline?per_page=2&cursor={data['next_cursor']}")
+        data = loads(resp.data)
+        assert [p['id'] for p in data['posts']] == [1]
+        assert data['next_cursor'] is None
+
+        resp = client.get('/api/v1/timeline?cursor=bogus')
+        assert resp.status_code == 400
+
+    def test_api_timeline_followees(self, client, make_user, login_as, csrf_from):
+        csrf = csrf_from()
+        for name in ('alice', 'bob'):
+            login_as(make_user(name))
+            client.post('/compose', data={'csrf_token': csrf, 'content': f'From {name}'})
+
+        login_as(make_user('carol'))
+        client.post('/follow/1', data={'csrf_token': csrf})
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'From carol'})
+
+        data = loads(client.get('/api/v1/timeline').data)
+        assert [p['username'] for p in data['posts']] == ['carol', 'alice']
+
+    def test_api_get_user(self, client, testuser):
+        resp = client.get('/api/v1/users/testuser')
+        assert resp.status_code == 200
+        data = loads(resp.data)
+        assert data['username'] == 'testuser'
+        assert data['follower_count'] == 0
+        assert data['following_count'] == 0
+        assert 'password_hash' not in data
+
+    def test_api_search(self, client):
+        resp = client.get('/api/v1/search?q=test&type=users')
+        assert resp.status_code == 200
+        data = loads(resp.data)
+        assert 'results' in data
+
+    def test_api_search_full_text(self, client, testuser, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={
+            'csrf_token': csrf,
+            'content': 'Searchable unique content xyz',
+        })
 
-class TestSecurity(ChirpTestCase):
+        data = loads(client.get('/api/v1/search?q=nique cont').data)
+        assert [r['id'] for r in data['results']] == [1]
+
+        data = loads(client.get('/api/v1/search?q=STUS&type=users').data)
+        assert [r['username'] for r in data['results']] == ['testuser']
+
+        # Shorter than a trigram: no post search, username prefix only
+        data = loads(client.get('/api/v1/search?q=xy').data)
+        assert data['results'] == []
+        data = loads(client.get('/api/v1/search?q=TE&type=users').data)
+        assert [r['username'] for r in data['results']] == ['testuser']
+        data = loads(client.get('/api/v1/search?q=st&type=users').data)
+        assert data['results'] == []
+        data = loads(client.get('/api/v1/search?q=t%25&type=users').data)
+        assert data['results'] == []
+
+    def test_api_trending(self, client):
+        resp = client.get('/api/v1/trending')
+        assert resp.status_code == 200
+        data = loads(resp.data)
+        assert 'trending' in data
+
+    def test_api_rate_limit(self, client, request):
+        from routes import api
+        api._rate_limits.clear()
+        request.addfinalizer(api._rate_limits.clear)
+        for _ in range(api.RATE_LIMIT):
+            assert client.get('/api/v1/trending').status_code == 200
+        resp = client.get('/api/v1/trending')
+        assert resp.status_code == 429
+
+    def test_api_post_not_found(self, client):
+        resp = client.get('/api/v1/posts/9999')
+        assert resp.status_code == 404
+
+
+class TestSecurity:
     """Test security features."""
 
-    def test_csrf_protection(self):
+    def test_csrf_protection(self, client):
         """POST without CSRF token should be rejected."""
-        resp = self.client.post('/login', data={
+        resp = client.post('/login', data={
             'login': 'test',
             'password': 'test',
         })
-        self.assertEqual(resp.status_code, 403)
+        assert resp.status_code == 403
 
-    def test_security_headers(self):
-        resp = self.client.get('/login')
-        self.assertEqual(resp.headers.get('X-Content-Type-Options'), 'nosniff')
-        self.assertEqual(resp.headers.get('X-Frame-Options'), 'DENY')
-        self.assertEqual(resp.headers.get('X-XSS-Protection'), '1; mode=block')
+    def test_security_headers(self, client):
+        resp = client.get('/login')
+        assert resp.headers.get('X-Content-Type-Options') == 'nosniff'
+        assert resp.headers.get('X-Frame-Options') == 'DENY'
+        assert resp.headers.get('X-XSS-Protection') == '1; mode=block'
 
-    def test_xss_prevention(self):
+    def test_xss_prevention(self, client, testuser, csrf_from):
         """HTML in user input should be sanitized."""
-        self._register_user()
-        csrf = self._get_csrf_from_page('/compose')
-        self.client.post('/compose', data={
+        csrf = csrf_from()
+        client.post('/compose', data={
             'csrf_token': csrf,
             'content': '<script>alert("xss")</script>Hello',
-        }, follow_redirects=True)
-
-        resp = self.client.get('/post/1')
-        self.assertNotIn(b'<script>', resp.data)
+        })
 
-    def test_login_required_redirect(self):
+        resp = client.get('/post/1')
+        assert b'<script>' not in resp.data
+
+    def test_clean_passes_plain_text_through(self):
+        from routes import clean
+        text = 'Plain "text", it\'s fine 😀'
+        assert clean(text) is text
+        assert clean('a < b & <em>c</em><img src=x>') == 'a &lt; b &amp; <em>c</em>'
+
+    def test_static_assets_skip_session(self, client):
+        """Static files should not start a session or set a cookie."""
+        resp = client.get('/static/img/favicon.svg')
+        assert resp.status_code == 200
+        assert resp.headers.get('Set-Cookie') is None
+        resp.close()
+
+    def test_redirect_does_not_set_session(self, client):
+        """Form-less responses should not mint a CSRF token cookie."""
+        resp = client.get('/')
+        assert resp.status_code == 302
+        assert resp.headers.get('Set-Cookie') is None
+
+    def test_login_required_redirect(self, client):
         """Accessing protected page without login should redirect."""
-        resp = self.client.get('/home')
-        self.assertEqual(resp.status_code, 302)
+        resp = client.get('/home')
+        assert resp.status_code == 302
 
 
-class TestNotifications(ChirpTestCase):
+class TestNotifications:
     """Test notification system."""
 
-    def test_notifications_page(self):
-        self._register_user()
-        resp = self.client.get('/notifications/')
-        self.assertEqual(resp.status_code, 200)
+    def test_notifications_page(self, client, testuser):
+        resp = client.get('/notifications/')
+        assert resp.status_code == 200
+
+    def test_notification_count_api(self, client, testuser):
+        resp = client.get('/notifications/count')
+        assert resp.status_code == 200
+        data = loads(resp.data)
+        assert 'count' in data
+
+    def test_notification_count_counts_unread(self, app, client, testuser):
+        with app.app_context():
+            from database import get_db_write
+            db = get_db_write()
+            db.executemany(
+                "INSERT INTO notifications (user_id, type, message, is_read) VALUES (1, 'follow', 'x', ?)",
+                [(0,), (0,), (1,)])
+            db.commit()
+        resp = client.get('/notifications/count')
+        assert loads(resp.data) == {'count': 2}
+
+    def test_viewing_notifications_marks_them_read(self, app, client, testuser):
+        with app.app_context():
+            from database import get_db_write
+            db = get_db_write()
+            db.executemany(
+                "INSERT INTO notifications (user_id, type, message) VALUES (1, 'follow', 'x')",
+                [(), ()])
+            db.commit()
+        client.get('/notifications/')
+        resp = client.get('/notifications/count')
+        assert loads(resp.data) == {'count': 0}
+
+    def test_notification_badge_caps_at_99(self, app, client, testuser):
+        with app.app_context():
+            from database import get_db_write
+            db = get_db_write()
+            db.executemany(
+                "INSERT INTO notifications (user_id, type, message) VALUES (1, 'follow', 'x')",
+                [()] * 150)
+            db.commit()
+        resp = client.get('/notifications/count')
+        assert loads(resp.data) == {'count': 100}
+        resp = client.get('/home')
+        assert b'<span class="badge">99+</span>' in resp.data
+
+    def test_mentions_notify_each_user_once(self, app, client, make_user, login_as, csrf_from):
+        make_user()
+        login_as(make_user('user2'))
+        csrf = csrf_from()
+        client.post('/compose', data={
+            'csrf_token': csrf,
+            'content': 'Hi @testuser @TestUser @user2 @nobody',
+        })
+        client.post('/post/1/reply', data={
+            'csrf_token': csrf, 'content': 'Again @testuser',
+        })
 
-    def test_notification_count_api(self):
-        self._register_user()
-        resp = self.client.get('/notifications/count')
-        self.assertEqual(resp.status_code, 200)
-        data = json.loads(resp.data)
-        self.assertIn('count', data)
+        with app.app_context():
+            from database import get_db
+            rows = get_db().execute(
+                "SELECT user_id, actor_id, post_id FROM notifications WHERE type = 'mention' ORDER BY id"
+            ).fetchall()
+            assert [tuple(r) for r in rows] == [(1, 2, 1), (1, 2, 2)]
+
+    def test_reply_mention_points_at_reply(self, app, client, testuser, make_user, login_as, csrf_from):
+        csrf = csrf_from()
+        client.post('/compose', data={'csrf_token': csrf, 'content': 'Original'})
+        login_as(make_user('user2'))
+        csrf = csrf_from()
+        client.post('/post/1/reply', data={
+            'csrf_token': csrf, 'content': 'Hey @testuser',
+        })
 
+        with app.app_context():
+            from database import get_db
+            rows = get_db().execute(
+                'SELECT type, post_id FROM notifications WHERE user_id = 1 ORDER BY id'
+            ).fetchall()
+            assert [tuple(r) for r in rows] == [('reply', 1), ('mention', 2)]
 
-class TestMessages(ChirpTestCase):
-    """Test direct messaging."""
 
-    def test_inbox_page(self):
-        self._register_user()
-        resp = self.client.get('/messages/')
-        self.assertEqual(resp.status_code, 200)
+class TestMessages:
+    """Test direct messaging."""
 
-    def test_new_message_page(self):
-        self._register_user()
-        resp = self.client.get('/messages/new')
-        self.assertEqual(resp.status_code, 200)
+    def test_inbox_page(self, client, testuser):
+        resp = client.get('/messages/')
+        assert resp.status_code == 200
+
+    def test_new_message_page(self, client, testuser):
+        resp = client.get('/messages/new')
+        assert resp.status_code == 200
+
+    @pytest.fixture
+    def start_conversation(self, client, make_user, login_as, csrf_from):
+        """Create the given users, then message each as 'testuser'."""
+        def start(*usernames):
+            for name in usernames:
+                make_user(name)
+            login_as(make_user('testuser', 'test@test.com'))
+            csrf = csrf_from()
+            for name in usernames:
+                client.post('/messages/new', data={
+                    'csrf_token': csrf,
+                    'username': name,
+                    'content': f'hello {name}',
+                })
+        return start
+
+    def test_inbox_lists_other_members(self, client, start_conversation):
+        start_conversation('alice', 'bob')
+        resp = client.get('/messages/')
+        convs = resp.data.split(b'conversations-list', 1)[1]
+        assert b'Alice' in convs
+        assert b'Bob' in convs
+        assert b'hello alice' in convs
+        assert b'Testuser' not in convs
+
+    def test_inbox_query_uses_message_index(self, db):
+        from routes.messages import INBOX_SQL
+        plan = ' | '.join(row[3] for row in db.execute(
+            'EXPLAIN QUERY PLAN ' + INBOX_SQL, {'user_id': 1}))
+        assert 'AUTOMATIC' not in plan
+        assert 'COVERING INDEX idx_messages_conv_recent' in plan
+
+    def test_inbox_row_follows_new_messages(self, client, csrf_from, start_conversation):
+        start_conversation('alice')
+        client.get('/messages/')
+        client.post('/messages/1/send', data={
+            'csrf_token': csrf_from(),
+            'content': 'newest',
+        })
+        resp = client.get('/messages/')
+        assert b'newest' in resp.data
+        assert b'hello alice' not in resp.data
+
+    def test_inbox_row_cache_is_bounded(self, client, monkeypatch, start_conversation):
+        from routes import messages
+        monkeypatch.setattr(messages, 'ROW_CACHE_SIZE', 1)
+        start_conversation('alice', 'bob')
+        resp = client.get('/messages/')
+        assert b'hello alice' in resp.data
+        assert b'hello bob' in resp.data
+        assert len(messages._row_cache) == 1
+
+    def test_conversation_pages_history(self, app, client, start_conversation):
+        start_conversation('alice')
+        with app.app_context():
+            from database import get_db_write
+            db = get_db_write()
+            db.executemany(
+                "INSERT INTO messages (conversation_id, sender_id, content, created_at) "
+                "VALUES (1, 1, ?, datetime('2020-01-01', ? || ' minutes'))",
+                [(f'msg{i:03d}', i) for i in range(60)])
+            db.commit()
+
+        resp = client.get('/messages/1')
+        assert b'hello alice' in resp.data
+        assert b'msg011' in resp.data
+        assert b'msg010' not in resp.data
+        older = resp.data.split(b'?before=', 1)[1].split(b'"', 1)[0].decode()
+
+        resp = client.get(f'/messages/1/page?before={older}')
+        data = loads(resp.data)
+        assert [m['content'] for m in data['messages']] == [f'msg{i:03d}' for i in range(11)]
+        assert data['next_cursor'] is None
+
+        resp = client.get('/messages/1/page?before=bogus')
+        assert resp.status_code == 400
+
+    def test_conversation_requires_membership(self, app, client, make_user, login_as, csrf_from, start_conversation):
+        start_conversation('alice')
+        login_as(make_user('mallory'))
+        assert client.get('/messages/1').status_code == 404
+        assert client.get('/messages/1/page').status_code == 404
+        resp = client.post('/messages/1/send', data={
+            'csrf_token': csrf_from(),
+            'content': 'intrusion',
+        })
+        assert resp.status_code == 404
+        with app.app_context():
+            from database import get_db
+            sent = get_db().execute(
+                "SELECT COUNT(*) FROM messages WHERE content = 'intrusion'").fetchone()[0]
+        assert sent == 0
+
+    def test_conversation_marks_read_only_when_unread(self, app, client, start_conversation):
+        start_conversation('alice')
+        with app.app_context():
+            from database import get_db_write
+            db = get_db_write()
+            db.execute("UPDATE conversation_members SET last_read_at = '2000-01-01' WHERE user_id = 2")
+            db.commit()
+            read_at = lambda: db.execute(
+                'SELECT last_read_at FROM conversation_members WHERE user_id = 2'
+            ).fetchone()[0]
+
+            # Only testuser's own message is newer: nothing to mark read
+            client.get('/messages/1')
+            assert read_at() == '2000-01-01'
+
+            db.execute("INSERT INTO messages (conversation_id, sender_id, content) VALUES (1, 1, 'hi')")
+            db.commit()
+            client.get('/messages/1')
+            assert read_at() != '2000-01-01'
+
+    def test_send_message_notifies_other_members(self, app, client, csrf_from, start_conversation):
+        start_conversation('alice')
+        client.post('/messages/1/send', data={
+            'csrf_token': csrf_from(),
+            'content': 'second',
+        })
+        with app.app_context():
+            from database import get_db
+            rows = get_db().execute('''
+                SELECT u.username FROM notifications n JOIN users u ON n.user_id = u.id
+                WHERE n.type = 'message'
+            ''').fetchall()
+        assert [r['username'] for r in rows] == ['alice']
 
 
-class TestErrorPages(ChirpTestCase):
+class TestErrorPages:
     """Test error handling."""
 
-    def test_404_page(self):
-        resp = self.client.get('/nonexistent-page')
-        self.assertEqual(resp.status_code, 404)
-
-    def test_api_404(self):
-        resp = self.client.get('/api/v1/nonexistent')
-        self.assertEqual(resp.status_code, 404)
-        data = json.loads(resp.data)
-        self.assertIn('error', data)
+    def test_404_page(self, client):
+        resp = client.get('/nonexistent-page')
+        assert resp.status_code == 404
 
+    def test_api_404(self, client):
+        resp = client.get('/api/v1/nonexistent')
+        assert resp.status_code == 404
+        data = loads(resp.data)
+        assert 'error' in data
 
-if __name__ == '__main__':
-    unittest.main()